@@ -13,10 +13,28 @@ import torch
 import jsonlines
 import re
 import ast
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.manifest import StageManifest, record_rewrite
+from utils.jsonl_io import JsonlWriter, iter_jsonl
+from utils.json_extract import parse_augmented
+from utils.schemas import AUGMENTED_SCHEMA, ParseStats, matches
+
+try:
+    from vllm.sampling_params import GuidedDecodingParams
+except ImportError:
+    # vllm without offline guided decoding, parse_augmented does it all
+    GuidedDecodingParams = None
 
 
 model_path = "/model_path/UltraComposer"
 max_seq_len = 1024*8
+# outputs that do not parse into AUGMENTED_SCHEMA are regenerated this many times at repair_temperature
+repair_attempts = 2
+# guided decoding of the augmented query + questions, with the vllm version's GuidedDecodingParams
+guided = True
+repair_temperature = 1.0
 
 tokenizer = AutoTokenizer.from_pretrained(model_path)
 llm = LLM(
@@ -27,11 +45,15 @@ llm = LLM(
 )
 
 
-def generate_sample_batch(question_list, batch_size=1000):
+def generate_sample_batch(question_list, batch_size=1000, temperature=0.7):
+    guided_kwargs = {}
+    if guided and GuidedDecodingParams is not None:
+        guided_kwargs["guided_decoding"] = GuidedDecodingParams(json=AUGMENTED_SCHEMA)
     sampling_params = SamplingParams(max_tokens=max_seq_len,
-                                    temperature=0.7,
+                                    temperature=temperature,
                                     n=1,
-                                    stop=["<|eot_id|>"]
+                                    stop=["<|eot_id|>"],
+                                    **guided_kwargs
                                 )
     outputs = llm.generate(question_list, sampling_params, use_tqdm=True)   
     completions = [output.outputs[0].text.strip() for output in outputs]
@@ -53,37 +75,10 @@ def make_conv_multiturn(question, history):
                                         chat_template="{% set loop_messages = messages %}{% for message in loop_messages %}{% set content = '<|start_header_id|>' + message['role'] + '<|end_header_id|>\n\n'+ message['content'] | trim + '<|eot_id|>' %}{% if loop.index0 == 0 %}{% set content = bos_token + content %}{% endif %}{{ content }}{% endfor %}{% if add_generation_prompt %}{{ '<|start_header_id|>assistant<|end_header_id|>\n\n' }}{% endif %}")
     return out
 
-def parse_augmented(tool_str):
-    try:
-        pattern = re.compile(r"```json(.*?)```|```(.*?)```", re.DOTALL)
-        matches = re.findall(pattern, tool_str)
-        tool_str = matches[0][0]
-    except Exception as e:
-        pass
-    try:
-        tool_str = tool_str[1:-1]
-        question = tool_str.split("\"question\":")[1].strip()[2:-2].replace("\"", "\'")
-        query = tool_str.split("\"question\":")[0].split("\"augmented query\":")[1].strip()[1:-2].replace("\"", "\'")
-        tool_str = json.dumps({
-            "augmented query": query,
-            "question": [question]
-        })
-    except:
-        pass
-    
-    try:
-        return json.loads(tool_str), tool_str
-    except (json.JSONDecodeError, TypeError):
-        try:
-            return ast.literal_eval(tool_str), tool_str
-        except (ValueError, SyntaxError):
-            return None, None
-
-
 def load_augmented_query(data_path, save_path):
     cnt = 0
     valid = 0
-    data = list(jsonlines.open(data_path, "r"))
+    data = list(iter_jsonl(data_path))
 
     for d in tqdm(data):
         response, new_response = parse_augmented(d["response"])
@@ -99,39 +94,83 @@ def load_augmented_query(data_path, save_path):
             continue
 
 
+def build_record(i, d, response):
+    # round i output record; a response that is missing or rejected keeps the query unchanged
+    if i == 0:
+        original = d["query"]
+        eval_question = []
+    else:
+        original = d["initial query"]
+        eval_question = list(d["eval question"])
+    try:
+        aug_query = response["augmented query"]
+        question = response["question"]
+        if "human evaluator" in aug_query or "provide the response in JSON format" in aug_query or aug_query == d["query"]:
+            raise KeyError
+    except:
+        aug_query = d["query"]
+        question = []
+
+    eval_question.extend(question)
+    return {
+        "query": aug_query,
+        "eval question": eval_question,
+        "initial query": original,
+        "response": response,
+        "history": d.get("history", [])
+    }
+
+
+def repair_round(i, data, dataset, save_path):
+    # regenerate only the records whose output did not parse into AUGMENTED_SCHEMA and rewrite them in place
+    records = list(iter_jsonl(save_path))
+    failed = [idx for idx, record in enumerate(records) if not matches(record["response"], AUGMENTED_SCHEMA)]
+    total = len(failed)
+    for attempt in range(repair_attempts):
+        if len(failed) == 0:
+            break
+        completions = generate_sample_batch([dataset[idx] for idx in failed], temperature=repair_temperature)
+        still = []
+        for idx, completion in zip(failed, completions):
+            response, new_response = parse_augmented(completion)
+            if matches(response, AUGMENTED_SCHEMA):
+                records[idx] = build_record(i, data[idx], response)
+            else:
+                still.append(idx)
+        failed = still
+    print(f"[repair] augment_query round {i}: {total - len(failed)}/{total} failed outputs repaired")
+    if total == len(failed):
+        return
+    with JsonlWriter(save_path, "w") as f:
+        for record in records:
+            f.write(record)
+    record_rewrite(save_path)
+
+
 if __name__ == "__main__":
     cnt = 0
     valid = 0
+    # generate in chunks so an interrupted round resumes from its last finished chunk
+    chunk_size = 10000
     # add up to three constraints
     for i in range(0,3):
-        data = list(jsonlines.open(f"./Sharegpt_augmented_query_sft_constraint_{i}.jsonl", "r"))
+        data_path = f"./Sharegpt_augmented_query_sft_constraint_{i}.jsonl"
+        save_path = f"./Sharegpt_augmented_query_sft_constraint_{i+1}.jsonl"
+        manifest = StageManifest(data_path, save_path, params={"stage": "augment_query", "round": i, "chunk_size": chunk_size})
+        if manifest.finished:
+            continue
+        data = list(iter_jsonl(data_path))
+        parse = ParseStats(f"augment_query round {i}")
         dataset = list(map(lambda d: make_conv_multiturn(d["query"], d["history"]), data))
-        completions = generate_sample_batch(dataset)
-        print(len(completions))
-        with jsonlines.open(f"./Sharegpt_augmented_query_sft_constraint_{i+1}.jsonl", "w") as f: 
-            for d, response in zip(data, completions):
-                response, new_response = parse_augmented(response)
-                if i == 0:
-                    original = d["query"]
-                    eval_question = []
-                else:
-                    original = d["initial query"]
-                    eval_question = d["eval question"]
-                try:
-                    aug_query = response["augmented query"]
-                    question = response["question"]
-                    if "human evaluator" in aug_query or "provide the response in JSON format" in aug_query or aug_query == d["query"]:
-                        raise KeyError
-                except:
-                    aug_query = d["query"]
-                    question = []
-
-                eval_question.extend(question)
-                
-                f.write({
-                    "query": aug_query,
-                    "eval question": eval_question,
-                    "initial query": original,
-                    "response": response,
-                    "history": d.get("history", [])
-                })
\ No newline at end of file
+        with JsonlWriter(save_path, "a") as f:
+            for st in range(manifest.completed, len(data), chunk_size):
+                completions = generate_sample_batch(dataset[st:st+chunk_size])
+                print(len(completions))
+                for d, response in zip(data[st:st+chunk_size], completions):
+                    response, new_response = parse_augmented(response)
+                    parse.add(response, AUGMENTED_SCHEMA)
+                    f.write(build_record(i, d, response))
+                manifest.checkpoint(min(st + chunk_size, len(data)), [f])
+            manifest.finish([f])
+        parse.report()
+        repair_round(i, data, dataset, save_path)
@@ -22,7 +22,32 @@ import yaml
 import asyncio
 import ast
 import argparse
+import sys
+import math
+import hashlib
+from collections import defaultdict
+from itertools import islice
+from contextlib import ExitStack
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.json_extract import parse_tool, parse_augmented
+from utils.jsonl_io import JsonlWriter, iter_jsonl
+from utils.stream_join import CustomIdReader, get_body, get_contents, body_content, body_contents
+from utils.online_client import OpenAIClient, AsyncOpenAIClient, to_batch_output
+from utils.completion_cache import cached_output_path
+from utils.request_ids import make_custom_id
+from utils.manifest import StageManifest
+from utils.verifiers import split_questions
+from utils.schemas import AUGMENTED_SCHEMA, ParseStats, verdict_schema, guided_json, guided_lines
+from utils.scheduler import Chunk, ShardScheduler, progress
+from utils.request_writer import RequestWriter
+
+# stages record a resume checkpoint every `checkpoint_every` input records
+checkpoint_every = 1000
+
+# judge outputs the parsers could not read or that do not match verdict_schema, reported by the stage reading them
+judge_parse = ParseStats("judge")
+escalate_parse = ParseStats("escalated judge")
 
 
 evaluate_prompt = """You are an expert that is good at judging whether the response to a given query meets the specified evaluator questions.
@@ -48,322 +73,1158 @@ You should only respond in the following JSON format:
 ```
 """.strip()
 
+evaluate_multi_prompt = """You are an expert that is good at judging whether responses to a given query meet the specified evaluator questions.
+Your task is to carefully examine each response on its own to determine if it adheres to each requirement outlined in the evaluator questions.
 
-def parse_tool(tool_str):
-    try:
-        pattern = re.compile(r"(\{.*\})", re.DOTALL)
-        matches = re.findall(pattern, tool_str)
-        tool_str = matches[0]
-    except Exception as e:
-        pass
-    if tool_str[0] == "[" and tool_str[-1] == "]":
-        tool_str = "{" + tool_str[1:-1] + "}"
-    try:
-        return json.loads(tool_str)
-    except:
-        try:
-            return ast.literal_eval(tool_str)
-        except Exception as e:
-            # print(tool_str, e)
-            return None
+[Query] {query}
+[Evaluator Question] {question}
+{responses}For each response and each question, please provide a justification for your evaluation, explaining how the response does or does not satisfy the criteria and a score ('YES' or 'NO') indicating whether the answer satisfies each constraint.
+You should only respond in the following JSON format, with one entry for every response:
+```json
+{{
+    "Response 1": {{
+        "Question 1": {{
+            "explanation": "",
+            "score": "YES" or "NO"
+        }},
+        "Question 2": {{
+            "explanation": "",
+            "score": "YES" or "NO"
+        }},
+    }},
+    "Response 2": {{
+        ...
+    }},
+}}
+```
+""".strip()
 
-def parse_augmented(tool_str):
-    try:
-        pattern = re.compile(r"```json(.*?)```|```(.*?)```", re.DOTALL)
-        matches = re.findall(pattern, tool_str)
-        tool_str = matches[0][0]
-    except Exception as e:
-        pass
-    try:
-        tool_str = tool_str[1:-1]
-        question = tool_str.split("\"question\":")[1].strip()[2:-2].replace("\"", "\'")
-        query = tool_str.split("\"question\":")[0].split("\"augmented query\":")[1].strip()[1:-2].replace("\"", "\'")
-        tool_str = json.dumps({
-            "augmented query": query,
-            "question": [question]
-        })
-    except:
-        pass
-    
-    try:
-        return json.loads(tool_str), tool_str
-    except (json.JSONDecodeError, TypeError):
-        try:
-            return ast.literal_eval(tool_str), tool_str
-        except (ValueError, SyntaxError):
-            return None, None
 
+evaluate_score_prompt = """You are an expert that is good at judging whether the response to a given query meets the specified evaluator questions.
+Your task is to carefully examine the response to determine if it adheres to each requirement outlined in the evaluator questions.
+
+[Query] {query}
+[Response] {response}
+[Evaluator Question] {question}
+
+For each question, answer 'YES' if the response satisfies the constraint and 'NO' otherwise.
+Do not explain. You should only respond with one line per question in the following format:
+{lines}""".strip()
+
+evaluate_multi_score_prompt = """You are an expert that is good at judging whether responses to a given query meet the specified evaluator questions.
+Your task is to carefully examine each response on its own to determine if it adheres to each requirement outlined in the evaluator questions.
 
-def load_augmented_query(data_path, save_path):
+[Query] {query}
+[Evaluator Question] {question}
+{responses}For each response and each question, answer 'YES' if the response satisfies the constraint and 'NO' otherwise.
+Do not explain. You should only respond with one line per response and question in the following format:
+{lines}""".strip()
+
+
+def load_augmented_query(data_path, save_path, resume=True):
     cnt = 0
     valid = 0
-    data = list(jsonlines.open(data_path, "r"))
-    for d in tqdm(data):
-        response, new_response = parse_augmented(d["response"])
-        try:
-            original = d["query"]
-            aug_query = response["augmented query"]
-            question = response["question"]
-            if "human evaluator" in aug_query or "provide the response in JSON format" in aug_query:
-                valid += 1
+    manifest = StageManifest(data_path, save_path, params={"stage": "load_augmented_query"}, resume=resume)
+    parse = ParseStats("augment_query")
+    pos = -1
+    with JsonlWriter(save_path, "a") as f:
+        for pos, d in enumerate(tqdm(iter_jsonl(data_path))):
+            if pos < manifest.completed:
                 continue
-            with jsonlines.open(save_path, "a") as f:
+            if pos - manifest.completed >= checkpoint_every:
+                manifest.checkpoint(pos, [f])
+            response, new_response = parse_augmented(d["response"])
+            parse.add(response, AUGMENTED_SCHEMA)
+            try:
+                original = d["query"]
+                aug_query = response["augmented query"]
+                question = response["question"]
+                if "human evaluator" in aug_query or "provide the response in JSON format" in aug_query:
+                    valid += 1
+                    continue
                 f.write({
                     "query": aug_query,
                     "eval question": question,
                     "initial query": original,
                 })
-        except Exception as e:
-            cnt += 1
-            continue
+            except Exception as e:
+                cnt += 1
+                continue
+        manifest.checkpoint(pos + 1, [f])
+        manifest.finish([f])
+    parse.report()
 
 
-def run_resampling_data(data_path, save_path, index=None):
-    sft_data = list(jsonlines.open(data_path, "r"))
-    cnt = 0
-    request_list = []
+resample_system_prompt = "You are an expert tasked with answering the given query. Please provide a clear and concise response directly, without introductory phrases such as 'What a great question,' 'Here is the answer,' or similar expressions. Focus solely on addressing the query."
+
+resample_params = {
+    "model": "meta-llama/Llama-3.1-8B-Instruct",
+    "max_tokens": 4096,
+    "temperature": 1.0,
+    "top_p": 0.95,
+    "stop": ["<|eot_id|>", "<|end_of_text|>"],
+}
+
+evaluate_params = {
+    "model": "meta-llama/Llama-3.1-8B-Instruct",
+    "max_tokens": 4096,
+    "temperature": 0,
+    "top_p": 1.0,
+}
+
+# context window of the judge server (vllm --max-model-len); multi-response judge prompts are split to fit
+judge_context_tokens = 8192
+
+# large judge of the cascade (see run_escalation_data), the model extract_constraint.py runs on
+escalate_params = {
+    **evaluate_params,
+    "model": "meta-llama/Meta-Llama-3.1-70B-Instruct",
+}
+
+# score-only judging: one YES/NO token per question, read back with its logprobs
+evaluate_score_params = {
+    **evaluate_params,
+    "logprobs": True,
+    "top_logprobs": 5,
+}
+
+
+def build_resample_messages(data):
+    # None for records with a dangling user turn in the history, which every stage skips
+    query = data["query"]
+    history = data.get("history", [])
+    if len(history) % 2 != 0:
+        return None
+    prompt = f"Now please answer the given query while stritly following its inside constraints.\n[Query] {query}"
+    message = [{"role": "system", "content": resample_system_prompt}]
+    for idx in range(0, len(history), 2):
+        message.extend([{"role": "user", "content": history[idx]["value"]}, {"role": "assistant", "content": history[idx+1]["value"]}])
+    message.append({"role": "user", "content": prompt})
+    return message
+
+
+def build_evaluate_messages(data, response, question=None):
+    # `question` restricts the prompt to a subset of the eval questions, renumbered from 1
+    question = data["eval question"] if question is None else question
+    temp = ""
+    for i in range(1, len(question)+1):
+        temp += "{}. {}\n".format(i, question[i-1])
+    prompt = evaluate_prompt.format(query=data["query"], response=response, question=temp)
+    return [{"role": "user", "content": prompt}]
+
+
+def build_evaluate_multi_messages(data, responses, question=None, score_only=False):
+    # one prompt for several responses to the same query: query and questions appear once
+    question = data["eval question"] if question is None else question
+    temp = ""
+    for i in range(1, len(question)+1):
+        temp += "{}. {}\n".format(i, question[i-1])
+    block = ""
+    for r in range(1, len(responses)+1):
+        block += "[Response {}] {}\n\n".format(r, responses[r-1])
+    if score_only:
+        lines = "".join("Response {} Question {}: YES or NO\n".format(r, i) for r in range(1, len(responses)+1) for i in range(1, len(question)+1))
+        prompt = evaluate_multi_score_prompt.format(query=data["query"], question=temp, responses=block, lines=lines)
+    else:
+        prompt = evaluate_multi_prompt.format(query=data["query"], question=temp, responses=block)
+    return [{"role": "user", "content": prompt}]
+
+
+def build_evaluate_score_messages(data, response, question=None):
+    question = data["eval question"] if question is None else question
+    temp = ""
+    for i in range(1, len(question)+1):
+        temp += "{}. {}\n".format(i, question[i-1])
+    lines = "".join("Question {}: YES or NO\n".format(i) for i in range(1, len(question)+1))
+    prompt = evaluate_score_prompt.format(query=data["query"], response=response, question=temp, lines=lines)
+    return [{"role": "user", "content": prompt}]
+
+
+def shard_range(index):
     if index == None:
-        st = 0
-        ed = len(sft_data)
+        return 0, None
+    if isinstance(index, Chunk):
+        return index.start, index.end
+    return 10000 * index, 10000 * (index + 1)
+
+
+def iter_shard(data_path, index):
+    # -> (pos, data) of the shard; a scheduler chunk seeks straight to its first record and reports
+    # every record as progress of its lease
+    st, ed = shard_range(index)
+    if isinstance(index, Chunk):
+        for pos, data in enumerate(islice(iter_jsonl(data_path, offset=index.offset), ed - st), start=st):
+            progress(index)
+            yield pos, data
+        return
+    yield from enumerate(islice(iter_jsonl(data_path), st, ed), start=st)
+
+
+def run_resampling_data(data_path, save_path, index=None, n_sampling=False, resume=True, compact=False):
+    # n_sampling=True writes one request per query with `n` = k instead of k copies of the prompt
+    # a save_path ending in .zst is zstd-compressed; compact=True stores shared messages once
+    # (utils/request_writer.py expands the file before upload)
+    k = 5
+    st, ed = shard_range(index)
+    manifest = StageManifest(data_path, save_path, params={"stage": "resampling", "index": index, "n_sampling": n_sampling, "k": k, "compact": compact}, resume=resume)
+    seen = set()
+    pos = st
+    with manifest.open(save_path) as fout:
+        f = RequestWriter(fout, compact)
+        for pos, data in tqdm(iter_shard(data_path, index)):
+            message = build_resample_messages(data)
+            custom_id = make_custom_id(data)
+            if message is None or custom_id in seen:
+                continue
+            seen.add(custom_id)
+            # records before the checkpoint only rebuild the dedup set
+            if pos < manifest.completed:
+                continue
+            if pos - manifest.completed >= checkpoint_every:
+                manifest.checkpoint(pos, [fout], start=st)
+
+            if n_sampling:
+                f.write({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {"messages": message, **resample_params, "n": k},
+                })
+                continue
+            for i in range(k):
+                f.write({
+                    "custom_id": f"{custom_id}-{i}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {"messages": message, **resample_params},
+                })
+        manifest.checkpoint(max(pos + 1, manifest.completed), [fout], start=st)
+        manifest.finish([fout])
+    if compact:
+        print(f"{f.requests} requests, {f.shared} messages written as references")
+
+def take_samples(response_reader, data, k, n_sampling=False):
+    # -> [(custom_id, response)] for one query; judge requests reuse the sample's custom_id
+    # per-sample requests: request-{hash}-{i} for each of the k samples
+    # n_sampling requests: one request-{hash} per query whose choices fan out to request-{hash}-{i}
+    custom_id = make_custom_id(data)
+    samples = []
+    if n_sampling:
+        contents = response_reader.take_contents(custom_id)
+        for i in range(k):
+            samples.append((f"{custom_id}-{i}", contents[i] if i < len(contents) else None))
+        return samples
+    for i in range(k):
+        contents = response_reader.take_contents(f"{custom_id}-{i}")
+        samples.append((f"{custom_id}-{i}", contents[0] if contents else None))
+    return samples
+
+
+def split_local(data, response, rule_verify=False):
+    # -> ({question index: verdict} decided by utils.verifiers, [question indices left for the judge])
+    questions = data["eval question"]
+    if not rule_verify:
+        return {}, list(range(len(questions)))
+    return split_questions(questions, response)
+
+
+# rule verdicts never fall below the escalation threshold; the cascade samples them for calibration like
+# confident judge verdicts (see escalation_indices)
+rule_confidence = 1.0
+
+
+def combine_verdicts(decided, remaining, eval):
+    # judge output for the remaining questions (numbered from 1) + local verdicts -> verdict in the original numbering
+    if remaining and not isinstance(eval, dict):
+        return None
+    verdict = {}
+    for i, flag in decided.items():
+        verdict[f"Question {i+1}"] = {"explanation": "rule-based check", "score": "YES" if flag else "NO", "confidence": rule_confidence}
+    for j, i in enumerate(remaining):
+        if f"Question {j+1}" in eval:
+            verdict[f"Question {i+1}"] = eval[f"Question {j+1}"]
+    return verdict
+
+
+def estimate_judge_tokens(messages, num_verdicts, score_only=False):
+    # rough prefill (4 chars per token) + decoded tokens per verdict: ~60 with an explanation, ~8 for a score line
+    return len(messages[0]["content"]) // 4 + (8 if score_only else 60) * num_verdicts
+
+
+def build_judge_messages(data, group, indices, score_only=False):
+    # a group of one keeps the per-response prompt, so its output has the same shape as without multi_judge
+    question = [data["eval question"][i] for i in indices]
+    if len(group) > 1:
+        return build_evaluate_multi_messages(data, [response for _, response in group], question, score_only)
+    if score_only:
+        return build_evaluate_score_messages(data, group[0][1], question)
+    return build_evaluate_messages(data, group[0][1], question)
+
+
+def build_judge_body(data, group, indices, score_only=False):
+    messages = build_judge_messages(data, group, indices, score_only)
+    if not score_only:
+        return {"messages": messages, **evaluate_params, **guided_json(verdict_schema(len(indices), len(group)))}
+    if len(group) == 1:
+        labels = [f"Question {i}" for i in range(1, len(indices)+1)]
     else:
-        st = 10000 * index
-        ed = min(len(sft_data), 10000 * (index + 1))
-
-    for data in tqdm(sft_data[st:ed]):
-        k = 5
-        query = data["query"]
-        question = data["eval question"]
-        history = data.get("history", [])
-        
-        system_prompt = "You are an expert tasked with answering the given query. Please provide a clear and concise response directly, without introductory phrases such as 'What a great question,' 'Here is the answer,' or similar expressions. Focus solely on addressing the query."
-        prompt = f"Now please answer the given query while stritly following its inside constraints.\n[Query] {query}"
-        if len(history) == 0:
-            messages = [[{"role": "system", "content": system_prompt} ,{"role": "user", "content": prompt}]] * k
+        labels = [f"Response {r} Question {i}" for r in range(1, len(group)+1) for i in range(1, len(indices)+1)]
+    return {"messages": messages, **evaluate_score_params, "max_tokens": 8 * len(indices) * len(group) + 16, **guided_lines(labels)}
+
+
+def sampled(key, fraction):
+    # deterministic per key, so every stage picks the same records for audits and calibration
+    if fraction <= 0:
+        return False
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) < fraction * 16 ** 8
+
+
+def pack_responses(data, samples, indices):
+    # greedily groups consecutive responses into prompts whose prefill + expected verdicts fit the
+    # judge's context window and max_tokens; a response that fits with no other is judged alone
+    groups, group = [], []
+    for sample in samples:
+        candidate = group + [sample]
+        verdicts = len(indices) * len(candidate)
+        tokens = estimate_judge_tokens(build_judge_messages(data, candidate, indices), verdicts)
+        if group and (tokens > judge_context_tokens or 60 * verdicts > evaluate_params["max_tokens"]):
+            groups.append(group)
+            group = [sample]
         else:
-            if len(history) % 2 != 0:
-                continue
-            message = [{"role": "system", "content": system_prompt}]
-            for idx in range(0, len(history), 2):
-                message.extend([{"role": "user", "content": history[idx]["value"]}, {"role": "assistant", "content": history[idx+1]["value"]}])
-            message.append({"role": "user", "content": prompt})
-
-            messages = [message] * k
-
-        for message in messages:
-            cnt += 1
-            request_list.append({
-                "custom_id": f"request-{cnt}",
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": "meta-llama/Llama-3.1-8B-Instruct",
-                    "messages": message,
-                    "max_tokens": 4096,
-                    "temperature": 1.0,
-                    "top_p": 0.95,
-                    "stop": ["<|eot_id|>", "<|end_of_text|>"],
-                },
-                
-            })
-    with jsonlines.open(save_path, "w") as f:
-        for r in request_list:
-            f.write(r)
-
-def run_reevaluation_data(data_path, result_path, save_path, index=None):
-    sft_data = list(jsonlines.open(data_path, "r"))
-    resample_results = list(jsonlines.open(result_path))
-    print(len(sft_data))
-    print(len(resample_results))
-    map = {}
-    for res in resample_results:
-        map[res["custom_id"]] = res
-    cnt = 0
-    k = 5
-    request_list = []
-    if index == None:
-        st = 0
-        ed = len(sft_data)
+            group = candidate
+    if group:
+        groups.append(group)
+    return groups
+
+
+def plan_judging(data, samples, rule_verify=False, multi_judge=False, score_only=False, audit_fraction=0.0):
+    # samples: [(custom_id, response)] of one query
+    # -> ({custom_id: {question index: local verdict}},
+    #     [(judge custom_id, [(custom_id, response)], question indices, score_only)])
+    # the plan only depends on the responses and the flags, so the merge rebuilds it to find the judge outputs
+    decided, requests = {}, []
+    if not multi_judge:
+        for custom_id, response in samples:
+            decided[custom_id], remaining = split_local(data, response, rule_verify)
+            if remaining:
+                requests.append((custom_id, [(custom_id, response)], remaining, score_only))
     else:
-        st = 10000 * index
-        ed = min(len(sft_data), 10000 * (index + 1))
-    
-    for data in tqdm(sft_data[st:ed]):
-        query = data["query"]
-        question = data["eval question"]
-        history = data.get("history", [])
-
-        if len(history) % 2 != 0:
-            continue
-        
-        temp = ""
-        for i in range(1, len(question)+1):
-            temp += "{}. {}\n".format(i, question[i-1])
-        for i in range(k):
-            cnt += 1
-            custom_id = "request-" + str(cnt)
-            response = map[custom_id]["response"]['body']["choices"][0]["message"]["content"]
-            prompt = evaluate_prompt.format(query=query, response=response, question=temp)
-            message = [{"role": "user", "content": prompt}]
-            request_list.append({
-                "custom_id": f"request-{cnt}",
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": "meta-llama/Llama-3.1-8B-Instruct",
-                    "messages": message,
-                    "max_tokens": 4096,
-                    "temperature": 0,
-                    "top_p": 1.0,
+        # one judge call per group of responses; a question still open for any response is asked for all of them
+        splits = {custom_id: split_local(data, response, rule_verify) for custom_id, response in samples}
+        indices = sorted(set(i for _, remaining in splits.values() for i in remaining))
+        for custom_id, (local, _) in splits.items():
+            decided[custom_id] = {i: flag for i, flag in local.items() if i not in indices}
+        if indices:
+            for group in pack_responses(data, samples, indices):
+                judge_id = group[0][0] if len(group) == 1 else f"{group[0][0]}-x{len(group)}"
+                requests.append((judge_id, group, indices, score_only))
+    # audited queries are judged a second time with explanations; that verdict is the one kept
+    if score_only and sampled(make_custom_id(data), audit_fraction):
+        requests += [(f"{judge_id}-audit", group, indices, False) for judge_id, group, indices, _ in requests]
+    return decided, requests
+
+
+def split_matrix(eval, size):
+    # {"Response r": {"Question q": ...}} -> verdict of each response, None for missing rows
+    if size == 1:
+        return [eval]
+    if not isinstance(eval, dict):
+        return [None] * size
+    return [eval.get(f"Response {r}") for r in range(1, size+1)]
+
+
+_score_line = re.compile(r"(?:Response\W*(\d+)\W*)?Question\W*(\d+)\W*(YES|NO)\b", re.IGNORECASE)
+_score_label = re.compile(r"(?:Response\W*(\d+)\W*)?Question\W*(\d+)\W*$", re.IGNORECASE)
+
+
+def _set_score(verdict, match, score, confidence=None):
+    response, question = match.group(1), match.group(2)
+    row = verdict.setdefault(f"Response {response}", {}) if response else verdict
+    row.setdefault(f"Question {question}", {})["score"] = score
+    if confidence is not None:
+        row[f"Question {question}"]["confidence"] = confidence
+
+
+def parse_scores(body):
+    # score-only judge output -> {"Question q": {"score", "confidence"}}, nested under "Response r"
+    # for multi-response prompts; confidence is the probability of the chosen verdict among
+    # YES / NO in the top logprobs of its token (missing when the server returned no logprobs);
+    # without top logprobs it is the probability of the chosen token itself
+    try:
+        choice = body["choices"][0]
+        content = choice["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    verdict = {}
+    for line in content.splitlines():
+        match = _score_line.search(line)
+        if match:
+            _set_score(verdict, match, match.group(3).upper())
+    line = ""
+    for token in ((choice.get("logprobs") or {}).get("content") or []):
+        word = token["token"].strip().upper()
+        match = _score_label.search(line)
+        if word in ("YES", "NO") and match:
+            prob = {"YES": 0.0, "NO": 0.0}
+            own = token.get("logprob")
+            tops = [top for top in token.get("top_logprobs") or [] if top.get("logprob") is not None]
+            for top in tops:
+                if top["token"].strip().upper() in prob:
+                    prob[top["token"].strip().upper()] += math.exp(top["logprob"])
+            # a sampled token is not always among the top logprobs
+            if own is not None and not any(top["token"] == token["token"] for top in tops):
+                prob[word] += math.exp(own)
+            total = prob["YES"] + prob["NO"] if tops else float(own is not None)
+            _set_score(verdict, match, word, round(prob[word] / total, 4) if total else None)
+        line = (line + token["token"]).rsplit("\n", 1)[-1]
+    return verdict if verdict else None
+
+
+def parse_judge(body, score_only=False):
+    if score_only:
+        return parse_scores(body)
+    try:
+        return parse_tool(body_content(body))
+    except:
+        return None
+
+
+def verdict_confidence(eval):
+    # lowest verdict confidence of a judged response; a score-only verdict without one (the server returned no
+    # logprobs) counts as 0.0, verdicts with an explanation (full judge, audits) carry none and count as 1.0
+    if not isinstance(eval, dict):
+        return 1.0
+    return min([value.get("confidence", 1.0 if "explanation" in value else 0.0) for value in eval.values() if isinstance(value, dict)] + [1.0])
+
+
+def collect_verdicts(data, decided, requests, outputs, audit=None):
+    # outputs: {judge custom_id: completion body} -> {custom_id: verdict in the original question numbering}
+    # audit, if given, counts how often the score-only verdict of a response agrees with its explanation audit
+    verdicts = {custom_id: combine_verdicts(local, [], None) for custom_id, local in decided.items()}
+    for judge_id, group, indices, score_only in requests:
+        eval = parse_judge(outputs.get(judge_id), score_only)
+        judge_parse.add(eval, verdict_schema(len(indices), len(group), not score_only))
+        for (custom_id, _), row in zip(group, split_matrix(eval, len(group))):
+            if decided[custom_id] or len(indices) < len(data["eval question"]):
+                row = combine_verdicts(decided[custom_id], indices, row)
+            if audit is not None and judge_id.endswith("-audit"):
+                flag, score_flag = judge_passed(row, len(data["eval question"])), judge_passed(verdicts[custom_id], len(data["eval question"]))
+                if flag is not None and score_flag is not None:
+                    audit["audited"] += 1
+                    audit["agreed"] += flag == score_flag
+            verdicts[custom_id] = row
+    return verdicts
+
+
+def read_verdicts(data, responses, evaluate_reader, audit=None, rule_verify=False, multi_judge=False, score_only=False, audit_fraction=0.0):
+    # judge plan of one query + its judge outputs -> (decided, requests, outputs, {custom_id: verdict})
+    decided, requests = plan_judging(data, responses, rule_verify, multi_judge, score_only, audit_fraction)
+    outputs = {judge_id: get_body(evaluate_reader.take(judge_id)) for judge_id, _, _, _ in requests}
+    return decided, requests, outputs, collect_verdicts(data, decided, requests, outputs, audit)
+
+
+def judge_indices(requests):
+    # custom_id -> question indices its judge request asked about
+    return {custom_id: indices for _, group, indices, _ in requests for custom_id, _ in group}
+
+
+def escalation_reason(data, custom_id, verdict, threshold, calibrate_fraction=0.0):
+    # "low" for verdicts the large judge has to redo (unparsed, cut off or below the confidence threshold),
+    # "calibration" for a sampled fraction of the confident ones, None otherwise
+    if judge_passed(verdict, len(data["eval question"])) is None or verdict_confidence(verdict) < threshold:
+        return "low"
+    if sampled(custom_id, calibrate_fraction):
+        return "calibration"
+    return None
+
+
+def escalation_indices(data, indices, custom_id):
+    # questions the large judge redoes: the ones the small judge answered, every question of a response
+    # the rules decided alone (those only get escalated for calibration)
+    return indices.get(custom_id) or list(range(len(data["eval question"])))
+
+
+def check_cascade(score_only):
+    # escalation reads the confidence of score-only verdicts; verdicts with an explanation have none
+    if not score_only:
+        raise ValueError("the judge cascade escalates on score-only confidences, run the small judge with score_only=True")
+
+
+def build_escalate_body(data, response, indices):
+    return {"messages": build_judge_messages(data, [(None, response)], indices), **escalate_params,
+            **guided_json(verdict_schema(len(indices)))}
+
+
+def escalated_verdict(data, decided, indices, body):
+    # large judge output of one response -> verdict in the original question numbering
+    eval = parse_judge(body)
+    escalate_parse.add(eval, verdict_schema(len(indices)))
+    if decided or len(indices) < len(data["eval question"]):
+        eval = combine_verdicts(decided, indices, eval)
+    return eval
+
+
+def usage_tokens(body):
+    try:
+        return body["usage"]["total_tokens"]
+    except (KeyError, TypeError):
+        return 0
+
+
+def run_reevaluation_data(data_path, result_path, save_path, index=None, n_sampling=False, cache=None, resume=True, compact=False, rule_verify=False, multi_judge=False,
+                          score_only=False, audit_fraction=0.0):
+    # with a CompletionCache, judge requests seen before are answered into the _cached_output.jsonl
+    # file next to save_path and only the misses are written to save_path
+    # with rule_verify, questions utils.verifiers can decide are answered locally and left out of the
+    # judge prompt; with multi_judge the k responses of a query share one judge prompt (split to fit
+    # judge_context_tokens); with score_only the judge answers one YES/NO per question and the merge reads
+    # its logprobs, except for an audit_fraction of queries that are also judged with explanations;
+    # pass the same flags to the merge so it rebuilds the same judge requests
+    # save_path / compact: as in run_resampling_data
+    k = 5
+    st, ed = shard_range(index)
+    save_paths = [save_path] + ([cached_output_path(save_path)] if cache is not None else [])
+    manifest = StageManifest([data_path] + ([result_path] if isinstance(result_path, str) else list(result_path)), save_paths,
+                             params={"stage": "reevaluation", "index": index, "n_sampling": n_sampling, "k": k, "rule_verify": rule_verify,
+                                     "multi_judge": multi_judge, "judge_context_tokens": judge_context_tokens,
+                                     "score_only": score_only, "audit_fraction": audit_fraction, "compact": compact}, resume=resume)
+    response_reader = CustomIdReader(result_path)
+    seen = set()
+    written = 0
+    local_questions, total_questions, responses = 0, 0, 0
+    full_tokens, judge_tokens = 0, 0
+    pos = st
+    files = [manifest.open(path) for path in save_paths]
+    f = RequestWriter(files[0], compact)
+    cached_f = jsonlines.Writer(files[-1])
+    try:
+        for pos, data in tqdm(iter_shard(data_path, index)):
+            history = data.get("history", [])
+            if len(history) % 2 != 0 or make_custom_id(data) in seen:
+                continue
+            seen.add(make_custom_id(data))
+            if pos < manifest.completed:
+                continue
+            if pos - manifest.completed >= checkpoint_every:
+                manifest.checkpoint(pos, files, start=st)
+            
+            samples = [(custom_id, response) for custom_id, response in take_samples(response_reader, data, k, n_sampling) if response is not None]
+            decided, requests = plan_judging(data, samples, rule_verify, multi_judge, score_only, audit_fraction)
+            if rule_verify or multi_judge or score_only:
+                # savings against one full judge prompt per response
+                responses += len(samples)
+                num_questions = len(data["eval question"])
+                for custom_id, response in samples:
+                    local_questions += len(decided[custom_id])
+                    total_questions += num_questions
+                    if num_questions:
+                        full_tokens += estimate_judge_tokens(build_evaluate_messages(data, response), num_questions)
+            for judge_id, group, indices, score in requests:
+                body = build_judge_body(data, group, indices, score)
+                if rule_verify or multi_judge or score_only:
+                    judge_tokens += estimate_judge_tokens(body["messages"], len(indices) * len(group), score)
+                request = {
+                    "custom_id": judge_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body
                 }
-            })
-    print(len(request_list))
-    with jsonlines.open(save_path, "w") as f:
-        for r in request_list:
-            f.write(r)
-
-
-def merge_query_with_response(data_path, response_path, evaluate_path, save_path, index=None):
-    sft_data = list(jsonlines.open(data_path, "r"))
-    resample_results = list(jsonlines.open(response_path))
-    evaluate_results = list(jsonlines.open(evaluate_path))
-    print(len(sft_data), len(resample_results), len(evaluate_results))
-    response_map = {}
-    evaluate_map = {}
-    for res in resample_results:
-        response_map[res["custom_id"]] = res
-    for res in evaluate_results:
-        evaluate_map[res["custom_id"]] = res
-    cnt = 0
-    error = 0
-    inputs = []
-    not_satisfied = []
-    if index == None:
-        st = 0
-        ed = len(sft_data)
-    else:
-        st = 10000 * index
-        ed = min(len(sft_data), 10000 * (index + 1))
-    
+                cached = cache.get(request["body"]) if cache is not None else None
+                if cached is not None:
+                    cached_f.write(to_batch_output(judge_id, body=cached))
+                else:
+                    f.write(request)
+                written += 1
+        manifest.checkpoint(max(pos + 1, manifest.completed), files, start=st)
+        manifest.finish(files)
+    finally:
+        for fout in files:
+            fout.close()
+    response_reader.close()
+    print(written, "missing responses:", response_reader.missing)
+    if rule_verify:
+        print(f"[rules] {local_questions}/{total_questions} questions decided locally")
+    if rule_verify or multi_judge or score_only:
+        print(f"[judge] {responses} responses in {written} judge calls, "
+              f"~{full_tokens - judge_tokens} of ~{full_tokens} judge tokens saved ({(full_tokens - judge_tokens) / max(full_tokens, 1):.1%})")
+    if cache is not None:
+        cache.report("reevaluation")
+
+
+def run_escalation_data(data_path, result_path, evaluate_path, save_path, index=None, n_sampling=False, threshold=0.9, calibrate_fraction=0.0,
+                        cache=None, resume=True, **judge_options):
+    # cascade, last tier: after run_reevaluation_data (rule checks + small judge, usually score_only=True)
+    # has been run, writes large-judge requests for the responses whose small-judge verdict is missing or
+    # below `threshold`, plus a calibrate_fraction of the confident ones to measure agreement above it;
+    # judge_options are the flags the small-judge requests were written with; pass the same arguments
+    # and escalate_path to the merge
+    check_cascade(judge_options.get("score_only", False))
     k = 5
-    print(k)
-    for data in tqdm(sft_data[st:ed]):
-        history = data.get("history", [])
-        if len(history) % 2 != 0:
-            continue
+    st, ed = shard_range(index)
+    save_paths = [save_path] + ([cached_output_path(save_path)] if cache is not None else [])
+    input_paths = [data_path]
+    for path in (result_path, evaluate_path):
+        input_paths.extend([path] if isinstance(path, str) else [p for p in path if os.path.exists(p)])
+    manifest = StageManifest(input_paths, save_paths, params={"stage": "escalation", "index": index, "n_sampling": n_sampling, "k": k, "threshold": threshold,
+                                                             "calibrate_fraction": calibrate_fraction, "judge_context_tokens": judge_context_tokens,
+                                                             **judge_options}, resume=resume)
+    response_reader = CustomIdReader(result_path)
+    evaluate_reader = CustomIdReader(evaluate_path)
+    seen = set()
+    judged, reasons = 0, {"low": 0, "calibration": 0}
+    pos = st
+    files = [manifest.open(path) for path in save_paths]
+    f = jsonlines.Writer(files[0])
+    cached_f = jsonlines.Writer(files[-1])
+    try:
+        for pos, data in tqdm(iter_shard(data_path, index)):
+            history = data.get("history", [])
+            if len(history) % 2 != 0 or make_custom_id(data) in seen:
+                continue
+            seen.add(make_custom_id(data))
+            if pos < manifest.completed:
+                continue
+            if pos - manifest.completed >= checkpoint_every:
+                manifest.checkpoint(pos, files, start=st)
+
+            responses = [(custom_id, response) for custom_id, response in take_samples(response_reader, data, k, n_sampling) if response is not None]
+            decided, requests, _, verdicts = read_verdicts(data, responses, evaluate_reader, **judge_options)
+            indices = judge_indices(requests)
+            for custom_id, response in responses:
+                judged += 1
+                reason = escalation_reason(data, custom_id, verdicts[custom_id], threshold, calibrate_fraction)
+                if reason is None:
+                    continue
+                reasons[reason] += 1
+                request = {
+                    "custom_id": f"{custom_id}-escalate",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": build_escalate_body(data, response, escalation_indices(data, indices, custom_id))
+                }
+                cached = cache.get(request["body"]) if cache is not None else None
+                if cached is not None:
+                    cached_f.write(to_batch_output(request["custom_id"], body=cached))
+                else:
+                    f.write(request)
+        manifest.checkpoint(max(pos + 1, manifest.completed), files, start=st)
+        manifest.finish(files)
+    finally:
+        for fout in files:
+            fout.close()
+    response_reader.close()
+    evaluate_reader.close()
+    judge_parse.report()
+    print(f"[cascade] {reasons['low'] + reasons['calibration']} of {judged} responses escalated: "
+          f"{reasons['low']} missing or below confidence {threshold}, {reasons['calibration']} for calibration")
+    if cache is not None:
+        cache.report("escalation")
+
+
+def new_cascade_stats():
+    return {"responses": 0, "questions": 0, "rule questions": 0, "rules only": 0, "small calls": 0, "small tokens": 0,
+            "kept": 0, "low": 0, "calibration": 0, "large tokens": 0, "compared": 0, "agreed": 0,
+            "rule compared": 0, "rule agreed": 0, "bins": {}}
 
-        satisfied = False
-        for i in range(k):
-            cnt += 1
-            custom_id = "request-" + str(cnt)
-            response = response_map[custom_id]["response"]['body']["choices"][0]["message"]["content"]
-            try:
-                eval = evaluate_map[custom_id]["response"]['body']["choices"][0]["message"]["content"]
-                eval = parse_tool(eval)
-            except:
-                eval = None
-            flag = True
-            
-            try:
-                for key, value in eval.items():
-                    if "Question" in key and ("score" not in value or value["score"].lower() == "no"):
-                        flag = False
-                        break
-            except:
-                flag = False
-                error += 1
 
-            if flag:
-                item = {
+def report_cascade(stats, threshold):
+    # per tier: what it decided, what it cost, and how the small judge agrees with the large one by confidence
+    print(f"[cascade] rules: {stats['rule questions']}/{stats['questions']} questions, {stats['rules only']}/{stats['responses']} responses decided without a judge, "
+          f"the large judge agrees on {stats['rule agreed']}/{stats['rule compared']} sampled")
+    print(f"[cascade] small judge: {stats['small calls']} calls, {stats['small tokens']} tokens, {stats['kept']} responses kept at confidence >= {threshold}")
+    print(f"[cascade] large judge: {stats['low'] + stats['calibration']} calls ({stats['low']} escalated, {stats['calibration']} calibration), "
+          f"{stats['large tokens']} tokens, agrees with the small judge on {stats['agreed']}/{stats['compared']}")
+    for low in sorted(stats["bins"]):
+        agreed, compared = stats["bins"][low]
+        print(f"    small-judge confidence {low:.1f}-{low + 0.1:.1f}: {agreed}/{compared} agree ({agreed / compared:.1%})")
+
+
+def judge_passed(eval, num_questions=None):
+    # True / False for a parsed judge output, None when it could not be parsed, a score is not YES / NO
+    # (a verdict cut off at "N") or (given num_questions) it was cut off before every question got a score
+    if not isinstance(eval, dict):
+        return None
+    scores = [value.get("score") if isinstance(value, dict) else None for key, value in eval.items() if "Question" in key]
+    if num_questions is not None and len(scores) < num_questions:
+        return None
+    scores = [score.strip().upper() if isinstance(score, str) else None for score in scores]
+    if any(score not in ("YES", "NO") for score in scores):
+        return None
+    return "NO" not in scores
+
+
+def merge_query_with_response_stream(data_path, response_path, evaluate_path, sft_save_path=None, dpo_save_path=None, index=None, k=5, n_sampling=False, resume=True,
+                                     rule_verify=False, multi_judge=False, score_only=False, audit_fraction=0.0, min_confidence=0.0,
+                                     escalate_path=None, threshold=0.9, calibrate_fraction=0.0):
+    # single pass over the sft data, walking the resample and judge outputs in lockstep
+    # only the k samples of the current query are held in memory
+    # with score_only, responses whose least confident verdict is below min_confidence count as judge errors
+    # with escalate_path (see run_escalation_data), escalated responses take the large judge's verdict
+    if escalate_path:
+        check_cascade(score_only)
+    st, ed = shard_range(index)
+    save_paths = [path for path in (sft_save_path, dpo_save_path) if path]
+    input_paths = [data_path]
+    for path in (response_path, evaluate_path) + ((escalate_path,) if escalate_path else ()):
+        input_paths.extend([path] if isinstance(path, str) else [p for p in path if os.path.exists(p)])
+    manifest = StageManifest(input_paths, save_paths, params={"stage": "merge", "index": index, "n_sampling": n_sampling, "k": k, "rule_verify": rule_verify,
+                                                             "multi_judge": multi_judge, "judge_context_tokens": judge_context_tokens,
+                                                             "score_only": score_only, "audit_fraction": audit_fraction, "min_confidence": min_confidence,
+                                                             "escalate": bool(escalate_path), "threshold": threshold, "calibrate_fraction": calibrate_fraction,
+                                                             "sft": bool(sft_save_path), "dpo": bool(dpo_save_path)}, resume=resume)
+    with ExitStack() as stack:
+        response_reader = stack.enter_context(CustomIdReader(response_path))
+        evaluate_reader = stack.enter_context(CustomIdReader(evaluate_path))
+        escalate_reader = stack.enter_context(CustomIdReader(escalate_path)) if escalate_path else None
+        files = [stack.enter_context(manifest.open(path)) for path in save_paths]
+        sft_writer = jsonlines.Writer(files[0]) if sft_save_path else None
+        dpo_writer = jsonlines.Writer(files[-1]) if dpo_save_path else None
+
+        seen = set()
+        error, uncertain = 0, 0
+        audit = {"audited": 0, "agreed": 0}
+        cascade = new_cascade_stats()
+        sft_cnt, not_satisfied, dpo_cnt = 0, 0, 0
+        pos = st
+        for pos, data in tqdm(iter_shard(data_path, index)):
+            history = data.get("history", [])
+            if len(history) % 2 != 0 or make_custom_id(data) in seen:
+                continue
+            seen.add(make_custom_id(data))
+            if pos < manifest.completed:
+                continue
+            if pos - manifest.completed >= checkpoint_every:
+                manifest.checkpoint(pos, files, start=st)
+
+            samples = []
+            responses = [(custom_id, response) for custom_id, response in take_samples(response_reader, data, k, n_sampling) if response is not None]
+            decided, requests, outputs, verdicts = read_verdicts(data, responses, evaluate_reader, audit, rule_verify, multi_judge, score_only, audit_fraction)
+            if escalate_reader is not None:
+                escalate_query(data, responses, decided, requests, outputs, verdicts, escalate_reader, threshold, calibrate_fraction, cascade)
+            for custom_id, response in responses:
+                flag = judge_passed(verdicts[custom_id], len(data["eval question"]))
+                if flag is not None and verdict_confidence(verdicts[custom_id]) < min_confidence:
+                    uncertain += 1
+                    flag = None
+                if flag is None:
+                    error += 1
+                samples.append((response, flag))
+            if len(samples) == 0:
+                continue
+
+            if sft_writer is not None:
+                passed = [response for response, flag in samples if flag]
+                if len(passed) == 0:
+                    not_satisfied += 1
+                sft_writer.write({
                     "instruction": data["query"],
-                    "output": response,
+                    "output": passed[0] if passed else samples[-1][0],
                     "history": history
-                }
-                inputs.append(item)
-                satisfied = True
-                cnt += (k-i-1)
-                break
-        if not satisfied:
-            item = {
-                "instruction": data["query"],
-                "output": response,
-                "history": history
-            }
-            inputs.append(item)
-            not_satisfied.append(data)
-    
-
-    with jsonlines.open(save_path, "w") as f:
-        for each in inputs:
-            f.write(each)
-
-
-def merge_query_with_response_dpo(data_path, response_path, evaluate_path, save_path, index=None):
-    sft_data = list(jsonlines.open(data_path, "r"))
-    resample_results = list(jsonlines.open(response_path))
-    evaluate_results = list(jsonlines.open(evaluate_path))
-    response_map = {}
-    evaluate_map = {}
-    for res in resample_results:
-        response_map[res["custom_id"]] = res
-    for res in evaluate_results:
-        evaluate_map[res["custom_id"]] = res
-    cnt = 0
-    error = 0
-    inputs = []
-    if index == None:
-        st = 0
-        ed = len(sft_data)
-    else:
-        st = 10000 * index
-        ed = min(len(sft_data), 10000 * (index + 1))
-
-    k = len(resample_results) // (ed-st)
-    print(k)
-    for data in tqdm(sft_data[st:ed]):
-        pos, neg = None, None
-        history = data.get("history", [])
-        for i in range(k):
-            cnt += 1
-            custom_id = "request-" + str(cnt)
-            response = response_map[custom_id]["response"]['body']["choices"][0]["message"]["content"]
+                })
+                sft_cnt += 1
+
+            if dpo_writer is not None:
+                pos_response, neg_response = None, None
+                for response, flag in samples:
+                    if flag is None:
+                        continue
+                    if flag:
+                        pos_response = response
+                    else:
+                        neg_response = response
+                if pos_response is not None and neg_response is not None:
+                    dpo_writer.write({
+                        "prompt": data["query"],
+                        "chosen": pos_response,
+                        "rejected": neg_response,
+                        "history": history
+                    })
+                    dpo_cnt += 1
+
+        manifest.checkpoint(max(pos + 1, manifest.completed), files, start=st)
+        manifest.finish(files)
+    print(f"sft: {sft_cnt} ({not_satisfied} not satisfied), dpo: {dpo_cnt}, judge errors: {error}, "
+          f"missing responses: {response_reader.missing}, missing evaluations: {evaluate_reader.missing}")
+    judge_parse.report()
+    if min_confidence > 0:
+        print(f"[score] {uncertain} responses below confidence {min_confidence} counted as judge errors")
+    if audit["audited"]:
+        print(f"[audit] score-only verdict agrees with the explanation judge on {audit['agreed']}/{audit['audited']} responses "
+              f"({audit['agreed'] / audit['audited']:.1%})")
+    if escalate_reader is not None:
+        print(f"missing escalations: {escalate_reader.missing}")
+        escalate_parse.report()
+        report_cascade(cascade, threshold)
+
+
+def escalate_query(data, responses, decided, requests, outputs, verdicts, escalate_reader, threshold, calibrate_fraction, stats):
+    # replaces the verdicts of escalated responses by the large judge's in place and counts per tier
+    num_questions = len(data["eval question"])
+    indices = judge_indices(requests)
+    stats["small calls"] += len(requests)
+    stats["small tokens"] += sum(usage_tokens(body) for body in outputs.values())
+    for custom_id, response in responses:
+        stats["responses"] += 1
+        stats["questions"] += num_questions
+        stats["rule questions"] += len(decided[custom_id])
+        if custom_id not in indices:
+            stats["rules only"] += 1
+        reason = escalation_reason(data, custom_id, verdicts[custom_id], threshold, calibrate_fraction)
+        if reason is None:
+            stats["kept"] += custom_id in indices
+            continue
+        stats[reason] += 1
+        body = get_body(escalate_reader.take(f"{custom_id}-escalate"))
+        stats["large tokens"] += usage_tokens(body)
+        verdict = escalated_verdict(data, decided[custom_id], escalation_indices(data, indices, custom_id), body)
+        small, large = judge_passed(verdicts[custom_id], num_questions), judge_passed(verdict, num_questions)
+        if large is None:
+            continue
+        if small is not None and custom_id not in indices:
+            stats["rule agreed"] += small == large
+            stats["rule compared"] += 1
+        elif small is not None:
+            low = math.floor(verdict_confidence(verdicts[custom_id]) * 10) / 10
+            bin = stats["bins"].setdefault(min(low, 0.9), [0, 0])
+            bin[0] += small == large
+            bin[1] += 1
+            stats["agreed"] += small == large
+            stats["compared"] += 1
+        verdicts[custom_id] = verdict
+
+
+def merge_query_with_response(data_path, response_path, evaluate_path, save_path, index=None, k=5, n_sampling=False, **judge_options):
+    # judge_options: the rule_verify / multi_judge / score_only ... flags the judge requests were written with
+    merge_query_with_response_stream(data_path, response_path, evaluate_path, sft_save_path=save_path, index=index, k=k, n_sampling=n_sampling, **judge_options)
+
+
+def merge_query_with_response_dpo(data_path, response_path, evaluate_path, save_path, index=None, k=5, n_sampling=False, **judge_options):
+    merge_query_with_response_stream(data_path, response_path, evaluate_path, dpo_save_path=save_path, index=index, k=k, n_sampling=n_sampling, **judge_options)
+
+
+def sample_until_enough(data, gen_client, judge_client, mode="sft", wave_size=2, max_budget=10, rule_verify=False, multi_judge=False,
+                        score_only=False, min_confidence=0.0, escalate_client=None, threshold=0.9, index=None):
+    # generate `wave_size` samples at a time and judge them right away,
+    # stopping once the query has what `mode` needs or the budget is spent;
+    # every wave counts as progress of a scheduler chunk `index`, so its lease outlives slow queries
+    message = build_resample_messages(data)
+    samples = []
+    while len(samples) < max_budget:
+        n = min(wave_size, max_budget - len(samples))
+        try:
+            responses = body_contents(gen_client.post({"messages": message, **resample_params, "n": n}))
+        except Exception as e:
+            responses = []
+        wave = [(len(samples) + i, response) for i, response in enumerate(responses) if response is not None]
+        decided, requests = plan_judging(data, wave, rule_verify, multi_judge, score_only)
+        outputs = {}
+        for judge_id, group, indices, score in requests:
             try:
-                eval = evaluate_map[custom_id]["response"]['body']["choices"][0]["message"]["content"]
-                # print(eval)
-                eval = parse_tool(eval)
+                outputs[judge_id] = judge_client.post(build_judge_body(data, group, indices, score))
             except:
-                eval = None
-            flag = True
-            
-            if isinstance(eval, dict):
+                outputs[judge_id] = None
+        verdicts = collect_verdicts(data, decided, requests, outputs)
+        indices = judge_indices(requests)
+        for i, response in wave:
+            if escalate_client is not None and i in indices and escalation_reason(data, i, verdicts[i], threshold) is not None:
                 try:
-                    for key, value in eval.items():
-                        if "Question" in key and value["score"].lower() == "no":
-                            flag = False
-                            break
+                    body = escalate_client.post(build_escalate_body(data, response, indices[i]))
                 except:
-                    flag = False
-            else:
-                error += 1
-                flag = False
+                    body = None
+                verdict = escalated_verdict(data, decided[i], indices[i], body)
+                if judge_passed(verdict, len(data["eval question"])) is not None:
+                    verdicts[i] = verdict
+        for i, response in wave:
+            flag = judge_passed(verdicts[i], len(data["eval question"]))
+            if flag is not None and verdict_confidence(verdicts[i]) < min_confidence:
+                flag = None
+            samples.append((response, flag))
+        samples += [(None, None)] * (n - len(wave))
+        progress(index)
+
+        passed = any(flag for _, flag in samples)
+        failed = any(flag is False for _, flag in samples)
+        if mode == "sft" and passed:
+            break
+        if mode == "dpo" and passed and failed:
+            break
+    return samples
+
+
+def run_adaptive_sampling(data_path, save_path, base_url, judge_url=None, mode="sft", wave_size=2, max_budget=10, index=None, num_workers=32, api_key=None, cache=None, resume=True,
+                          rule_verify=False, multi_judge=False, score_only=False, min_confidence=0.0, escalate_url=None, threshold=0.9, guided="vllm"):
+    # online alternative to run_resampling_data -> run_reevaluation_data -> merge_query_with_response(_dpo)
+    # with escalate_url, verdicts of the judge below `threshold` confidence are redone by the large judge there;
+    # guided: guided decoding parameters the servers accept ("vllm", "openai" or "none", see utils.schemas.for_backend)
+    gen_client = OpenAIClient(base_url, api_key=api_key, pool_size=num_workers, guided=guided)
+    judge_client = OpenAIClient(judge_url or base_url, api_key=api_key, pool_size=num_workers, cache=cache, guided=guided)
+    if escalate_url:
+        check_cascade(score_only)
+    escalate_client = OpenAIClient(escalate_url, api_key=api_key, pool_size=num_workers, cache=cache, guided=guided) if escalate_url else None
+    st, ed = shard_range(index)
+    manifest = StageManifest(data_path, save_path, params={"stage": "adaptive_sampling", "index": index, "mode": mode,
+                                                           "wave_size": wave_size, "max_budget": max_budget, "rule_verify": rule_verify, "multi_judge": multi_judge,
+                                                           "score_only": score_only, "min_confidence": min_confidence,
+                                                           "escalate": bool(escalate_url), "threshold": threshold}, resume=resume)
+
+    def unique_records():
+        seen = set()
+        for pos, data in iter_shard(data_path, index):
+            if build_resample_messages(data) is not None and make_custom_id(data) not in seen:
+                seen.add(make_custom_id(data))
+                if pos >= manifest.completed:
+                    yield pos, data
+
+    sft_data = unique_records()
+    queries, generated, written = 0, 0, 0
+    pbar = tqdm()
+    with manifest.open(save_path) as fout, ThreadPoolExecutor(num_workers) as executor:
+        f = jsonlines.Writer(fout)
+        while True:
+            chunk = list(islice(sft_data, num_workers * 8))
+            if len(chunk) == 0:
+                break
+            results = executor.map(lambda item: sample_until_enough(item[1], gen_client, judge_client, mode, wave_size, max_budget, rule_verify, multi_judge,
+                                                                               score_only, min_confidence, escalate_client, threshold, index), chunk)
+            for (_, data), samples in zip(chunk, results):
+                pbar.update(1)
+                queries += 1
+                generated += len(samples)
+                history = data.get("history", [])
+                responses = [(response, flag) for response, flag in samples if response is not None]
+                if mode == "sft" and responses:
+                    passed = [response for response, flag in responses if flag]
+                    f.write({
+                        "instruction": data["query"],
+                        "output": passed[0] if passed else responses[-1][0],
+                        "history": history
+                    })
+                    written += 1
+                elif mode == "dpo":
+                    pos = [response for response, flag in responses if flag]
+                    neg = [response for response, flag in responses if flag is False]
+                    if pos and neg:
+                        f.write({
+                            "prompt": data["query"],
+                            "chosen": pos[-1],
+                            "rejected": neg[-1],
+                            "history": history
+                        })
+                        written += 1
+            manifest.checkpoint(chunk[-1][0] + 1, [fout], start=st)
+        manifest.finish([fout])
+    pbar.close()
+    print(f"queries: {queries}, written: {written}, samples generated and judged: {generated} "
+          f"(fixed k=5 would use {5 * queries}), avg samples per query: {generated / max(queries, 1):.2f}")
+    judge_parse.report()
+    if escalate_client is not None:
+        escalate_parse.report()
+    if cache is not None:
+        cache.report("adaptive sampling judge")
+
+
+# live queues of the pipelined stage, exposed for monitoring through get_queue_depths()
+pipeline_queues = {}
+
+
+def get_queue_depths():
+    return {name: queue.qsize() for name, queue in pipeline_queues.items()}
+
+
+async def run_pipelined_sampling_async(data_path, response_save_path, evaluate_save_path, gen_url, judge_url, index=None, k=5,
+                                       gen_concurrency=64, judge_concurrency=64, queue_size=256, api_key=None, cache=None, resume=True, rule_verify=False, multi_judge=False,
+                                       score_only=False, audit_fraction=0.0, escalate_url=None, escalate_save_path=None, threshold=0.9, calibrate_fraction=0.0,
+                                       guided="vllm"):
+    # resampling and judging as one producer/consumer pipeline: every finished generation is judged
+    # right away on the judge server, so both servers stay busy; bounded queues give backpressure
+    # with escalate_url, the cascade's large judge runs inline and writes escalate_save_path for the merge;
+    # guided: guided decoding parameters the servers accept (see utils.schemas.for_backend)
+    if escalate_url:
+        check_cascade(score_only)
+    st, ed = shard_range(index)
+    save_paths = [response_save_path, evaluate_save_path] + ([escalate_save_path] if escalate_url else [])
+    manifest = StageManifest(data_path, save_paths, params={"stage": "pipelined_sampling", "index": index, "k": k, "rule_verify": rule_verify,
+                                                            "multi_judge": multi_judge, "judge_context_tokens": judge_context_tokens,
+                                                            "score_only": score_only, "audit_fraction": audit_fraction,
+                                                            "escalate": bool(escalate_url), "threshold": threshold, "calibrate_fraction": calibrate_fraction}, resume=resume)
+    gen_client = AsyncOpenAIClient(gen_url, api_key=api_key, concurrency=gen_concurrency, guided=guided)
+    judge_client = AsyncOpenAIClient(judge_url, api_key=api_key, concurrency=judge_concurrency, cache=cache, guided=guided)
+    escalate_client = AsyncOpenAIClient(escalate_url, api_key=api_key, concurrency=judge_concurrency, cache=cache, guided=guided) if escalate_url else None
+    gen_queue = asyncio.Queue(queue_size)
+    judge_queue = asyncio.Queue(queue_size)
+    pipeline_queues["generate"] = gen_queue
+    pipeline_queues["judge"] = judge_queue
+    pbar = tqdm(desc="judged")
+    # results complete out of order: the lines of a query are held until every earlier query is written,
+    # so the outputs only ever hold whole queries up to the watermark and a resumed run redoes exactly the rest
+    inflight = {}
+    held = defaultdict(list)
+    finished = set()
+    produced = [manifest.completed]
+    # bounds the queries whose lines are held behind a slow one
+    window = asyncio.Semaphore(4 * queue_size)
+
+    def watermark():
+        return next(iter(inflight)) if inflight else produced[0]
+
+    def hold(pos, f, result):
+        held[pos].append((f, json.dumps(result, ensure_ascii=False) + "\n"))
+
+    def query_done(pos, files):
+        # produce() reads ahead of the judged queries, so a scheduler lease counts finished queries as progress
+        progress(index)
+        finished.add(pos)
+        while inflight and next(iter(inflight)) in finished:
+            first = next(iter(inflight))
+            del inflight[first]
+            finished.discard(first)
+            for f, line in held.pop(first, []):
+                f.write(line)
+            window.release()
+        if watermark() - manifest.completed >= checkpoint_every:
+            manifest.checkpoint(watermark(), files, start=st)
+
+    async def produce():
+        seen = set()
+        for pos, data in iter_shard(data_path, index):
+            message = build_resample_messages(data)
+            custom_id = make_custom_id(data)
+            if message is None or custom_id in seen:
                 continue
-            if flag:
-                pos = response
-            else:
-                neg = response
-        if pos is not None and neg is not None:
-            inputs.append(
-                {
-                    "prompt": data["query"],
-                    "chosen": pos,
-                    "rejected": neg,
-                    "history": history
-                }
-            )
-    
+            seen.add(custom_id)
+            if pos < manifest.completed:
+                continue
+            await window.acquire()
+            inflight[pos] = k
+            await gen_queue.put((pos, custom_id, data, message))
+            produced[0] = pos + 1
+        for _ in range(gen_concurrency):
+            await gen_queue.put(None)
+
+    async def generate(fout, escalate_f, files):
+        while True:
+            item = await gen_queue.get()
+            if item is None:
+                return
+            pos, custom_id, data, message = item
+            try:
+                body = await gen_client.post({"messages": message, **resample_params, "n": k})
+                result = to_batch_output(custom_id, body=body)
+            except Exception as e:
+                result = to_batch_output(custom_id, error=e)
+            hold(pos, fout, result)
+            samples = [(f"{custom_id}-{i}", response) for i, response in enumerate(get_contents(result)) if response is not None]
+            # local verdicts are recomputed at merge time, only the judge requests are written
+            decided, requests = plan_judging(data, samples, rule_verify, multi_judge, score_only, audit_fraction)
+            if escalate_client is not None:
+                await calibrate_rules(pos, data, samples, requests, escalate_f)
+            inflight[pos] = len(requests)
+            if len(requests) == 0:
+                query_done(pos, files)
+            for request in requests:
+                await judge_queue.put((pos, data, decided, request))
+
+    async def escalate(pos, data, decided, request, body, fout):
+        # audit requests are left alone: an audited query keeps its explanation verdict
+        judge_id, group, indices, _ = request
+        if judge_id.endswith("-audit"):
+            return
+        verdicts = collect_verdicts(data, {custom_id: decided[custom_id] for custom_id, _ in group}, [request], {judge_id: body})
+        for custom_id, response in group:
+            if escalation_reason(data, custom_id, verdicts[custom_id], threshold, calibrate_fraction) is None:
+                continue
+            try:
+                result = to_batch_output(f"{custom_id}-escalate", body=await escalate_client.post(build_escalate_body(data, response, indices)))
+            except Exception as e:
+                result = to_batch_output(f"{custom_id}-escalate", error=e)
+            hold(pos, fout, result)
+
+    async def calibrate_rules(pos, data, samples, requests, fout):
+        # responses the rules decided alone have no judge request; a sampled fraction goes to the large judge
+        indices = judge_indices(requests)
+        for custom_id, response in samples:
+            if custom_id in indices or not sampled(custom_id, calibrate_fraction):
+                continue
+            try:
+                result = to_batch_output(f"{custom_id}-escalate", body=await escalate_client.post(build_escalate_body(data, response, escalation_indices(data, indices, custom_id))))
+            except Exception as e:
+                result = to_batch_output(f"{custom_id}-escalate", error=e)
+            hold(pos, fout, result)
+
+    async def judge(fout, escalate_f, files):
+        while True:
+            item = await judge_queue.get()
+            if item is None:
+                return
+            pos, data, decided, request = item
+            judge_id, group, indices, score = request
+            body = None
+            try:
+                body = await judge_client.post(build_judge_body(data, group, indices, score))
+                result = to_batch_output(judge_id, body=body)
+            except Exception as e:
+                result = to_batch_output(judge_id, error=e)
+            hold(pos, fout, result)
+            if escalate_client is not None:
+                await escalate(pos, data, decided, request, body, escalate_f)
+            pbar.update(1)
+            pbar.set_postfix(get_queue_depths(), refresh=False)
+            inflight[pos] -= 1
+            if inflight[pos] == 0:
+                query_done(pos, files)
+
+    try:
+        with manifest.open(response_save_path) as response_f, manifest.open(evaluate_save_path) as evaluate_f, \
+                (manifest.open(escalate_save_path) if escalate_url else open(os.devnull, "w")) as escalate_f:
+            files = [response_f, evaluate_f] + ([escalate_f] if escalate_url else [])
+            judges = [asyncio.ensure_future(judge(evaluate_f, escalate_f, files)) for _ in range(judge_concurrency)]
+            await asyncio.gather(produce(), *[generate(response_f, escalate_f, files) for _ in range(gen_concurrency)])
+            for _ in range(judge_concurrency):
+                await judge_queue.put(None)
+            await asyncio.gather(*judges)
+            manifest.checkpoint(watermark(), files, start=st)
+            manifest.finish(files)
+    finally:
+        pbar.close()
+        pipeline_queues.clear()
+        await gen_client.close()
+        await judge_client.close()
+        if escalate_client is not None:
+            await escalate_client.close()
+    judge_parse.report()
+    if cache is not None:
+        cache.report("pipelined judge")
+
+
+def run_pipelined_sampling(data_path, response_save_path, evaluate_save_path, gen_url, judge_url, index=None, k=5,
+                           gen_concurrency=64, judge_concurrency=64, queue_size=256, api_key=None, cache=None, resume=True, rule_verify=False, multi_judge=False,
+                           score_only=False, audit_fraction=0.0, escalate_url=None, escalate_save_path=None, threshold=0.9, calibrate_fraction=0.0,
+                           guided="vllm"):
+    # writes the same files as resampling + reevaluation batches with n_sampling=True,
+    # so merge_query_with_response_stream(..., n_sampling=True) consumes them directly
+    asyncio.run(run_pipelined_sampling_async(data_path, response_save_path, evaluate_save_path, gen_url, judge_url, index=index, k=k,
+                                             gen_concurrency=gen_concurrency, judge_concurrency=judge_concurrency,
+                                             queue_size=queue_size, api_key=api_key, cache=cache, resume=resume,
+                                             rule_verify=rule_verify, multi_judge=multi_judge, score_only=score_only, audit_fraction=audit_fraction,
+                                             escalate_url=escalate_url, escalate_save_path=escalate_save_path, threshold=threshold,
+                                             calibrate_fraction=calibrate_fraction, guided=guided))
+
+
+def run_sharded(stage, work_dir, data_path, *args, chunk_size=1000, lease_seconds=600, worker=None, **kwargs):
+    # runs `stage` chunk by chunk under a ShardScheduler shared by any number of workers (start the same
+    # call on every node); "{chunk}" in the path arguments becomes the chunk id, so every chunk has its
+    # own outputs and manifest and a reclaimed chunk resumes from the dead worker's last checkpoint.
+    # Chunk outputs join by custom_id, so their batch outputs can simply be concatenated per stage.
+    scheduler = ShardScheduler(work_dir, data_path, chunk_size=chunk_size, lease_seconds=lease_seconds, worker=worker)
+
+    def chunk_paths(chunk, value):
+        return value.replace("{chunk}", f"{chunk.id:05d}") if isinstance(value, str) else value
+
+    def run_chunk(chunk):
+        stage(data_path, *[chunk_paths(chunk, arg) for arg in args], index=chunk,
+              **{key: chunk_paths(chunk, value) for key, value in kwargs.items()})
 
-    with jsonlines.open(save_path, "w") as f:
-        for each in inputs:
-            f.write(each)
+    return scheduler.run(run_chunk)
 
 
 if __name__ == "__main__":
@@ -381,6 +1242,27 @@ if __name__ == "__main__":
 
     # run the following code line by line
     run_resampling_data("./Sharegpt_turn1_augmented_query_sft_1.jsonl", f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}.jsonl", index=split)
+    # (or stored compressed with the shared prompt written once, expanded at upload time with utils/request_writer.py:
+    #  run_resampling_data(..., f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}.jsonl.zst", index=split, compact=True))
+    # multi-turn prompts can leave less than max_tokens=4096 of the context; set max_tokens per request from what is left
+    # (and trim the oldest turns of those that do not fit) before uploading:
+    # python utils/token_budget.py plan -i ./Sharegpt_turn1_augmented_query_sft_1_query_1.jsonl -o ./Sharegpt_turn1_augmented_query_sft_1_query_1.planned.jsonl --tokenizer meta-llama/Llama-3.1-8B-Instruct --context 8192 --max-output 4096 --overflow trim
     # run_reevaluation_data("./Sharegpt_turn1_augmented_query_sft_1.jsonl", f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_output.jsonl", f"./result_call_1219/Sharegpt_turn1_augmented_query_sft_1_query{args.split}_evaluate.jsonl", index=split)
+    # (multi_judge=True judges the k responses of a query in one call; score_only=True, audit_fraction=0.05 asks for
+    #  YES/NO tokens only and audits 5% of queries with explanations; pass the same flags to the merge)
+    # before merging, failed judge outputs can be re-issued alone: python utils/repair.py collect --stage judge ... (see utils/repair.py)
+    # cascade: rules + small judge with rule_verify=True, score_only=True above, then escalate low-confidence verdicts to the 70B judge
+    # run_escalation_data("./Sharegpt_turn1_augmented_query_sft_1.jsonl", f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_output.jsonl", f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_evaluate_output.jsonl", f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_escalate.jsonl", index=split, threshold=0.9, calibrate_fraction=0.02, rule_verify=True, score_only=True)
+    # and merge with the same flags + escalate_path=f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_escalate_output.jsonl"
     # merge_query_with_response(data_path="./Sharegpt_turn1_augmented_query_sft_1.jsonl", response_path=f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_output.jsonl", evaluate_path=f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_evaluate_output.jsonl", save_path=f"./Sharegpt_turn1_augmented_query_sft_1{args.split}_response.jsonl", index=split)
-    # merge_query_with_response_dpo(..)
\ No newline at end of file
+    # merge_query_with_response_dpo(..)
+    # or write both the sft and dpo data in one pass:
+    # merge_query_with_response_stream(data_path="./Sharegpt_turn1_augmented_query_sft_1.jsonl", response_path=f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_output.jsonl", evaluate_path=f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_evaluate_output.jsonl", sft_save_path=f"./Sharegpt_turn1_augmented_query_sft_1{args.split}_response.jsonl", dpo_save_path=f"./Sharegpt_turn1_augmented_query_sft_1{args.split}_dpo.jsonl", index=split)
+    # online mode against an OpenAI-compatible server, stopping per query once enough samples pass:
+    # run_adaptive_sampling("./Sharegpt_turn1_augmented_query_sft_1.jsonl", f"./Sharegpt_turn1_augmented_query_sft_1{args.split}_response.jsonl", base_url="http://localhost:8000", mode="sft", max_budget=10, index=split)
+    # or pipeline generation and judging across two running servers, then merge with n_sampling=True:
+    # run_pipelined_sampling("./Sharegpt_turn1_augmented_query_sft_1.jsonl", f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_output.jsonl", f"./Sharegpt_turn1_augmented_query_sft_1_query{args.split}_evaluate_output.jsonl", gen_url="http://localhost:8000", judge_url="http://localhost:8001", index=split)
+    # instead of assigning --index to machines by hand, start the same command on every node with a shared work_dir;
+    # nodes lease 1000-record chunks until all are done (progress: python utils/scheduler.py status -w ... -i ...):
+    # run_sharded(run_pipelined_sampling, "./schedule/pipelined", "./Sharegpt_turn1_augmented_query_sft_1.jsonl", "./chunks/Sharegpt_turn1_augmented_query_sft_1_query_{chunk}_output.jsonl", "./chunks/Sharegpt_turn1_augmented_query_sft_1_query_{chunk}_evaluate_output.jsonl", gen_url="http://localhost:8000", judge_url="http://localhost:8001")
+    # run_sharded(run_resampling_data, "./schedule/resampling", "./Sharegpt_turn1_augmented_query_sft_1.jsonl", "./chunks/Sharegpt_turn1_augmented_query_sft_1_query_{chunk}.jsonl")
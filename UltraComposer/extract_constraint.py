@@ -1,9 +1,18 @@
 import jsonlines
 import os
+import sys
 from tqdm import tqdm
 import json
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.completion_cache import CompletionCache, cached_output_path
+from utils.online_client import to_batch_output
+from utils.request_ids import make_custom_id
+from utils.manifest import StageManifest
+from utils.jsonl_io import JsonlWriter, iter_jsonl
+from utils.schemas import CONSTRAINT_SCHEMA, guided_json
+
 
 # first stage extract constraints
 prompt_template = """You are an expert in extracting instruction constraints from a given query. 
@@ -176,27 +185,77 @@ Explanation: The primary goal of the query is to recommend books. The query incl
 Please only provide the response in JSON format.
 """.strip()
 
+# same instructions with the query moved to the end: every request then starts with the same ~2k
+# tokens, which a server with prefix caching (vllm --enable-prefix-caching, sglang) prefills once
+prefix_prompt_template = prompt_template.replace("Query: {QUERY}\n\n", "", 1) + """
+
+Now extract the constraints of the following query.
+Query: {QUERY}"""
+
+LAYOUTS = ("original", "prefix")
+
+
+def build_prompt(query, layout="original"):
+    assert layout in LAYOUTS, f"layout must be one of {LAYOUTS}"
+    template = prefix_prompt_template if layout == "prefix" else prompt_template
+    return template.format(QUERY=query)
+
 
-def packing(data_path="your_data.jsonl"):
-    data = list(jsonlines.open(data_path, "r"))
-    for idx, d in enumerate(tqdm(data)):
-        query = prompt_template.format(QUERY=d['query'])
+def packing(data_path="your_data.jsonl", cache=None, resume=True, layout="original"):
+    # with a CompletionCache, prompts answered before go to extract_constraint_prompts_cached_output.jsonl
+    # in batch output format instead of the request file
+    # layout="prefix" puts the query after the instructions and examples (see utils/bench_prefix_cache.py)
+    save_path = "./extract_constraint_prompts.jsonl"
+    outputs = [save_path] + ([cached_output_path(save_path)] if cache is not None else [])
+    manifest = StageManifest(data_path, outputs, params={"stage": "extract_constraint", "layout": layout}, resume=resume)
+    f = JsonlWriter(save_path, "a")
+    cached_f = JsonlWriter(cached_output_path(save_path), "a") if cache is not None else None
+    files = [f] + ([cached_f] if cached_f is not None else [])
+    seen = set()
+    idx = -1
+    for idx, d in enumerate(tqdm(iter_jsonl(data_path))):
+        custom_id = make_custom_id(d, fields=("query",))
+        if custom_id in seen:
+            continue
+        seen.add(custom_id)
+        if idx < manifest.completed:
+            continue
+        if idx - manifest.completed >= 1000:
+            manifest.checkpoint(idx, files)
+        query = build_prompt(d['query'], layout)
         messages = [{'role': 'user', 'content': query}]
+        request = {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "meta-llama/Meta-Llama-3.1-70B-Instruct",
+                "messages": messages,
+                "max_tokens": 4096,
+                "temperature": 0,
+                "top_p": 1.0,
+                **guided_json(CONSTRAINT_SCHEMA),
+            }
+        }
+        cached = cache.get(request["body"]) if cache is not None else None
+        if cached is not None:
+            cached_f.write(to_batch_output(request["custom_id"], body=cached))
+            continue
         # use vllm batch call for inference
-        with jsonlines.open("./extract_constraint_prompts.jsonl", "a") as f:
-            f.write({
-                "custom_id": f"request-{idx}",
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": "meta-llama/Meta-Llama-3.1-70B-Instruct",
-                    "messages": messages,
-                    "max_tokens": 4096,
-                    "temperature": 0,
-                    "top_p": 1.0
-                }
-            })          
+        f.write(request)
+    manifest.checkpoint(idx + 1, files)
+    manifest.finish(files)
+    for fout in files:
+        fout.close()
+    if cache is not None:
+        cache.report("extract_constraint")
     
 if __name__ == "__main__":
+    # near-duplicate queries can be dropped first: python utils/dedup.py dedup -i your_data.jsonl -o your_data.dedup.jsonl --threshold 0.8
+    # and packing("your_data.dedup.jsonl"); utils/dedup.py expand copies the results to the dropped queries
     packing("your_data.jsonl")
+    # against a server with prefix caching: packing("your_data.jsonl", layout="prefix")
+    # to skip prompts that were already answered: packing("your_data.jsonl", cache=CompletionCache("./completion_cache.sqlite"))
+    # and after the batch finishes: CompletionCache("./completion_cache.sqlite").fill("./extract_constraint_prompts.jsonl", "output.jsonl");
+    # generate_eval_ques then reads ["output.jsonl", "./extract_constraint_prompts_cached_output.jsonl"] as the results
     # after packing, you need to run batch and extract the results to 
@@ -1,10 +1,22 @@
 import jsonlines
 import os
+import sys
 from tqdm import tqdm
 import json
 import ast
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.completion_cache import cached_output_path
+from utils.jsonl_io import JsonlWriter, iter_jsonl
+from utils.online_client import to_batch_output
+from utils.request_ids import make_custom_id
+from utils.manifest import StageManifest
+from utils.json_extract import extract_json
+from utils.stream_join import CustomIdReader, get_content, has_custom_ids, iter_positional
+from utils.schemas import CONSTRAINT_SCHEMA, QUESTION_SCHEMA, ParseStats, guided_json, matches
+from utils.question_memo import QuestionMemo
+
 # second stage: generate question
 generate_prompt_template = """You are an expert in crafting questions to evaluate whether a response to a query adheres to specific constraints.
 
@@ -85,67 +97,182 @@ Constraint: {constraint}
 ```
 """.strip()
 
+# the output format block moved in front of the query, so everything up to "Query:" is shared by all requests
+prefix_generate_prompt_template = generate_prompt_template[:generate_prompt_template.index("Query: {query}")] + """```json
+{{
+    "question": "string",
+}}
+```
+Query: {query}
+Constraint: {constraint}"""
+
+LAYOUTS = ("original", "prefix")
+
+
+def build_prompt(query, constraint, layout="original"):
+    assert layout in LAYOUTS, f"layout must be one of {LAYOUTS}"
+    template = prefix_generate_prompt_template if layout == "prefix" else generate_prompt_template
+    return template.format(query=query, constraint=constraint)
+
+
+class ConstraintResults:
+    # extract_constraint result per input record: by custom_id from batch output lines, by position from
+    # post-processed {'output': ...} records; take() must be called once for every input record, in order
+    def __init__(self, batch_call_results):
+        self.reader = CustomIdReader(batch_call_results) if has_custom_ids(batch_call_results) else None
+        self.records = iter_positional(batch_call_results) if self.reader is None else None
+        self.missing = 0
+
+    def take(self, custom_id):
+        result = self.reader.take(custom_id) if self.reader is not None else next(self.records, None)
+        self.missing += result is None
+        return result
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+
 
-def packing(data_path, batch_call_results):
-    data = list(jsonlines.open(data_path, "r"))
-    extract_constraint = list(jsonlines.open(batch_call_results, "r"))
+def packing(data_path, batch_call_results, cache=None, resume=True, layout="original", memo=None):
+    # extract_constraint results are joined by the content-derived custom_id of each query,
+    # so the results file may be filtered, reordered or come from a different shard layout;
+    # batch_call_results may be a list, e.g. with the extract_constraint_prompts_cached_output.jsonl of cache hits;
+    # post-processed {'output': ...} records without a custom_id are joined by position instead, one per input record
+    # layout="prefix": prompt with the static part first, for servers with prefix caching
+    # with a QuestionMemo, generic constraints ("Use bullet points") get their question from the memo;
+    # like cache hits, those are written to generate_questions_prompts_cached_output.jsonl
+    save_path = "./generate_questions_prompts.jsonl"
+    answered = cache is not None or memo is not None
+    outputs = [save_path] + ([cached_output_path(save_path)] if answered else [])
+    results = [batch_call_results] if isinstance(batch_call_results, str) else [p for p in batch_call_results if os.path.exists(p)]
+    manifest = StageManifest([data_path] + results, outputs, params={"stage": "generate_eval_ques", "layout": layout, "memo": memo is not None}, resume=resume)
+    extract_constraint = ConstraintResults(batch_call_results)
+    parse = ParseStats("extract_constraint")
+    f = JsonlWriter(save_path, "a")
+    cached_f = JsonlWriter(cached_output_path(save_path), "a") if answered else None
+    files = [f] + ([cached_f] if cached_f is not None else [])
+    seen = set()
+    idx = -1
 
-    for idx, d in enumerate(tqdm(data)):
+    for idx, d in enumerate(tqdm(iter_jsonl(data_path))):
         d["idx"] = str(idx)
+        custom_id = make_custom_id(d, fields=("query",))
+        # a positional result belongs to this record even when the record is skipped
+        result = extract_constraint.take(custom_id)
+        if custom_id in seen:
+            continue
+        seen.add(custom_id)
+        if idx < manifest.completed:
+            continue
+        if idx - manifest.completed >= 1000:
+            manifest.checkpoint(idx, files)
         # extract constraint
-        try:
-            constraint = extract_constraint[idx]['output']
-            d['output'] = constraint
-        except Exception as e:
-            print(e)
+        if result is None:
             continue
+        d['output'] = result['output'] if 'output' in result else get_content(result)
         
-        # generate questions
-        try:
-            constraints = d['output']
-            try:
-                constraints = json.loads(constraints.strip())
-            except:
-                try:
-                    constraints = ast.literal_eval(constraints.strip())
-                except Exception as e:
+        # generate questions; outputs that do not match the schema are counted by parse and skipped,
+        # so extract_results numbers the same constraints
+        constraints = extract_json(d['output'])
+        if not parse.add(constraints if isinstance(constraints, dict) else None, CONSTRAINT_SCHEMA):
+            continue
+
+        if not constraints['Complex']:
+            continue
+        
+        constraints.pop('Complex')
+        constraints.pop('Basic Query', None)
+        cnt = 0
+        for key, value in constraints.items():
+            for item in value:
+                cnt += 1
+                constraint = item['constraint']
+                simplified = item['simplified query']
+
+                query = d['query']
+
+                question = memo.lookup(constraint, key) if memo is not None else None
+                if question is not None:
+                    content = json.dumps({"question": question}, ensure_ascii=False)
+                    cached_f.write(to_batch_output(f"{custom_id}-{cnt}", body={"choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]}))
+                    continue
+
+                messages = [{'role': 'user', 'content': build_prompt(query, constraint, layout)}]
+                request = {
+                    "custom_id": f"{custom_id}-{cnt}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": "meta-llama/Meta-Llama-3.1-70B-Instruct",
+                        "messages": messages,
+                        "max_tokens": 4096,
+                        "temperature": 0,
+                        "top_p": 1.0,
+                        **guided_json(QUESTION_SCHEMA),
+                    }
+                }
+                cached = cache.get(request["body"]) if cache is not None else None
+                if cached is not None:
+                    cached_f.write(to_batch_output(request["custom_id"], body=cached))
                     continue
+                f.write(request)
+
+    extract_constraint.close()
+    print(f"{extract_constraint.missing} queries without an extract_constraint result")
+    parse.report()
+    manifest.checkpoint(idx + 1, files)
+    manifest.finish(files)
+    for fout in files:
+        fout.close()
+    if cache is not None:
+        cache.report("generate_eval_ques")
+    if memo is not None:
+        memo.report()
 
-            if not constraints['Complex']:
+
+def extract_results(data_path, batch_call_results, question_results, save_path="./query_tool.jsonl"):
+    # (query, simplified query, question) records for sft_data.py: the constraints of every query are
+    # walked in the order packing numbered them; question_results are the batch outputs of the packed
+    # requests (and the _cached_output.jsonl file of cache / memo hits)
+    extract_constraint = ConstraintResults(batch_call_results)
+    questions = CustomIdReader(question_results)
+    seen = set()
+    written, missing = 0, 0
+    with JsonlWriter(save_path, "w") as f:
+        for d in tqdm(iter_jsonl(data_path)):
+            custom_id = make_custom_id(d, fields=("query",))
+            result = extract_constraint.take(custom_id)
+            if custom_id in seen:
+                continue
+            seen.add(custom_id)
+            output = None if result is None else result['output'] if 'output' in result else get_content(result)
+            constraints = extract_json(output) if output is not None else None
+            if not isinstance(constraints, dict) or not matches(constraints, CONSTRAINT_SCHEMA) or not constraints['Complex']:
                 continue
-            
-            basic = constraints["Basic Query"]
-            constraints.pop('Complex')
-            constraints.pop('Basic Query')
             cnt = 0
             for key, value in constraints.items():
-                for dict in value:
+                if key in ('Complex', 'Basic Query'):
+                    continue
+                for item in value:
                     cnt += 1
-                    constraint = dict['constraint']
-                    simplified = dict['simplified query']
-
-                    query = d['query']
-
-                    messages = [{'role': 'user', 'content': generate_prompt_template.format(query=query, constraint=constraint)}]
-                    with jsonlines.open("./generate_questions_prompts.jsonl", "a") as f:
-                        f.write({
-                            "custom_id": f"request-{idx}-{cnt}",
-                            "method": "POST",
-                            "url": "/v1/chat/completions",
-                            "body": {
-                                "model": "meta-llama/Meta-Llama-3.1-70B-Instruct",
-                                "messages": messages,
-                                "max_tokens": 4096,
-                                "temperature": 0,
-                                "top_p": 1.0
-                            }
-                        })
-                    
-        except Exception as e:          
-            print(e)
-            continue            
+                    content = get_content(questions.take(f"{custom_id}-{cnt}") or {})
+                    if content is None:
+                        missing += 1
+                        continue
+                    f.write({"query": d['query'], "simplified query": item['simplified query'], "tool": content})
+                    written += 1
+    extract_constraint.close()
+    questions.close()
+    print(f"{written} questions written to {save_path}, {missing} without a result")
 
 
 if __name__ == "__main__":
     packing("your_data_path", "batch_call_results")
-    # after packing, you need to run batch and extract the results to 
\ No newline at end of file
+    # when extract_constraint ran with a CompletionCache, its cache hits are results too:
+    # packing("your_data_path", ["batch_call_results", "extract_constraint_prompts_cached_output.jsonl"])
+    # reuse the questions of generic constraints, learned from earlier batches
+    # (python utils/question_memo.py learn --requests generate_questions_prompts.jsonl --results output.jsonl):
+    # packing("your_data_path", "batch_call_results", memo=QuestionMemo("./question_memo.json"))
+    # after packing, you need to run batch and extract the results to query_tool.jsonl for sft_data.py:
+    # extract_results("your_data_path", "batch_call_results", ["output.jsonl", "generate_questions_prompts_cached_output.jsonl"])
+ 
\ No newline at end of file
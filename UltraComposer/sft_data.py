@@ -1,39 +1,43 @@
 import os
+import sys
 import json
 import jsonlines
 from tqdm import tqdm
 import ast
 import re
 
-def parse_tool(tool_str):
-    try:
-        pattern = re.compile(r"```json(.*?)```|```(.*?)```", re.DOTALL)
-        matches = re.findall(pattern, tool_str)
-        tool_str = matches[0][0]
-    except Exception as e:
-        pass
-    try:
-        return json.loads(tool_str)
-    except (json.JSONDecodeError, TypeError):
-        try:
-            return ast.literal_eval(tool_str)
-        except (ValueError, SyntaxError):
-            return None
-        
-results = list(jsonlines.open("query_tool.jsonl", "r"))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.manifest import StageManifest
+from utils.json_extract import parse_tool
+from utils.schemas import QUESTION_SCHEMA, ParseStats
+from utils.jsonl_io import JsonlWriter, iter_jsonl
 
-for data in tqdm(results):
+
+manifest = StageManifest("query_tool.jsonl", "./ultracomposer_sft.jsonl", params={"stage": "ultracomposer_sft"})
+parse = ParseStats("generate_eval_ques")
+f = JsonlWriter("./ultracomposer_sft.jsonl", "a")
+idx = -1
+
+for idx, data in enumerate(tqdm(iter_jsonl("query_tool.jsonl"))):
+    if idx < manifest.completed:
+        continue
+    if idx - manifest.completed >= 1000:
+        manifest.checkpoint(idx, [f])
     query = data["query"]
     simplified = data["simplified query"]
     if query == simplified:
         continue
     tool = parse_tool(data["tool"])
+    parse.add(tool, QUESTION_SCHEMA)
     if tool is None or tool["question"] == "":
         continue
 
-    with jsonlines.open("./ultracomposer_sft.jsonl", "a") as f:
-        f.write({
-                "simplified query": simplified,
-                "query": query,
-                "tool": json.dumps({"question": [tool["question"]]}),
-            })
\ No newline at end of file
+    f.write({
+            "simplified query": simplified,
+            "query": query,
+            "tool": json.dumps({"question": [tool["question"]]}),
+        })
+parse.report()
+manifest.checkpoint(idx + 1, [f])
+manifest.finish([f])
+f.close()
@@ -5,4 +5,7 @@ python -m vllm.entrypoints.openai.run_batch \
 --dtype auto \
 --tensor-parallel-size 4 \
 --trust-remote-code \
---disable-custom-all-reduce
\ No newline at end of file
+--disable-custom-all-reduce
+
+# or, against an already running `vllm serve` (no batch queue, results stream to disk as they finish):
+# python utils/online_client.py -i "input.jsonl" -o "output.jsonl" --base-url http://localhost:8000 --concurrency 64
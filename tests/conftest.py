@@ -0,0 +1,37 @@
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+# the scripts import utils from the repo root and their siblings from their own directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "UltraComposer"), os.path.join(ROOT, "Preprocessing")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def mock_server():
+    # utils/mock_server.py on a free port, in this process: mock_server(pass_rate=...) -> (base url, handler class);
+    # the handler class counts the requests it answered in `posts`
+    from utils.mock_server import MockHandler
+    from utils.prefix_cache import PrefixCache
+
+    servers = []
+
+    def start(**attrs):
+        def do_POST(self):
+            type(self).posts += 1
+            MockHandler.do_POST(self)
+        handler = type("Handler", (MockHandler,), {"posts": 0, "prefix_cache": PrefixCache(), "do_POST": do_POST, **attrs})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}", handler
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
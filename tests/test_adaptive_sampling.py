@@ -0,0 +1,102 @@
+import json
+import random
+import threading
+import time
+
+from rejection_sampling import run_adaptive_sampling
+from utils.mock_server import MockHandler
+from utils.scheduler import ShardScheduler
+
+
+QUERIES = [f"Write a short poem about topic {i}." for i in range(4)]
+
+
+def write_data(tmp_path):
+    path = tmp_path / "data.jsonl"
+    path.write_text("".join(json.dumps({"query": query, "eval question": ["Is the response a poem?"], "history": []}) + "\n" for query in QUERIES))
+    return str(path)
+
+
+def read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_sft(tmp_path, mock_server):
+    url, gen = mock_server()
+    judge_url, judge = mock_server(pass_rate=1.0)
+    save_path = str(tmp_path / "sft.jsonl")
+    run_adaptive_sampling(write_data(tmp_path), save_path, url, judge_url=judge_url, mode="sft", wave_size=2, max_budget=6, num_workers=4)
+    records = read(save_path)
+    assert sorted(record["instruction"] for record in records) == QUERIES
+    assert all(record["output"].startswith("mock response") and record["history"] == [] for record in records)
+    # every response passes, so one wave per query
+    assert gen.posts == len(QUERIES) and judge.posts == 2 * len(QUERIES)
+
+
+def test_sft_spends_the_budget_when_nothing_passes(tmp_path, mock_server):
+    url, gen = mock_server(pass_rate=0.0)
+    save_path = str(tmp_path / "sft.jsonl")
+    run_adaptive_sampling(write_data(tmp_path), save_path, url, mode="sft", wave_size=2, max_budget=6, num_workers=4)
+    # the last response is kept when none passed
+    assert len(read(save_path)) == len(QUERIES)
+    assert gen.posts == len(QUERIES) * (3 + 6)
+
+
+def test_dpo(tmp_path, mock_server):
+    random.seed(0)
+    url, _ = mock_server(pass_rate=0.5)
+    save_path = str(tmp_path / "dpo.jsonl")
+    run_adaptive_sampling(write_data(tmp_path), save_path, url, mode="dpo", wave_size=2, max_budget=10, num_workers=1)
+    records = read(save_path)
+    assert records and {record["prompt"] for record in records} <= set(QUERIES)
+    assert all(record["chosen"] != record["rejected"] for record in records)
+
+
+def test_escalation(tmp_path, mock_server):
+    # the small score-only judge says NO to everything, the large judge YES; every verdict is below
+    # the threshold, so every response is escalated and passes
+    url, gen = mock_server()
+    judge_url, judge = mock_server(pass_rate=0.0)
+    escalate_url, escalate = mock_server(pass_rate=1.0)
+    save_path = str(tmp_path / "sft.jsonl")
+    run_adaptive_sampling(write_data(tmp_path), save_path, url, judge_url=judge_url, mode="sft", wave_size=2, max_budget=6, num_workers=4,
+                          score_only=True, escalate_url=escalate_url, threshold=1.01)
+    assert len(read(save_path)) == len(QUERIES)
+    assert gen.posts == len(QUERIES)
+    assert judge.posts == escalate.posts == 2 * len(QUERIES)
+
+
+def slow_completion(self, body):
+    time.sleep(0.05)
+    return MockHandler._completion(self, body)
+
+
+def test_lease_outlives_a_long_wave(tmp_path, mock_server):
+    # one chunk of all the queries, read in a single executor.map wave that runs for several leases
+    lease = 0.3
+    data_path = write_data(tmp_path)
+    a, b = (ShardScheduler(str(tmp_path / "work"), data_path, chunk_size=len(QUERIES), lease_seconds=lease, worker=worker) for worker in "ab")
+    url, gen = mock_server(pass_rate=0.0, _completion=slow_completion)
+    stolen, stop = [], threading.Event()
+
+    def steal():
+        while not stop.wait(0.05):
+            chunk = b.acquire()
+            if chunk is not None:
+                stolen.append(chunk)
+
+    thread = threading.Thread(target=steal, daemon=True)
+    chunk = a.acquire()
+    start = time.time()
+    thread.start()
+    try:
+        with a.heartbeat(chunk):
+            run_adaptive_sampling(data_path, str(tmp_path / "sft.jsonl"), url, mode="sft", wave_size=2, max_budget=6, index=chunk, num_workers=1)
+    finally:
+        stop.set()
+        thread.join()
+    assert time.time() - start > 3 * lease
+    assert stolen == []
+    assert a.complete(chunk)
+    assert len(read(str(tmp_path / "sft.jsonl"))) == len(QUERIES)
@@ -0,0 +1,60 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+from utils.schemas import AUGMENTED_SCHEMA
+
+
+class SamplingParams:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+class GuidedDecodingParams:
+    def __init__(self, json=None):
+        self.json = json
+
+
+class LLM:
+    # records the sampling params instead of loading /model_path/UltraComposer
+    def __init__(self, **kwargs):
+        self.sampling_params = []
+
+    def generate(self, prompts, sampling_params, use_tqdm=False):
+        self.sampling_params.append(sampling_params)
+        completion = types.SimpleNamespace(text='{"augmented query": "q", "question": ["Is it short?"]}')
+        return [types.SimpleNamespace(outputs=[completion]) for _ in prompts]
+
+
+@pytest.fixture
+def augment_query(monkeypatch):
+    # the module loads the model at import time; the model stack is replaced for the import
+    vllm = types.ModuleType("vllm")
+    vllm.LLM, vllm.SamplingParams = LLM, SamplingParams
+    sampling_params = types.ModuleType("vllm.sampling_params")
+    sampling_params.GuidedDecodingParams = GuidedDecodingParams
+    transformers = types.ModuleType("transformers")
+    transformers.AutoTokenizer = types.SimpleNamespace(from_pretrained=lambda path: None)
+    torch = types.ModuleType("torch")
+    torch.cuda = types.SimpleNamespace(device_count=lambda: 1)
+    modules = {"vllm": vllm, "vllm.sampling_params": sampling_params, "transformers": transformers, "torch": torch}
+    for name in ("openai", "pandas"):
+        modules[name] = sys.modules.get(name) or types.ModuleType(name)
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, "augment_query", raising=False)
+    return importlib.import_module("augment_query")
+
+
+def test_sampling_params_are_guided(augment_query):
+    augment_query.generate_sample_batch(["prompt"])
+    params = augment_query.llm.sampling_params[-1].kwargs
+    assert params["guided_decoding"].json == AUGMENTED_SCHEMA
+
+
+def test_guided_flag_off(augment_query, monkeypatch):
+    monkeypatch.setattr(augment_query, "guided", False)
+    augment_query.generate_sample_batch(["prompt"])
+    assert "guided_decoding" not in augment_query.llm.sampling_params[-1].kwargs
@@ -0,0 +1,35 @@
+import pytest
+
+from rejection_sampling import check_cascade, combine_verdicts, escalation_reason, judge_passed, verdict_confidence
+from utils.json_extract import parse_tool
+
+
+DATA = {"eval question": ["Does the response use bullet points?", "Is the tone friendly?"]}
+
+
+def test_score_only_verdict_without_confidence_escalates():
+    verdict = {"Question 1": {"score": "YES", "confidence": 0.97}, "Question 2": {"score": "YES"}}
+    assert verdict_confidence(verdict) == 0.0
+    assert escalation_reason(DATA, "q-0", verdict, 0.9) == "low"
+
+
+def test_rule_verdicts_are_confident_and_sampled_for_calibration():
+    verdict = combine_verdicts({0: True, 1: False}, [], None)
+    assert verdict_confidence(verdict) == 1.0
+    assert escalation_reason(DATA, "q-0", verdict, 0.9) is None
+    assert escalation_reason(DATA, "q-0", verdict, 0.9, calibrate_fraction=1.0) == "calibration"
+
+
+def test_cascade_needs_score_only():
+    with pytest.raises(ValueError):
+        check_cascade(False)
+    check_cascade(True)
+
+
+def test_judge_passed_needs_yes_or_no():
+    assert judge_passed({"Question 1": {"score": "YES"}, "Question 2": {"score": "no"}}, 2) is False
+    assert judge_passed({"Question 1": {"score": "YES"}, "Question 2": {"score": "N"}}, 2) is None
+    # cut off inside the score of the last question
+    truncated = parse_tool('{"Question 1": {"score": "YES"}, "Question 2": {"explanation": "Four bullets.", "score": "N')
+    assert judge_passed(truncated, 2) is None
+    assert judge_passed({"Question 1": {"score": "YES"}, "Question 2": {"score": "YES"}}, 2) is True
@@ -0,0 +1,76 @@
+import multiprocessing
+import sqlite3
+
+from utils.completion_cache import CompletionCache
+
+
+def body(i, temperature=0):
+    return {"model": "m", "messages": [{"role": "user", "content": f"q{i}"}], "temperature": temperature}
+
+
+def answer(i):
+    return {"choices": [{"index": 0, "message": {"role": "assistant", "content": f"a{i}" * 10}, "finish_reason": "stop"}]}
+
+
+def test_hit_and_miss(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get(body(0)) is None
+    cache.put(body(0), answer(0))
+    assert cache.get(body(0)) == answer(0)
+    # sampled requests are neither stored nor answered
+    cache.put(body(1, temperature=0.7), answer(1))
+    assert cache.get(body(1, temperature=0.7)) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    size = len('{"choices": [{"index": 0, "message": {"role": "assistant", "content": "' + "a0" * 10 + '"}, "finish_reason": "stop"}]}')
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"), max_bytes=int(size * 3.5))
+    for i in range(3):
+        cache.put(body(i), answer(i))
+    # q0 is used again, so q1 is the least recently used entry
+    assert cache.get(body(0)) is not None
+    cache.put(body(3), answer(3))
+    assert cache.get(body(1)) is None
+    assert all(cache.get(body(i)) is not None for i in (0, 3))
+    assert cache.total_bytes <= cache.max_bytes * 0.9
+    cache.close()
+
+
+def put_in_other_process(path, queue):
+    cache = CompletionCache(path)
+    try:
+        cache.put(body(1), answer(1))
+        queue.put(cache.get(body(0)))
+    except sqlite3.OperationalError as e:
+        queue.put(str(e))
+    cache.close()
+
+
+def test_reads_do_not_lock_other_processes(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = CompletionCache(path)
+    cache.put(body(0), answer(0))
+    # a stage that only reads, while another process stores results
+    assert cache.get(body(0)) == answer(0)
+    queue = multiprocessing.get_context("spawn").Queue()
+    process = multiprocessing.get_context("spawn").Process(target=put_in_other_process, args=(path, queue))
+    process.start()
+    process.join(60)
+    assert queue.get(timeout=1) == answer(0)
+    assert cache.get(body(1)) == answer(1)
+    cache.report("test")
+    cache.close()
+
+
+def test_access_times_are_written(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = CompletionCache(path)
+    cache.put(body(0), answer(0))
+    before = sqlite3.connect(path).execute("SELECT accessed FROM completions").fetchone()[0]
+    cache.get(body(0))
+    cache.report("test")
+    after = sqlite3.connect(path).execute("SELECT accessed FROM completions").fetchone()[0]
+    assert after > before
+    cache.close()
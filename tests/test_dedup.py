@@ -0,0 +1,49 @@
+import json
+
+import numpy as np
+
+from utils.dedup import dedup, expand_results, guard_key, representatives
+
+
+BASE = ("Write a detailed blog post about the history of the Roman Empire, covering its rise, its most famous "
+        "emperors, the wars it fought along its borders and the reasons for its slow decline and fall. ")
+
+
+def test_guard_key():
+    assert guard_key("Use exactly 3 paragraphs") != guard_key("Use exactly 5 paragraphs")
+    assert guard_key("Answer in French") != guard_key("Answer in Spanish")
+    assert guard_key("Answer in  FRENCH") == guard_key("answer in french")
+
+
+def test_representatives_are_not_transitive():
+    # 1 ~ 0, 2 ~ 1 but 2 !~ 0: 2 is compared with 0, the record 1 is dropped for, and kept
+    similar = {(0, 1), (1, 2)}
+
+    def same(u, v):
+        return np.array([(min(a, b), max(a, b)) in similar for a, b in zip(u, v)], dtype=bool)
+
+    assert representatives(3, np.array([0, 1]), np.array([1, 2]), same).tolist() == [0, 0, 2]
+
+
+def test_dedup(tmp_path):
+    queries = [
+        BASE + "Use exactly 3 paragraphs.",
+        BASE + "Use exactly 5 paragraphs.",
+        BASE + "Answer in under 100 words.",
+        BASE + "Answer in French.",
+        BASE.upper() + "Use  exactly 3 paragraphs.",
+        BASE + "Use exactly 3 paragraphs!",
+    ]
+    data_path = tmp_path / "data.jsonl"
+    data_path.write_text("".join(json.dumps({"query": query}) + "\n" for query in queries))
+    save_path = str(tmp_path / "dedup.jsonl")
+    assert dedup(str(data_path), save_path, workers=1) == 2
+    with open(save_path) as f:
+        assert [json.loads(line)["query"] for line in f] == queries[:4]
+    with open(save_path + ".clusters") as f:
+        clusters = [json.loads(line) for line in f]
+    assert len(clusters) == 2 and len({cluster["representative"] for cluster in clusters}) == 1
+
+    results_path = tmp_path / "output.jsonl"
+    results_path.write_text(json.dumps({"custom_id": clusters[0]["representative"], "response": None, "error": None}) + "\n")
+    assert expand_results(save_path + ".clusters", str(results_path), str(tmp_path / "expanded.jsonl")) == 2
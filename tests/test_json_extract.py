@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+from utils.json_extract import extract_json, parse_augmented, parse_tool
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils", "json_extract_corpus.jsonl")
+
+with open(CORPUS, "r", encoding="utf-8") as f:
+    cases = [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.mark.parametrize("case", cases, ids=[json.dumps(case["text"])[:40] for case in cases])
+def test_corpus(case):
+    assert parse_tool(case["text"]) == case["expected"]
+
+
+@pytest.mark.parametrize("text", ["{", "[", "```json\n{", "{\n   ", "no json here", ""])
+def test_nothing_recovered(text):
+    assert extract_json(text) is None
+
+
+def test_truncated_keeps_complete_members():
+    # a value cut off at the end is dropped with its member, it may be the prefix of another one
+    assert extract_json('{"a": 1, "b": "tw') == {"a": 1}
+    assert extract_json('{"a": 1, "b": 12') == {"a": 1}
+    assert extract_json('{"a": 1, "b": "two"') == {"a": 1, "b": "two"}
+    assert extract_json('{"explanation": "cut') is None
+
+
+def test_truncated_no_is_not_a_score():
+    verdict = parse_tool('{"Question 1": {"explanation": "The response has four bullets.", "score": "N')
+    assert verdict == {"Question 1": {"explanation": "The response has four bullets."}}
+
+
+def test_unescaped_quote_followed_by_comma():
+    assert extract_json('{"q": "use "x", and y"}') == {"q": 'use "x", and y'}
+    assert extract_json('{"q": "use "x", "r": 1}') == {"q": 'use "x', "r": 1}
+    assert extract_json('["a "b", c", "d"]') == ['a "b", c', "d"]
+
+
+def test_first_of_two_values():
+    assert extract_json('{"a": 1} and {"b": 2}') == {"a": 1}
+
+
+def test_parse_augmented_wraps_question():
+    result, dumped = parse_augmented('```json\n{"augmented query": "q", "question": "Is it short?"}\n```')
+    assert result == {"augmented query": "q", "question": ["Is it short?"]}
+    assert json.loads(dumped) == result
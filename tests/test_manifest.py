@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from utils.manifest import StageManifest, record_rewrite, truncate_partial_line
+
+
+@pytest.fixture
+def paths(tmp_path):
+    data = tmp_path / "data.jsonl"
+    data.write_text("".join(json.dumps({"i": i}) + "\n" for i in range(5)))
+    return str(data), str(tmp_path / "out.jsonl")
+
+
+def write_records(manifest, output, records):
+    with manifest.open(output) as f:
+        for i in records:
+            f.write(json.dumps({"i": i}) + "\n")
+
+
+def test_resume_truncates_to_checkpoint(paths):
+    data, output = paths
+    manifest = StageManifest(data, output, params={"stage": "test"})
+    write_records(manifest, output, range(2))
+    manifest.checkpoint(2)
+    # written after the checkpoint, then the run died mid-line
+    write_records(manifest, output, [2])
+    with open(output, "a") as f:
+        f.write('{"i": 3')
+
+    manifest = StageManifest(data, output, params={"stage": "test"})
+    assert manifest.completed == 2 and not manifest.finished
+    with open(output) as f:
+        assert [json.loads(line)["i"] for line in f] == [0, 1]
+    write_records(manifest, output, range(2, 5))
+    manifest.checkpoint(5)
+    manifest.finish()
+    assert StageManifest(data, output, params={"stage": "test"}).finished
+
+
+def test_changed_inputs_or_params_are_refused(paths):
+    data, output = paths
+    manifest = StageManifest(data, output, params={"stage": "test"})
+    write_records(manifest, output, range(2))
+    manifest.checkpoint(2)
+    with pytest.raises(RuntimeError):
+        StageManifest(data, output, params={"stage": "other"})
+    with open(data, "a") as f:
+        f.write(json.dumps({"i": 5}) + "\n")
+    with pytest.raises(RuntimeError):
+        StageManifest(data, output, params={"stage": "test"})
+    # a fresh run empties the outputs
+    manifest = StageManifest(data, output, params={"stage": "test"}, resume=False)
+    assert manifest.completed == 0
+    with open(output) as f:
+        assert f.read() == ""
+
+
+def test_truncate_partial_line(tmp_path):
+    path = tmp_path / "out.jsonl"
+    path.write_text('{"i": 0}\n{"i": 1}\n{"i": ')
+    truncate_partial_line(str(path))
+    assert path.read_text() == '{"i": 0}\n{"i": 1}\n'
+    truncate_partial_line(str(path))
+    assert path.read_text() == '{"i": 0}\n{"i": 1}\n'
+
+
+def test_record_rewrite(paths):
+    data, output = paths
+    manifest = StageManifest(data, output)
+    write_records(manifest, output, range(5))
+    manifest.checkpoint(5)
+    manifest.finish()
+    # rewritten in place with longer records
+    with open(output, "w") as f:
+        f.write("".join(json.dumps({"i": i, "repaired": True}) + "\n" for i in range(5)))
+    record_rewrite(output)
+    StageManifest(data, output)
+    with open(output) as f:
+        assert all(json.loads(line)["repaired"] for line in f)
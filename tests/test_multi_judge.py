@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import rejection_sampling
+from rejection_sampling import build_judge_body, collect_verdicts, plan_judging
+from utils.json_extract import parse_tool
+from utils.online_client import OpenAIClient
+
+
+DATA = {"query": "List three French cities.", "eval question": ["Does the response use bullet points?", "Is the tone friendly?", "Are the cities in France?"]}
+SAMPLES = [(f"q-{i}", f"- Paris\n- Lyon\n- Nice {i}") for i in range(3)]
+
+
+def ask(url, data, samples, **flags):
+    decided, requests = plan_judging(data, samples, multi_judge=True, **flags)
+    client = OpenAIClient(url)
+    outputs = {judge_id: client.post(build_judge_body(data, group, indices, score)) for judge_id, group, indices, score in requests}
+    return decided, requests, outputs, collect_verdicts(data, decided, requests, outputs)
+
+
+def test_matrix_is_split_per_response(mock_server):
+    url, server = mock_server(pass_rate=0.5)
+    _, requests, outputs, verdicts = ask(url, DATA, SAMPLES)
+    assert [judge_id for judge_id, _, _, _ in requests] == ["q-0-x3"] and server.posts == 1
+    matrix = parse_tool(outputs["q-0-x3"]["choices"][0]["message"]["content"])
+    for r, (custom_id, _) in enumerate(SAMPLES, start=1):
+        assert verdicts[custom_id] == matrix[f"Response {r}"]
+
+
+def test_rule_verdicts_keep_the_original_numbering(mock_server):
+    # the bullet question is decided locally for every response, the judge is asked about 2 and 3 only
+    url, _ = mock_server(pass_rate=0.5)
+    decided, requests, outputs, verdicts = ask(url, DATA, SAMPLES, rule_verify=True)
+    assert requests[0][2] == [1, 2]
+    matrix = parse_tool(outputs[requests[0][0]]["choices"][0]["message"]["content"])
+    for r, (custom_id, _) in enumerate(SAMPLES, start=1):
+        assert verdicts[custom_id]["Question 1"]["score"] == "YES"
+        assert verdicts[custom_id]["Question 2"] == matrix[f"Response {r}"]["Question 1"]
+        assert verdicts[custom_id]["Question 3"] == matrix[f"Response {r}"]["Question 2"]
+
+
+def test_missing_row_fails_only_its_response():
+    decided, requests = plan_judging(DATA, SAMPLES, multi_judge=True)
+    row = {f"Question {q}": {"explanation": "", "score": "YES"} for q in range(1, 4)}
+    content = json.dumps({"Response 1": row, "Response 3": row})
+    outputs = {requests[0][0]: {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]}}
+    verdicts = collect_verdicts(DATA, decided, requests, outputs)
+    assert verdicts["q-0"] == row and verdicts["q-2"] == row
+    assert verdicts["q-1"] is None
+
+
+def test_groups_are_split_to_fit_the_context(mock_server, monkeypatch):
+    # room for two responses per prompt
+    body = build_judge_body(DATA, SAMPLES[:2], [0, 1, 2])
+    monkeypatch.setattr(rejection_sampling, "judge_context_tokens", len(body["messages"][0]["content"]) // 4 + 60 * 6 + 1)
+    url, server = mock_server(pass_rate=0.5)
+    _, requests, outputs, verdicts = ask(url, DATA, SAMPLES)
+    assert [judge_id for judge_id, _, _, _ in requests] == ["q-0-x2", "q-2"]
+    assert server.posts == 2
+    matrix = parse_tool(outputs["q-0-x2"]["choices"][0]["message"]["content"])
+    single = parse_tool(outputs["q-2"]["choices"][0]["message"]["content"])
+    assert verdicts == {"q-0": matrix["Response 1"], "q-1": matrix["Response 2"], "q-2": single}
@@ -0,0 +1,40 @@
+import json
+import os
+
+import yaml
+
+from utils import pipeline
+from utils.pipeline import Pipeline
+
+
+def make_repo(tmp_path, monkeypatch):
+    # a stage script importing a utils module, in a repo root of its own
+    root = tmp_path / "repo"
+    (root / "utils").mkdir(parents=True)
+    (root / "utils" / "helper.py").write_text("def double(x):\n    return 2 * x\n")
+    (root / "stage.py").write_text("def main(data_path):\n    from utils.helper import double\n")
+    monkeypatch.setattr(pipeline, "ROOT", str(root))
+    source = tmp_path / "source.jsonl"
+    source.write_text("".join(json.dumps({"query": f"q{i}"}) + "\n" for i in range(3)))
+    config = {"work_dir": str(tmp_path / "work"), "sources": {"s": str(source)},
+              "stages": {"stage": {"call": "stage.py:main", "args": {"data_path": "{source}"}, "outputs": ["out.jsonl"]}}}
+    config_path = tmp_path / "pipeline.yaml"
+    config_path.write_text(yaml.safe_dump(config))
+    return root, str(config_path)
+
+
+def test_key_hashes_imported_modules(tmp_path, monkeypatch):
+    root, config_path = make_repo(tmp_path, monkeypatch)
+    p = Pipeline(config_path)
+    stage = p.stages["stage"]
+    assert p.code_paths(stage) == sorted([str(root / "stage.py"), str(root / "utils" / "helper.py")])
+    key = p.key("stage", "s")
+    (root / "utils" / "helper.py").write_text("def double(x):\n    return x + x\n")
+    assert Pipeline(config_path).key("stage", "s") != key
+
+
+def test_dry_run_writes_nothing(tmp_path, monkeypatch):
+    _, config_path = make_repo(tmp_path, monkeypatch)
+    planned = Pipeline(config_path).run(dry_run=True)
+    assert [(name, action) for name, _, action, _ in planned] == [("stage", "run")]
+    assert not os.path.exists(tmp_path / "work")
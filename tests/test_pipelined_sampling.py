@@ -0,0 +1,100 @@
+import hashlib
+import json
+import random
+import threading
+
+import pytest
+
+import rejection_sampling
+from rejection_sampling import merge_query_with_response_stream, run_pipelined_sampling, run_reevaluation_data, run_resampling_data
+from utils.manifest import StageManifest
+from utils.mock_server import MockHandler
+from utils.online_client import run_batch_online
+
+
+LOCK = threading.Lock()
+
+
+def deterministic_completion(self, body):
+    # the mock server's answers, but a function of the prompt: the i-th choice of a generation request
+    # and the verdicts for one judge prompt are the same on both paths
+    prompt = body["messages"][-1]["content"]
+    self.calls = getattr(self, "calls", 0) + 1
+    key = f"{prompt}\x00{self.calls}"
+    if "[Evaluator Question]" not in prompt:
+        return "mock response " + hashlib.sha1(key.encode()).hexdigest()[:8], None
+    with LOCK:
+        random.seed(key)
+        return MockHandler._completion(self, body)
+
+
+def write_data(tmp_path):
+    path = tmp_path / "data.jsonl"
+    records = [{"query": f"Write a short poem about topic {i}.", "eval question": ["Is the response a poem?", "Is the tone friendly?"], "history": []}
+               for i in range(6)]
+    # a repeated query is skipped on both paths
+    records.append(records[0])
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    return str(path)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("flags", [{}, {"multi_judge": True}, {"score_only": True}, {"multi_judge": True, "score_only": True}],
+                         ids=["per-response", "multi-judge", "score-only", "multi-score-only"])
+def test_pipelined_equals_staged(tmp_path, mock_server, flags):
+    url, _ = mock_server(pass_rate=0.6, _completion=deterministic_completion)
+    data = write_data(tmp_path)
+
+    staged = tmp_path / "staged"
+    staged.mkdir()
+    run_resampling_data(data, str(staged / "resample.jsonl"), n_sampling=True)
+    run_batch_online(str(staged / "resample.jsonl"), str(staged / "responses.jsonl"), url)
+    run_reevaluation_data(data, str(staged / "responses.jsonl"), str(staged / "evaluate.jsonl"), n_sampling=True, **flags)
+    run_batch_online(str(staged / "evaluate.jsonl"), str(staged / "verdicts.jsonl"), url)
+    merge_query_with_response_stream(data, str(staged / "responses.jsonl"), str(staged / "verdicts.jsonl"), str(staged / "sft.jsonl"),
+                                     str(staged / "dpo.jsonl"), n_sampling=True, **flags)
+
+    pipelined = tmp_path / "pipelined"
+    pipelined.mkdir()
+    run_pipelined_sampling(data, str(pipelined / "responses.jsonl"), str(pipelined / "verdicts.jsonl"), url, url,
+                           gen_concurrency=4, judge_concurrency=4, queue_size=4, **flags)
+    merge_query_with_response_stream(data, str(pipelined / "responses.jsonl"), str(pipelined / "verdicts.jsonl"), str(pipelined / "sft.jsonl"),
+                                     str(pipelined / "dpo.jsonl"), n_sampling=True, **flags)
+
+    assert len(read(staged / "sft.jsonl").splitlines()) == 6
+    assert read(pipelined / "sft.jsonl") == read(staged / "sft.jsonl")
+    assert read(pipelined / "dpo.jsonl") == read(staged / "dpo.jsonl")
+
+
+def test_merge_closes_its_files_on_error(tmp_path, monkeypatch):
+    data = write_data(tmp_path)
+    (tmp_path / "responses.jsonl").write_text("")
+    (tmp_path / "verdicts.jsonl").write_text("")
+    readers, files = [], []
+    open_output = StageManifest.open
+
+    class Reader(rejection_sampling.CustomIdReader):
+        def __init__(self, path):
+            super().__init__(path)
+            readers.append(self)
+
+    def manifest_open(self, path):
+        files.append(open_output(self, path))
+        return files[-1]
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("judge output")
+
+    monkeypatch.setattr(rejection_sampling, "CustomIdReader", Reader)
+    monkeypatch.setattr(StageManifest, "open", manifest_open)
+    monkeypatch.setattr(rejection_sampling, "read_verdicts", fail)
+    with pytest.raises(RuntimeError):
+        merge_query_with_response_stream(data, str(tmp_path / "responses.jsonl"), str(tmp_path / "verdicts.jsonl"), str(tmp_path / "sft.jsonl"),
+                                         str(tmp_path / "dpo.jsonl"), n_sampling=True)
+    assert len(readers) == 2 and len(files) == 2
+    assert all(f.closed for reader in readers for f in reader._files)
+    assert all(f.closed for f in files)
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from utils.projection import _fast, project
+from utils.stream_join import CustomIdReader, get_contents
+
+
+FIELDS = ("custom_id", "status_code", "contents", "finish_reasons", "usage")
+LOGPROBS = {"content": [{"token": "YES", "logprob": -0.01, "top_logprobs": [{"token": "YES", "logprob": -0.01}, {"token": "NO", "logprob": -4.6}]}]}
+USAGE = {"prompt_tokens": 10, "completion_tokens": 4, "total_tokens": 14}
+
+
+def choice(index, content, finish_reason="stop", logprobs=None):
+    return {"index": index, "message": {"role": "assistant", "content": content}, "logprobs": logprobs, "finish_reason": finish_reason}
+
+
+def line(custom_id, choices, status_code=200):
+    return {"id": "batch_req_1", "custom_id": custom_id,
+            "response": {"status_code": status_code, "request_id": "r", "body": {"choices": choices, "usage": USAGE}}, "error": None}
+
+
+def cases(logprobs):
+    lp = LOGPROBS if logprobs else None
+    reordered = {"response": {"body": {"usage": USAGE, "choices": [
+        {"finish_reason": "length", "message": {"content": "a", "role": "assistant"}, "logprobs": lp, "index": 0}]}, "status_code": 200},
+        "custom_id": "reordered", "error": None}
+    missing_finish = line("missing-finish", [choice(0, "a", logprobs=lp), choice(1, "b", logprobs=lp)])
+    del missing_finish["response"]["body"]["choices"][0]["finish_reason"]
+    return {
+        "plain": line("plain", [choice(0, "YES", logprobs=lp), choice(1, "NO", logprobs=lp)]),
+        "reordered keys": reordered,
+        "unordered choices": line("unordered", [choice(1, "second", logprobs=lp), choice(0, "first", logprobs=lp)]),
+        "missing finish_reason": missing_finish,
+        "escaped keys in content": line("escaped", [choice(0, '{"message": {"content": "x"}, "finish_reason": "stop", "custom_id": "y"}', logprobs=lp)]),
+        "error line": {"id": "batch_req_2", "custom_id": "error", "response": None, "error": {"code": "TimeoutError", "message": "timed out"}},
+        "server error": line("server-error", [], status_code=500),
+    }
+
+
+def parsed(record):
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    choices = sorted(body.get("choices") or [], key=lambda c: c.get("index", 0))
+    return (record["custom_id"], response.get("status_code"), get_contents(record),
+            [c.get("finish_reason") for c in choices], body.get("usage"))
+
+
+@pytest.mark.parametrize("logprobs", [False, True])
+@pytest.mark.parametrize("name", list(cases(False)))
+def test_project_matches_full_parse(name, logprobs):
+    record = cases(logprobs)[name]
+    raw = json.dumps(record).encode("utf-8")
+    assert project(raw, FIELDS) == parsed(record)
+
+
+def test_scanner_handles_plain_logprob_lines():
+    # the cases the scanner can read are read without the full parse fallback
+    raw = json.dumps(cases(True)["plain"])
+    assert _fast(raw) == ("plain", ["YES", "NO"], ["stop", "stop"], USAGE, 200)
+    assert _fast(json.dumps(cases(True)["missing finish_reason"])) is None
+
+
+def test_take_contents(tmp_path):
+    path = tmp_path / "output.jsonl"
+    records = list(cases(False).values()) + [dict(cases(True)["plain"], custom_id="logprobs")]
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    with CustomIdReader(str(path)) as reader:
+        for record in records:
+            assert reader.take_contents(record["custom_id"]) == get_contents(record)
+        assert reader.take_contents("absent") == []
@@ -0,0 +1,58 @@
+import json
+
+from utils.jsonl_io import iter_jsonl
+from utils.online_client import to_batch_output
+from utils.repair import collect_failures, failure_reason, merge_repairs
+
+
+def request(custom_id):
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+            "body": {"messages": [{"role": "user", "content": custom_id}], "max_tokens": 100, "temperature": 0}}
+
+
+def output(custom_id, content, finish_reason="stop"):
+    return to_batch_output(custom_id, body={"choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}]})
+
+
+def write(path, records):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    return str(path)
+
+
+def test_collect_and_merge(tmp_path):
+    requests = write(tmp_path / "requests.jsonl", [request(c) for c in "abcde"])
+    outputs = write(tmp_path / "output.jsonl", [
+        output("a", '{"question": "Is it short?"}'),
+        output("b", '{"question": "Is it', finish_reason="length"),
+        output("c", "no json here"),
+        output("d", '{"answer": "wrong key"}'),
+    ])
+    repair = str(tmp_path / "repair.jsonl")
+    reasons = collect_failures(requests, outputs, repair, "generate_eval_ques", temperature=0.7)
+    assert reasons == {"truncated": 1, "invalid_json": 1, "schema_mismatch": 1, "missing": 1}
+    repairs = {r["custom_id"]: r["body"] for r in iter_jsonl(repair)}
+    assert sorted(repairs) == ["b", "c", "d", "e"]
+    assert repairs["b"]["max_tokens"] == 200 and repairs["b"]["temperature"] == 0
+    assert repairs["c"]["temperature"] == 0.7 and repairs["e"]["temperature"] == 0
+
+    # b, c and e come back fine, d fails again
+    repair_output = write(tmp_path / "repair_output.jsonl", [
+        output("e", '{"question": "Is it e?"}'),
+        output("b", '{"question": "Is it b?"}'),
+        output("c", '{"question": "Is it c?"}'),
+        output("d", "still no json"),
+    ])
+    merge_repairs(outputs, repair, repair_output, "generate_eval_ques")
+    merged = list(iter_jsonl(outputs))
+    assert [r["custom_id"] for r in merged] == ["a", "b", "c", "d", "e"]
+    contents = [r["response"]["body"]["choices"][0]["message"]["content"] for r in merged]
+    assert contents == ['{"question": "Is it short?"}', '{"question": "Is it b?"}', '{"question": "Is it c?"}',
+                        '{"answer": "wrong key"}', '{"question": "Is it e?"}']
+
+
+def test_judge_scores_must_be_yes_or_no():
+    body = request("a")["body"]
+    assert failure_reason(output("a", '{"Question 1": {"explanation": "ok", "score": "YES"}}'), body, "judge") is None
+    assert failure_reason(output("a", '{"Question 1": {"explanation": "ok", "score": "N"}}'), body, "judge") == "schema_mismatch"
+    multi = '{"Response 1": {"Question 1": {"score": "NO"}}, "Response 2": {"Question 1": {"score": "maybe"}}}'
+    assert failure_reason(output("a", multi), body, "judge") == "schema_mismatch"
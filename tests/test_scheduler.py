@@ -0,0 +1,74 @@
+import json
+import time
+
+import pytest
+
+from utils.manifest import StageManifest
+from utils.scheduler import LeaseLost, ShardScheduler, progress
+
+
+LEASE = 0.3
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    path = tmp_path / "data.jsonl"
+    path.write_text("".join(json.dumps({"i": i}) + "\n" for i in range(10)))
+    return str(path)
+
+
+def scheduler(tmp_path, data_path, worker):
+    return ShardScheduler(str(tmp_path / "work"), data_path, chunk_size=4, lease_seconds=LEASE, worker=worker, poll_seconds=0.05)
+
+
+def test_plan(tmp_path, data_path):
+    chunks = scheduler(tmp_path, data_path, "a").chunks
+    assert [(chunk.start, chunk.end) for chunk in chunks] == [(0, 4), (4, 8), (8, 10)]
+    with open(data_path, "a") as f:
+        f.write(json.dumps({"i": 10}) + "\n")
+    with pytest.raises(RuntimeError):
+        scheduler(tmp_path, data_path, "b")
+
+
+def test_expired_lease_is_reclaimed(tmp_path, data_path):
+    a, b = scheduler(tmp_path, data_path, "a"), scheduler(tmp_path, data_path, "b")
+    chunk = a.acquire()
+    assert b.acquire().id != chunk.id
+    time.sleep(LEASE * 1.5)
+    assert b.acquire().id == chunk.id
+    # the first owner finishing late leaves the chunk to the new one
+    assert not a.complete(chunk)
+    assert b.complete(chunk)
+    assert a.status()["done"] == 1
+
+
+def test_progress_keeps_the_lease(tmp_path, data_path):
+    a, b = scheduler(tmp_path, data_path, "a"), scheduler(tmp_path, data_path, "b")
+    chunk = a.acquire()
+    with a.heartbeat(chunk):
+        deadline = time.time() + LEASE * 2
+        while time.time() < deadline:
+            progress(chunk)
+            time.sleep(0.01)
+        assert b.acquire().id != chunk.id
+
+
+def test_hung_worker_loses_its_lease(tmp_path, data_path):
+    a, b = scheduler(tmp_path, data_path, "a"), scheduler(tmp_path, data_path, "b")
+    chunk = a.acquire()
+    manifest = StageManifest(data_path, str(tmp_path / "out.jsonl"))
+    with a.heartbeat(chunk):
+        # no progress: the heartbeat stops renewing and another worker takes the chunk over
+        time.sleep(LEASE * 1.5)
+        assert b.acquire().id == chunk.id
+        with pytest.raises(LeaseLost):
+            manifest.checkpoint(1)
+        with pytest.raises(LeaseLost):
+            progress(chunk)
+    assert manifest.completed == 0
+
+
+def test_run(tmp_path, data_path):
+    seen = []
+    assert scheduler(tmp_path, data_path, "a").run(lambda chunk: seen.extend(range(chunk.start, chunk.end))) == 3
+    assert seen == list(range(10))
@@ -0,0 +1,14 @@
+import pytest
+
+from utils.schemas import QUESTION_SCHEMA, for_backend, guided_json, guided_lines
+
+
+def test_for_backend():
+    body = {"messages": [], **guided_json(QUESTION_SCHEMA)}
+    assert for_backend(body, "vllm") == body
+    assert for_backend(body, "openai") == {"messages": [], "response_format": {"type": "json_schema", "json_schema": {"name": "output", "schema": QUESTION_SCHEMA}}}
+    assert for_backend(body, "none") == {"messages": []}
+    # regex-guided decoding only exists on vllm
+    assert for_backend({"messages": [], **guided_lines(["Question 1"])}, "openai") == {"messages": []}
+    with pytest.raises(ValueError):
+        for_backend(body, "sglang")
@@ -0,0 +1,98 @@
+import copy
+import math
+
+import pytest
+
+from rejection_sampling import build_judge_body, escalation_reason, parse_scores, verdict_confidence
+from utils.online_client import OpenAIClient
+
+
+DATA = {"query": "Write a haiku about rain.", "eval question": ["Is the response a haiku?", "Is it about rain?", "Is the tone calm?"]}
+
+
+def judge(url):
+    return OpenAIClient(url).post(build_judge_body(DATA, [("q-0", "Soft rain on the roof")], [0, 1, 2], score_only=True))
+
+
+def verdict_tokens(body):
+    return [token for token in body["choices"][0]["logprobs"]["content"] if token["token"].strip() in ("YES", "NO")]
+
+
+def body_of(*tokens):
+    # one "Question q: <token>" line per verdict token
+    content, logprobs = "", []
+    for q, token in enumerate(tokens, start=1):
+        logprobs += [{"token": f"Question {q}:", "logprob": 0.0}, token, {"token": "\n", "logprob": 0.0}]
+        content += f"Question {q}:{token['token']}\n"
+    return {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "logprobs": {"content": logprobs}}]}
+
+
+def test_confidence_from_the_mock_logprobs(mock_server):
+    url, _ = mock_server()
+    body = judge(url)
+    verdict = parse_scores(body)
+    assert list(verdict) == ["Question 1", "Question 2", "Question 3"]
+    for q, token in enumerate(verdict_tokens(body), start=1):
+        assert verdict[f"Question {q}"]["score"] == token["token"].strip()
+        # the mock splits the probability between the chosen verdict and the other one
+        assert verdict[f"Question {q}"]["confidence"] == pytest.approx(math.exp(token["logprob"]), abs=1e-4)
+        assert 0.55 <= verdict[f"Question {q}"]["confidence"] <= 1.0
+    assert verdict_confidence(verdict) == min(value["confidence"] for value in verdict.values())
+
+
+def test_threshold(mock_server):
+    url, _ = mock_server()
+    verdict = parse_scores(judge(url))
+    lowest = verdict_confidence(verdict)
+    assert escalation_reason(DATA, "q-0", verdict, threshold=lowest) is None
+    assert escalation_reason(DATA, "q-0", verdict, threshold=lowest + 1e-3) == "low"
+
+
+def test_missing_top_logprobs(mock_server):
+    # the chosen token is all there is: its own probability, not a certain 1.0
+    url, _ = mock_server()
+    body = judge(url)
+    for token in verdict_tokens(body):
+        token["logprob"] = math.log(0.6)
+        del token["top_logprobs"]
+    verdict = parse_scores(body)
+    assert [value["confidence"] for value in verdict.values()] == [0.6] * 3
+    assert escalation_reason(DATA, "q-0", verdict, threshold=0.9) == "low"
+    assert escalation_reason(DATA, "q-0", verdict, threshold=0.5) is None
+
+
+def test_no_logprobs(mock_server):
+    # a server that ignored `logprobs`: the scores are read, every verdict is escalated
+    url, _ = mock_server()
+    body = judge(url)
+    body["choices"][0]["logprobs"] = None
+    verdict = parse_scores(body)
+    assert all("confidence" not in value and value["score"] in ("YES", "NO") for value in verdict.values())
+    assert verdict_confidence(verdict) == 0.0
+    assert escalation_reason(DATA, "q-0", verdict, threshold=0.1) == "low"
+
+
+@pytest.mark.parametrize("token, confidence", [
+    # spellings of the same verdict are summed
+    ({"token": " YES", "logprob": math.log(0.5), "top_logprobs": [{"token": " YES", "logprob": math.log(0.5)}, {"token": "yes", "logprob": math.log(0.3)},
+                                                                  {"token": " No", "logprob": math.log(0.2)}]}, 0.8),
+    # other tokens do not count
+    ({"token": " NO", "logprob": math.log(0.6), "top_logprobs": [{"token": " NO", "logprob": math.log(0.6)}, {"token": " Maybe", "logprob": math.log(0.3)},
+                                                                 {"token": " YES", "logprob": math.log(0.1)}]}, 0.8571),
+    # only one verdict among the top logprobs
+    ({"token": " YES", "logprob": math.log(0.7), "top_logprobs": [{"token": " YES", "logprob": math.log(0.7)}, {"token": " Y", "logprob": math.log(0.2)}]}, 1.0),
+    # the sampled token is not among the top logprobs
+    ({"token": " NO", "logprob": math.log(0.2), "top_logprobs": [{"token": " YES", "logprob": math.log(0.6)}]}, 0.25),
+    # entries without a logprob are skipped
+    ({"token": " YES", "logprob": math.log(0.9), "top_logprobs": [{"token": " YES", "logprob": None}]}, 0.9),
+    ({"token": " YES", "logprob": None, "top_logprobs": []}, None),
+    ({"token": " YES", "logprob": float("-inf"), "top_logprobs": [{"token": " YES", "logprob": float("-inf")}]}, None),
+], ids=["spellings", "other-tokens", "one-verdict", "sampled-not-in-top", "null-top", "null-logprob", "zero-probability"])
+def test_odd_top_logprobs(token, confidence):
+    sure = {"token": " YES", "logprob": 0.0, "top_logprobs": [{"token": " YES", "logprob": 0.0}]}
+    verdict = parse_scores(body_of(copy.deepcopy(sure), token))
+    assert verdict["Question 1"] == {"score": "YES", "confidence": 1.0}
+    assert verdict["Question 2"]["score"] == token["token"].strip()
+    assert verdict["Question 2"].get("confidence") == confidence
+    # a verdict without a confidence counts as the least confident
+    assert verdict_confidence(verdict) == (0.0 if confidence is None else confidence)
@@ -0,0 +1,75 @@
+import json
+import random
+
+from utils.offset_index import OffsetIndex, build_index, load_index
+from utils.stream_join import CustomIdReader, get_content
+
+
+def result(custom_id, content):
+    return {"custom_id": custom_id, "response": {"body": {"choices": [{"index": 0, "message": {"content": content}}]}}, "error": None}
+
+
+def write(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    return str(path)
+
+
+def expected(paths):
+    # what reading every file into one dict gives: the last line of an id wins
+    lines = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                lines[record["custom_id"]] = get_content(record)
+    return lines
+
+
+def test_lockstep(tmp_path):
+    path = write(tmp_path / "out.jsonl", [result(f"r-{i}", f"a{i}") for i in range(20)])
+    with CustomIdReader(path) as reader:
+        assert [get_content(reader.take(f"r-{i}")) for i in range(20)] == [f"a{i}" for i in range(20)]
+        assert reader._lockstep
+        assert reader.take("r-99") is None
+        assert reader.missing == 1
+
+
+def test_out_of_order(tmp_path):
+    records = [result(f"r-{i}", f"a{i}") for i in range(50)]
+    random.Random(0).shuffle(records)
+    path = write(tmp_path / "out.jsonl", records)
+    with CustomIdReader(path) as reader:
+        assert {f"r-{i}": get_content(reader.take(f"r-{i}")) for i in range(50)} == expected([path])
+
+
+def test_last_line_wins(tmp_path):
+    # a retried request appended at the end, and a later file overriding an earlier one
+    path = write(tmp_path / "out.jsonl", [result(f"r-{i}", f"a{i}") for i in range(10)] + [result("r-3", "retried")])
+    cached = write(tmp_path / "cached.jsonl", [result("r-7", "cached")])
+    want = expected([path, cached])
+    assert want["r-3"] == "retried" and want["r-7"] == "cached"
+    with CustomIdReader([path, cached]) as reader:
+        assert {f"r-{i}": get_content(reader.take(f"r-{i}")) for i in range(10)} == want
+        assert reader._lockstep
+    with OffsetIndex(path) as index:
+        assert get_content(index.get("r-3")) == "retried"
+
+
+def test_missing_files_are_skipped(tmp_path):
+    path = write(tmp_path / "out.jsonl", [result("r-0", "a0")])
+    with CustomIdReader([path, str(tmp_path / "absent.jsonl")]) as reader:
+        assert get_content(reader.take("r-0")) == "a0"
+
+
+def test_index_is_rebuilt_after_append(tmp_path):
+    path = write(tmp_path / "out.jsonl", [result(f"r-{i}", f"a{i}") for i in range(5)])
+    assert build_index(path).shape[1] == 5
+    assert load_index(path) is not None
+    with open(path, "a") as f:
+        f.write(json.dumps(result("r-5", "a5")) + "\n")
+    assert load_index(path) is None
+    with OffsetIndex(path) as index:
+        assert len(index) == 6
+        assert [get_content(record) for record in index.range(4, 6)] == ["a4", "a5"]
@@ -0,0 +1,13 @@
+from utils import token_budget
+from utils.tokens import load_tokenizer
+
+
+def test_fit_only_lowers_max_tokens():
+    token_budget._tokenizer = load_tokenizer("approx")
+    body = {"messages": [{"role": "user", "content": "Is the response in English?"}], "max_tokens": 16}
+    planned, tokens, dropped, fits = token_budget.fit(body, 8192, 1, 4096, 16, "flag")
+    assert fits and planned["max_tokens"] == 16
+    planned, _, _, fits = token_budget.fit({**body, "max_tokens": 100000}, 8192, 1, 4096, 16, "flag")
+    assert fits and planned["max_tokens"] == 4096
+    planned, _, _, fits = token_budget.fit({"messages": body["messages"]}, 8192, 1, None, 16, "flag")
+    assert fits and planned["max_tokens"] == 8192 - tokens - 16
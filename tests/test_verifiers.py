@@ -0,0 +1,85 @@
+import pytest
+
+from utils.verifiers import sentences, split_questions, verify
+
+
+BULLETS = "- Paris is the capital of France and has many museums\n- Lyon is known for food\n- Nice is on the coast"
+
+
+@pytest.mark.parametrize("question", [
+    "Is each bullet point within 20 words?",
+    "Does every bullet point contain exactly 5 words?",
+    "Does each paragraph contain at most 3 sentences?",
+    "Are there no more than 2 sentences per paragraph?",
+    "Does the response avoid a numbered list?",
+    "Is the response free of JSON format?",
+    "Is the response written without bullet points?",
+    "Does the response not use bullet points?",
+    "Does the first paragraph contain at least 20 words?",
+])
+def test_scoped_or_negated_questions_go_to_the_judge(question):
+    assert verify(question, BULLETS) == (None, None)
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("Does the response use bullet points?", True),
+    ("Does the response use a numbered list?", False),
+    ("Does the response contain no more than 10 words?", False),
+    ("Does the response contain at least 10 words?", True),
+    ("Does the response avoid commas?", True),
+    ("Is the response in JSON format?", False),
+])
+def test_whole_response_questions(question, expected):
+    verdict, _ = verify(question, BULLETS)
+    assert verdict is expected
+
+
+def test_questions_two_checkers_read_go_to_the_judge():
+    assert verify("Is the response all lowercase and in JSON format?", '{"a": 1}') == (None, None)
+    assert verify("Does the response use bullet points and contain at least 10 words?", BULLETS) == (None, None)
+
+
+FIVE_BULLETS = "\n".join(f"- item {i}" for i in range(5))
+
+
+@pytest.mark.parametrize("question, response, expected", [
+    ("Does the response contain at least three bullet points?", "- only one", False),
+    ("Does the response contain at most 3 bullet points?", FIVE_BULLETS, False),
+    ("Does the response contain no more than 5 bullet points?", FIVE_BULLETS, True),
+    ("Does the response contain exactly 3 bullet points?", BULLETS, True),
+    ("Is the response a numbered list with 5 items?", "1. one\n2. two", False),
+    ("Is the response a numbered list with 2 items?", "1. one\n2. two", True),
+    ("Does the response mention the term \"apple\"?", "I like apples.", False),
+    ("Does the response mention the term \"apple\"?", "An apple a day.", True),
+])
+def test_counts_and_keywords(question, response, expected):
+    verdict, _ = verify(question, response)
+    assert verdict is expected
+
+
+@pytest.mark.parametrize("question, response", [
+    ("Is the response formatted in JSON with keys name and age?", '{"name": 1}'),
+    ("Does the response mention the term \"AI\" at least twice?", "AI is here."),
+    ("Is the response in lowercase letters only, except for proper nouns?", "Hello Paris"),
+    ("Is the response written in English?", "el perro es muy grande y la casa de mi madre es bonita"),
+])
+def test_qualified_questions_go_to_the_judge(question, response):
+    assert verify(question, response) == (None, None)
+
+
+def test_english():
+    assert verify("Is the response written in English?", "The dog is very big and the house of my mother is pretty.") == (True, "Linguistic")
+    assert verify("Is the response written in English?", "Собака очень большая, а дом моей матери красивый.") == (False, "Linguistic")
+
+
+def test_sentences_skip_abbreviations():
+    assert len(sentences("Dr. Smith will see you at 3 p.m. tomorrow.")) == 1
+    assert len(sentences("Dr. Smith arrived at 3 p.m. He left at 5 p.m.")) == 2
+    assert len(sentences("J. K. Rowling wrote it. So did I.")) == 2
+    assert len(sentences("all lowercase here. still two")) == 2
+    assert verify("Does the response contain exactly 1 sentence?", "Dr. Smith will see you at 3 p.m. tomorrow.") == (True, "Numerical")
+
+
+def test_split_questions():
+    questions = ["Does the response use bullet points?", "Is the tone friendly?", "Is each bullet point within 20 words?"]
+    assert split_questions(questions, BULLETS) == ({0: True}, [1, 2])
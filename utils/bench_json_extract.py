@@ -0,0 +1,117 @@
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.json_extract import parse_tool
+
+
+# the parsers the scripts used before utils.json_extract, kept here as the baseline
+def legacy_parse_tool(tool_str):
+    try:
+        pattern = re.compile(r"(\{.*\})", re.DOTALL)
+        matches = re.findall(pattern, tool_str)
+        tool_str = matches[0]
+    except Exception as e:
+        pass
+    if tool_str[0] == "[" and tool_str[-1] == "]":
+        tool_str = "{" + tool_str[1:-1] + "}"
+    try:
+        return json.loads(tool_str)
+    except:
+        try:
+            return ast.literal_eval(tool_str)
+        except Exception as e:
+            return None
+
+
+def legacy_parse_augmented(tool_str):
+    try:
+        pattern = re.compile(r"```json(.*?)```|```(.*?)```", re.DOTALL)
+        matches = re.findall(pattern, tool_str)
+        tool_str = matches[0][0]
+    except Exception as e:
+        pass
+    try:
+        tool_str = tool_str[1:-1]
+        question = tool_str.split("\"question\":")[1].strip()[2:-2].replace("\"", "\'")
+        query = tool_str.split("\"question\":")[0].split("\"augmented query\":")[1].strip()[1:-2].replace("\"", "\'")
+        tool_str = json.dumps({
+            "augmented query": query,
+            "question": [question]
+        })
+    except:
+        pass
+    try:
+        return json.loads(tool_str), tool_str
+    except (json.JSONDecodeError, TypeError):
+        try:
+            return ast.literal_eval(tool_str), tool_str
+        except (ValueError, SyntaxError):
+            return None, None
+
+
+def safe(fn, text):
+    try:
+        return fn(text)
+    except Exception:
+        return None
+
+
+def accuracy(corpus):
+    parsers = {
+        "legacy": lambda case: safe(legacy_parse_augmented, case["text"])[0] if case["kind"] == "augmented" and safe(legacy_parse_augmented, case["text"]) else safe(legacy_parse_tool, case["text"]),
+        "json_extract": lambda case: parse_tool(case["text"]),
+    }
+    for name, parser in parsers.items():
+        correct = 0
+        for case in corpus:
+            correct += parser(case) == case["expected"]
+        print(f"{name:>12}: {correct}/{len(corpus)} corpus cases parsed exactly")
+    for case in corpus:
+        if parse_tool(case["text"]) != case["expected"]:
+            print("  json_extract mismatch:", json.dumps(case["text"])[:120])
+
+
+def valid_json(text):
+    try:
+        json.loads(re.findall(r"(\{.*\})", text, re.DOTALL)[0])
+        return True
+    except (IndexError, ValueError):
+        return False
+
+
+def throughput(corpus, repeat):
+    # per shape: valid JSON (plus long judge outputs, the shape that dominates the merge stages) and outputs
+    # that need repair, where the legacy parser falls back to ast.literal_eval or gives up
+    long_judge = "```json\n{\n" + ",\n".join(
+        f'    "Question {i}": {{\n        "explanation": "{"The response follows the constraint. " * 40}",\n        "score": "YES"\n    }}'
+        for i in range(1, 6)) + "\n}\n```"
+    shapes = {
+        "valid": [case["text"] for case in corpus if valid_json(case["text"])] + [long_judge] * 8,
+        "repair": [case["text"] for case in corpus if not valid_json(case["text"])],
+    }
+    for shape, texts in shapes.items():
+        for name, parser in (("legacy", legacy_parse_tool), ("json_extract", parse_tool)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for text in texts:
+                    safe(parser, text)
+            elapsed = time.perf_counter() - start
+            print(f"{shape:>12} {name:>12}: {repeat * len(texts) / elapsed:,.0f} outputs/s ({sum(map(len, texts)) * repeat / elapsed / 2**20:.1f} MiB/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "json_extract_corpus.jsonl"))
+    parser.add_argument("--repeat", default=200, type=int)
+    args = parser.parse_args()
+
+    with open(args.corpus, "r", encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    accuracy(corpus)
+    throughput(corpus, args.repeat)
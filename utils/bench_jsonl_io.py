@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import jsonlines
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import JsonlWriter, iter_jsonl
+
+
+# utils.jsonl_io against the pattern the scripts used before: jsonlines.open(path, "a") around every
+# record and list(jsonlines.open(path)) to read. Point --dir at the network filesystem the stages write
+# to; the per-record open/close is what hurts there.
+
+
+def make_records(n):
+    # request-shaped records: a long prompt and a few parameters
+    prompt = "Please answer the query while following every constraint in it. " * 20
+    return [{
+        "custom_id": f"request-{i:012x}",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {"model": "meta-llama/Meta-Llama-3.1-70B-Instruct", "messages": [{"role": "user", "content": f"{prompt} [{i}]"}],
+                 "max_tokens": 4096, "temperature": 0, "top_p": 1.0},
+    } for i in range(n)]
+
+
+def legacy_write(path, records):
+    for record in records:
+        with jsonlines.open(path, "a") as f:
+            f.write(record)
+
+
+def buffered_write(path, records):
+    with JsonlWriter(path, "a") as f:
+        for record in records:
+            f.write(record)
+
+
+def legacy_read(path):
+    return len(list(jsonlines.open(path, "r")))
+
+
+def fast_read(path):
+    return sum(1 for _ in iter_jsonl(path))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default=None, help="directory to write the test files to (default: a temporary directory)")
+    parser.add_argument("-n", default=20000, type=int, help="records")
+    args = parser.parse_args()
+
+    records = make_records(args.n)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        legacy_path = os.path.join(tmp, "legacy.jsonl")
+        buffered_path = os.path.join(tmp, "buffered.jsonl")
+        results = [
+            ("write", "jsonlines.open per record", timed(legacy_write, legacy_path, records)),
+            ("write", "JsonlWriter", timed(buffered_write, buffered_path, records)),
+            ("read", "list(jsonlines.open)", timed(legacy_read, legacy_path)),
+            ("read", "iter_jsonl", timed(fast_read, buffered_path)),
+        ]
+        with open(legacy_path, "rb") as a, open(buffered_path, "rb") as b:
+            assert a.read() == b.read(), "JsonlWriter output differs from jsonlines"
+        size = os.path.getsize(buffered_path)
+    for op, name, elapsed in results:
+        print(f"{op:>5} {name:>26}: {args.n / elapsed:>10,.0f} records/s ({size / elapsed / 2**20:.1f} MiB/s)")
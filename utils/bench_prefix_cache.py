@@ -0,0 +1,217 @@
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "UltraComposer"))
+import extract_constraint
+import generate_eval_ques
+from utils.json_extract import extract_json
+from utils.jsonl_io import iter_jsonl
+from utils.online_client import OpenAIClient
+from utils.prefix_cache import PrefixCache
+from utils.schemas import CONSTRAINT_CATEGORIES, CONSTRAINT_SCHEMA, GUIDED_BACKENDS, guided_json, matches
+from utils.stream_join import body_contents
+from utils.tokens import load_tokenizer
+
+
+# the "original" and "prefix" prompt layouts of extract_constraint / generate_eval_ques (see build_prompt there):
+# - estimate: offline, prompt tokens and the share a vllm-style prefix cache would serve, per layout
+# - measure: the same prompts sent to a running server (vllm serve --enable-prefix-caching, sglang),
+#   with the cached tokens it reports in usage and its /metrics prefix cache counters
+# - accuracy: a held-out set of queries decomposed with both layouts at temperature 0; the prefix
+#   layout regresses when it parses less often or agrees less with the reference decompositions
+#   ("output" field, e.g. earlier extract_constraint results) than the original layout
+#
+# python utils/bench_prefix_cache.py estimate --stage extract_constraint -i your_data.jsonl --tokenizer meta-llama/Meta-Llama-3.1-70B-Instruct
+# python utils/bench_prefix_cache.py measure --stage extract_constraint -i your_data.jsonl --base-url http://localhost:8000 -n 500
+# python utils/bench_prefix_cache.py accuracy -i heldout.jsonl --base-url http://localhost:8000 -n 200
+
+LAYOUTS = ("original", "prefix")
+
+
+def stage_prompts(stage, path, layout, n=None):
+    # -> user messages of the stage's requests for the first n records of `path`; generate_eval_ques
+    # needs the extract_constraint result of each query in its "output" field
+    prompts = []
+    for d in iter_jsonl(path):
+        if n is not None and len(prompts) >= n:
+            break
+        if stage == "extract_constraint":
+            prompts.append([{"role": "user", "content": extract_constraint.build_prompt(d["query"], layout)}])
+            continue
+        constraints = extract_json(d.get("output") or "")
+        if not isinstance(constraints, dict) or not constraints.get("Complex"):
+            continue
+        for key in CONSTRAINT_CATEGORIES:
+            for item in constraints.get(key) or []:
+                if isinstance(item, dict) and "constraint" in item:
+                    prompts.append([{"role": "user", "content": generate_eval_ques.build_prompt(d["query"], item["constraint"], layout)}])
+    return prompts[:n]
+
+
+def estimate(args):
+    tokenizer = load_tokenizer(args.tokenizer)
+    rows = []
+    for layout in LAYOUTS:
+        cache = PrefixCache(block_size=args.block_size)
+        prompts = stage_prompts(args.stage, args.input, layout, args.n)
+        for messages in prompts:
+            cache.lookup(tokenizer.chat_tokens(messages))
+        rows.append((layout, len(prompts), cache.queries, cache.hits))
+    report(rows, f"{args.stage}, {tokenizer.name} tokens, blocks of {args.block_size}")
+
+
+def report(rows, title):
+    print(title)
+    print(f"{'layout':>10} {'requests':>9} {'prompt tokens':>14} {'cached':>12} {'hit rate':>9} {'prefill':>12}")
+    for layout, n, prompt_tokens, cached in rows:
+        print(f"{layout:>10} {n:>9} {prompt_tokens:>14,} {cached:>12,} {cached / max(prompt_tokens, 1):>9.1%} {prompt_tokens - cached:>12,}")
+    if len(rows) == 2:
+        saved = (rows[0][2] - rows[0][3]) - (rows[1][2] - rows[1][3])
+        print(f"prefill tokens saved by the prefix layout: {saved:,} ({saved / max(rows[0][2] - rows[0][3], 1):.1%})")
+
+
+def scrape_metrics(base_url):
+    # prometheus counters of the server -> {name: value summed over labels}, {} when unavailable
+    try:
+        text = requests.get(base_url.rstrip("/") + "/metrics", timeout=10).text
+    except requests.RequestException:
+        return {}
+    metrics = {}
+    for line in text.splitlines():
+        match = re.match(r"^([\w:]+)(?:\{[^}]*\})?\s+([-+\d.eE]+|NaN)$", line)
+        if match:
+            metrics[match.group(1)] = metrics.get(match.group(1), 0.0) + float(match.group(2))
+    return metrics
+
+
+def reset_prefix_cache(base_url):
+    # vllm (VLLM_SERVER_DEV_MODE=1) and sglang endpoints; without one, the prefix layout also
+    # profits from what the original layout left in the cache, so measure it on a fresh server
+    for path in ("/reset_prefix_cache", "/flush_cache"):
+        try:
+            if requests.post(base_url.rstrip("/") + path, timeout=30).ok:
+                return True
+        except requests.RequestException:
+            pass
+    print("could not reset the prefix cache of the server")
+    return False
+
+
+def measure(args):
+    client = OpenAIClient(args.base_url, api_key=args.api_key, pool_size=args.concurrency, guided=args.guided)
+    rows = []
+    for layout in LAYOUTS:
+        prompts = stage_prompts(args.stage, args.input, layout, args.n)
+        reset_prefix_cache(args.base_url)
+        before = scrape_metrics(args.base_url)
+        start = time.perf_counter()
+
+        def call(messages):
+            return client.chat(messages, model=args.model, max_tokens=args.max_tokens, temperature=0)
+
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            usages = [result.get("usage") or {} for result in pool.map(call, prompts)]
+        elapsed = time.perf_counter() - start
+        after = scrape_metrics(args.base_url)
+        prompt_tokens = sum(usage.get("prompt_tokens", 0) for usage in usages)
+        cached = sum((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0 for usage in usages)
+        queries = after.get("vllm:prefix_cache_queries_total", 0) - before.get("vllm:prefix_cache_queries_total", 0)
+        hits = after.get("vllm:prefix_cache_hits_total", 0) - before.get("vllm:prefix_cache_hits_total", 0)
+        print(f"{layout}: {len(prompts)} requests in {elapsed:.1f}s ({len(prompts) / elapsed:.1f} requests/s)"
+              + (f", server prefix cache hit rate {hits / queries:.1%} ({hits:,.0f}/{queries:,.0f} tokens)" if queries else ", no prefix cache counters in /metrics"))
+        rows.append((layout, len(prompts), prompt_tokens, cached))
+    report(rows, f"{args.stage} on {args.base_url}, cached tokens from usage.prompt_tokens_details")
+
+
+def decomposition(text):
+    # extract_constraint output -> (parses and matches the schema, complex, set of normalized constraints)
+    value = extract_json(text or "")
+    if not isinstance(value, dict) or not matches(value, CONSTRAINT_SCHEMA):
+        return False, None, frozenset()
+    constraints = set()
+    for key in CONSTRAINT_CATEGORIES:
+        for item in value.get(key) or []:
+            constraints.add(re.sub(r"[^\w ]", "", item["constraint"].lower()).strip())
+    return True, bool(value["Complex"]), frozenset(constraints)
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def agreement(pairs):
+    # [(decomposition, decomposition)] -> (same Complex flag, mean constraint Jaccard over pairs both parsed)
+    both = [(a, b) for a, b in pairs if a[0] and b[0]]
+    if not both:
+        return 0.0, 0.0
+    return sum(a[1] == b[1] for a, b in both) / len(both), sum(jaccard(a[2], b[2]) for a, b in both) / len(both)
+
+
+def accuracy(args):
+    client = OpenAIClient(args.base_url, api_key=args.api_key, pool_size=args.concurrency, guided=args.guided)
+    records = list(islice(iter_jsonl(args.input), args.n))
+    references = [decomposition(d["output"]) if d.get("output") else None for d in records]
+    results = {}
+    for layout in LAYOUTS:
+        def call(d):
+            messages = [{"role": "user", "content": extract_constraint.build_prompt(d["query"], layout)}]
+            contents = body_contents(client.chat(messages, model=args.model, max_tokens=4096, temperature=0, top_p=1.0, **guided_json(CONSTRAINT_SCHEMA)))
+            return decomposition(contents[0] if contents else None)
+
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            results[layout] = list(pool.map(call, records))
+
+    regressed = False
+    print(f"{len(records)} held-out queries, {sum(r is not None for r in references)} with a reference decomposition")
+    scores = {}
+    for layout in LAYOUTS:
+        valid = sum(r[0] for r in results[layout]) / max(len(records), 1)
+        line = f"{layout:>10}: valid {valid:.1%}"
+        scores[layout] = [valid]
+        labelled = [(r, ref) for r, ref in zip(results[layout], references) if ref is not None and ref[0]]
+        if labelled:
+            complex_acc, overlap = agreement(labelled)
+            scores[layout] += [complex_acc, overlap]
+            line += f", Complex matches the reference {complex_acc:.1%}, constraint Jaccard {overlap:.3f}"
+        print(line)
+    same_complex, overlap = agreement(list(zip(results["original"], results["prefix"])))
+    print(f"original vs prefix: same Complex flag {same_complex:.1%}, constraint Jaccard {overlap:.3f}")
+    for name, original, prefix in zip(("valid rate", "Complex accuracy", "constraint Jaccard"), scores["original"], scores["prefix"]):
+        if prefix < original - args.tolerance:
+            print(f"regression: {name} {original:.3f} -> {prefix:.3f}")
+            regressed = True
+    print("prefix layout regressed" if regressed else f"no regression beyond {args.tolerance}")
+    return not regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["estimate", "measure", "accuracy"])
+    parser.add_argument("-i", "--input", required=True, help="records with 'query' (and 'output': extract_constraint result)")
+    parser.add_argument("--stage", default="extract_constraint", choices=["extract_constraint", "generate_eval_ques"])
+    parser.add_argument("-n", default=None, type=int, help="requests per layout (records for accuracy)")
+    parser.add_argument("--tokenizer", default=None, help="tokenizer of the served model (estimate); approximate without one")
+    parser.add_argument("--block-size", default=16, type=int)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--model", default="meta-llama/Meta-Llama-3.1-70B-Instruct")
+    parser.add_argument("--concurrency", default=32, type=int)
+    parser.add_argument("--guided", default="vllm", choices=GUIDED_BACKENDS, help="guided decoding parameters the server accepts")
+    parser.add_argument("--max-tokens", default=1, type=int, help="output tokens per request when measuring prefill")
+    parser.add_argument("--tolerance", default=0.02, type=float, help="accepted drop of the accuracy scores")
+    args = parser.parse_args()
+
+    if args.command == "estimate":
+        estimate(args)
+    elif args.command == "measure":
+        measure(args)
+    elif not accuracy(args):
+        sys.exit(1)
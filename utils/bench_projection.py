@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import loads
+from utils.projection import project
+from utils.stream_join import get_contents
+
+
+# records/s of reading content, finish_reason and usage from a batch output file: full json.loads,
+# full orjson (utils.jsonl_io.loads) and utils.projection. The synthetic file has the vllm / OpenAI
+# output layout, n choices per line and optionally per-token logprobs (score-only judge outputs).
+
+
+_words = "The response addresses every constraint of the query in a clear and direct way".split()
+_contents = []
+
+
+def make_line(i, n, logprobs):
+    if not _contents:
+        _contents.extend(" ".join(random.choice(_words) for _ in range(random.randint(100, 400))) for _ in range(256))
+    choices = []
+    for c in range(n):
+        content = random.choice(_contents)
+        choice = {"index": c, "message": {"role": "assistant", "content": content, "tool_calls": []},
+                  "logprobs": None, "finish_reason": "stop", "stop_reason": None}
+        if logprobs:
+            choice["logprobs"] = {"content": [{"token": w, "logprob": -0.01, "bytes": list(w.encode()),
+                                               "top_logprobs": [{"token": w, "logprob": -0.01, "bytes": list(w.encode())}]}
+                                              for w in content.split()[:64]]}
+        choices.append(choice)
+    body = {"id": f"chat-{i:x}", "object": "chat.completion", "created": 1734567890, "model": "meta-llama/Llama-3.1-8B-Instruct",
+            "choices": choices, "usage": {"prompt_tokens": 312, "total_tokens": 312 + 350 * n, "completion_tokens": 350 * n}}
+    record = {"id": f"vllm-{i:x}", "custom_id": f"request-{i:016x}", "response": {"status_code": 200, "request_id": f"vllm-batch-{i:x}", "body": body}, "error": None}
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def make_file(path, size, n, logprobs):
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        i = 0
+        while written < size:
+            line = make_line(i, n, logprobs)
+            f.write(line)
+            written += len(line)
+            i += 1
+    return i
+
+
+def read_json(path):
+    for line in open(path, "rb"):
+        record = json.loads(line)
+        body = record["response"]["body"]
+        yield record["custom_id"], get_contents(record), body["choices"][0]["finish_reason"], body["usage"]
+
+
+def read_orjson(path):
+    for line in open(path, "rb"):
+        record = loads(line)
+        body = record["response"]["body"]
+        yield record["custom_id"], get_contents(record), body["choices"][0]["finish_reason"], body["usage"]
+
+
+def read_projected(path):
+    for line in open(path, "rb"):
+        yield project(line, ("custom_id", "contents", "finish_reason", "usage"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gb", default=2.0, type=float, help="size of the synthetic output file")
+    parser.add_argument("-n", default=5, type=int, help="choices per line")
+    parser.add_argument("--logprobs", action="store_true", help="add per-token logprobs to every choice")
+    parser.add_argument("--dir", default=None)
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path = os.path.join(tmp, "output.jsonl")
+        records = make_file(path, int(args.gb * 2**30), args.n, args.logprobs)
+        size = os.path.getsize(path)
+        print(f"{records} records, {size / 2**30:.2f} GiB")
+        expected = None
+        for name, reader in (("json.loads", read_json), ("orjson", read_orjson), ("projection", read_projected)):
+            start = time.perf_counter()
+            checksum = 0
+            for custom_id, contents, finish_reason, usage in reader(path):
+                checksum += len(contents[0]) + usage["completion_tokens"]
+            elapsed = time.perf_counter() - start
+            assert expected is None or checksum == expected
+            expected = checksum
+            print(f"{name:>12}: {records / elapsed:,.0f} records/s ({size / elapsed / 2**20:.0f} MiB/s)")
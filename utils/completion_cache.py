@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def cache_key(body):
+    # model, messages and every sampling parameter take part in the key
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def cacheable(body):
+    # only greedy single-sample requests are deterministic enough to replay
+    return body.get("temperature", 1.0) == 0 and body.get("n", 1) == 1
+
+
+def cached_output_path(save_path):
+    # cache hits of a request file are written here, in batch output format (never compressed)
+    if save_path.endswith(".zst"):
+        save_path = save_path[:-len(".zst")]
+    return os.path.splitext(save_path)[0] + "_cached_output.jsonl"
+
+
+class CompletionCache:
+    """Persistent content-addressed cache of chat completion bodies.
+
+    Entries live in one sqlite file shared by every stage and are keyed by
+    cache_key(request body). When the file grows past `max_bytes` the least
+    recently used entries are evicted. Safe to share between threads and
+    processes: access times of hits are written in batches, so a stage that
+    only reads does not hold the sqlite write lock.
+    """
+
+    def __init__(self, path="./completion_cache.sqlite", max_bytes=20 * 2**30, touch_batch=1000, touch_seconds=10.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, body TEXT, size INTEGER, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        # key -> access time of hits not written yet
+        self.touched = {}
+        self.touch_batch = touch_batch
+        self.touch_seconds = touch_seconds
+        self.touch_flushed = time.time()
+
+    def get(self, body):
+        if not cacheable(body):
+            return None
+        key = cache_key(body)
+        with self.lock:
+            row = self.db.execute("SELECT body FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.touch_batch or time.time() - self.touch_flushed > self.touch_seconds:
+                self._flush_touched()
+                self.db.commit()
+            return json.loads(row[0])
+
+    def _flush_touched(self):
+        if self.touched:
+            self.db.executemany("UPDATE completions SET accessed = ? WHERE key = ?", [(accessed, key) for key, accessed in self.touched.items()])
+            self.touched = {}
+        self.touch_flushed = time.time()
+
+    def put(self, body, response_body):
+        if not cacheable(body) or response_body is None:
+            return
+        value = json.dumps(response_body, ensure_ascii=False)
+        with self.lock:
+            old = self.db.execute("SELECT size FROM completions WHERE key = ?", (cache_key(body),)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)", (cache_key(body), value, len(value), time.time()))
+            self.total_bytes += len(value) - (old[0] if old else 0)
+            self._flush_touched()
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        # drop least recently used entries until the cache is down to 90% of the budget;
+        # other processes sharing the file add entries too
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        target = self.max_bytes * 0.9
+        while self.total_bytes > target:
+            rows = self.db.execute("SELECT key, size FROM completions ORDER BY accessed LIMIT 1000").fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                evicted.append((key,))
+                self.total_bytes -= size
+            self.db.executemany("DELETE FROM completions WHERE key = ?", evicted)
+
+    def fill(self, request_path, output_path):
+        # store the results of a finished batch so later runs can reuse them
+        from utils.jsonl_io import iter_jsonl
+        from utils.stream_join import CustomIdReader
+
+        stored = 0
+        with CustomIdReader(output_path) as reader:
+            for request in iter_jsonl(request_path):
+                if not cacheable(request["body"]):
+                    continue
+                record = reader.take(request["custom_id"])
+                if record is None or record.get("response") is None:
+                    continue
+                self.put(request["body"], record["response"]["body"])
+                stored += 1
+        return stored
+
+    def report(self, stage):
+        # end of a stage: access times of its hits are written out
+        with self.lock:
+            self._flush_touched()
+            self.db.commit()
+        total = self.hits + self.misses
+        print(f"[cache] {stage}: {self.hits} hits / {total} lookups ({self.hits / max(total, 1):.1%}), "
+              f"{self.total_bytes / 2**20:.1f} MiB cached")
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self.lock:
+            self._flush_touched()
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,273 @@
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import JsonlWriter, iter_jsonl, loads, open_binary
+from utils.offset_index import OffsetIndex, id_key
+from utils.request_ids import make_custom_id
+
+
+# near-duplicate filter for the query files that go into extract_constraint (retries, copy-pasted
+# templates): MinHash signatures of the byte shingles of every normalized query, computed in a process
+# pool, then LSH banding. Records sharing a band bucket are compared on their full signatures with the
+# first record of the bucket; every cluster keeps its first record and a record is only dropped for a
+# kept record it was compared with directly and reaches the threshold with (no chains A ~ B ~ C).
+# Numbers, language names and format words are not left to the fuzzy match: two records are only
+# joined when they have the same ones in the same order ("exactly 3 paragraphs" is no duplicate of
+# "exactly 5 paragraphs", "in French" none of "in Spanish").
+# Signatures and band keys live in memory-mapped files under work_dir, so the input is only limited
+# by disk: 10M queries with 128 permutations take ~5 GB there.
+#
+# <save_path>            the kept records, in input order
+# <save_path>.clusters   one line per dropped record: its custom_id and the one of the record kept for it;
+#                        expand_results() copies the kept record's results to the dropped ones
+#
+# python utils/dedup.py dedup -i your_data.jsonl -o your_data.dedup.jsonl --threshold 0.8
+# python utils/dedup.py expand --clusters your_data.dedup.jsonl.clusters --results output.jsonl -o output.expanded.jsonl
+
+_BASE = np.uint64(0x100000001B3)
+
+_GUARD_WORDS = [
+    # numbers
+    "zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "eleven", "twelve",
+    "fifteen", "twenty", "thirty", "fifty", "hundred", "thousand", "single", "once", "twice", "half",
+    # languages
+    "english", "french", "spanish", "german", "italian", "portuguese", "dutch", "russian", "chinese", "mandarin",
+    "cantonese", "japanese", "korean", "arabic", "hindi", "bengali", "turkish", "vietnamese", "thai", "indonesian",
+    "polish", "swedish", "greek", "hebrew", "latin", "persian", "urdu", "swahili",
+    # formats
+    "json", "yaml", "xml", "html", "csv", "markdown", "latex", "table", "tables", "bullet", "bullets", "bulleted",
+    "numbered", "list", "lists", "paragraph", "paragraphs", "sentence", "sentences", "word", "words", "character",
+    "characters", "line", "lines", "section", "sections", "lowercase", "uppercase", "capital", "capitals", "title",
+    "heading", "headings", "bold", "italic", "italics", "quotation", "quotes", "code", "poem", "haiku", "sonnet",
+    "limerick", "essay", "email", "letter", "tweet", "dialogue", "script", "comma", "commas",
+]
+_GUARD = re.compile(r"\d+(?:[.,]\d+)*|\b(?:" + "|".join(_GUARD_WORDS) + r")\b")
+
+
+def normalize(text):
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def guard_key(text):
+    # the numbers, language names and format words of a text, in order: records only join when these match
+    return id_key("\x1f".join(_GUARD.findall(normalize(text))))
+
+
+def permutations(num_perm, seed=1):
+    # multiply-shift hashing: (a * x + b) >> 32 with odd 64-bit a, wrapping uint64 arithmetic
+    rng = np.random.RandomState(seed)
+    a = rng.randint(0, 1 << 62, num_perm, dtype=np.int64).astype(np.uint64) * np.uint64(4) + np.uint64(1)
+    b = rng.randint(0, 1 << 62, num_perm, dtype=np.int64).astype(np.uint64)
+    return a, b
+
+
+def signatures_of(texts, a, b, k=5, block=8):
+    # -> (len(texts), num_perm) uint32 MinHash signatures of the k-byte shingles of the normalized texts,
+    # computed for the whole chunk at once: all texts in one buffer, windows across two texts left out
+    data = [normalize(text).encode("utf-8").ljust(k, b"\0") for text in texts]
+    lengths = np.array([len(d) for d in data], dtype=np.int64)
+    buffer = np.frombuffer(b"".join(data), dtype=np.uint8).astype(np.uint64)
+    powers = _BASE ** np.arange(k, dtype=np.uint64)
+    hashes = sliding_window_view(buffer, k) @ powers
+    counts = lengths - k + 1
+    first = np.cumsum(counts) - counts
+    index = np.arange(counts.sum()) + np.repeat(np.cumsum(lengths) - lengths - first, counts)
+    x = hashes[index]
+    result = np.empty((len(texts), len(a)), dtype=np.uint32)
+    for start in range(0, len(a), block):
+        h = (a[start:start + block, None] * x[None, :] + b[start:start + block, None]) >> np.uint64(32)
+        result[:, start:start + block] = np.minimum.reduceat(h, first, axis=1).T
+    return result
+
+
+def optimal_bands(threshold, num_perm):
+    # (bands, rows) with bands * rows <= num_perm minimizing false positive + false negative probability mass
+    s = np.linspace(0, 1, 1001)
+    best = None
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        p = 1 - (1 - s ** rows) ** bands
+        error = (np.where(s < threshold, p, 0).sum() + np.where(s >= threshold, 1 - p, 0).sum()) / len(s)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+_state = {}
+
+
+def _init(num_perm, shingle, bands, rows, seed):
+    a, b = permutations(num_perm, seed)
+    mix = np.random.RandomState(seed + 1).randint(1, 1 << 62, rows).astype(np.uint64) | np.uint64(1)
+    _state.update(a=a, b=b, shingle=shingle, bands=bands, rows=rows, mix=mix)
+
+
+def sign_chunk(texts):
+    # -> (signatures (n, num_perm) uint32, band keys (n, bands) uint64)
+    s = _state
+    signatures = signatures_of(texts, s["a"], s["b"], s["shingle"])
+    used = signatures[:, :s["bands"] * s["rows"]].astype(np.uint64).reshape(len(texts), s["bands"], s["rows"])
+    keys = (used * s["mix"]).sum(axis=2) + np.arange(s["bands"], dtype=np.uint64)
+    return signatures, keys
+
+
+def representatives(n, edges_u, edges_v, same):
+    # edges (u < v) verified as duplicates -> the record kept for each record (itself when it is kept).
+    # A record first points to its earliest verified match; when that one is dropped for an earlier record,
+    # it is compared with that record directly (same(v, t) -> bool array) and moves on or is kept itself,
+    # so every dropped record reaches the threshold with the record it is dropped for
+    labels = np.arange(n, dtype=np.int64)
+    if len(edges_u):
+        np.minimum.at(labels, edges_v, edges_u)
+    while True:
+        target = labels[labels]
+        moving = np.nonzero(target != labels)[0]
+        if not len(moving):
+            return labels
+        ok = same(moving, target[moving])
+        labels[moving[ok]] = target[moving[ok]]
+        labels[moving[~ok]] = moving[~ok]
+
+
+def candidate_edges(keys):
+    # records sharing a bucket of one band -> (first record of the bucket, record) pairs
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    first = order[np.maximum.accumulate(np.where(starts, np.arange(len(order)), 0))]
+    duplicate = ~starts
+    return first[duplicate], order[duplicate]
+
+
+def dedup(data_path, save_path, threshold=0.8, num_perm=128, shingle=5, field="query", workers=None,
+          chunk=2000, work_dir=None, seed=1):
+    start_time = time.time()
+    workers = workers or os.cpu_count()
+    bands, rows = optimal_bands(threshold, num_perm)
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        with open_binary(data_path) as f:
+            n = sum(1 for line in f if line.strip())
+        print(f"{n} records, {bands} bands x {rows} rows of {num_perm} permutations, threshold {threshold}")
+        signatures = np.lib.format.open_memmap(os.path.join(tmp, "signatures.npy"), mode="w+", dtype=np.uint32, shape=(max(n, 1), num_perm))
+        keys = np.lib.format.open_memmap(os.path.join(tmp, "keys.npy"), mode="w+", dtype=np.uint64, shape=(bands, max(n, 1)))
+        ids = np.zeros(n, dtype=np.uint64)
+        guards = np.zeros(n, dtype=np.uint64)
+        records = iter_jsonl(data_path)
+        pos, done = 0, 0
+        with ProcessPoolExecutor(workers, initializer=_init, initargs=(num_perm, shingle, bands, rows, seed)) as pool:
+            # a bounded number of chunks in flight, so the input is never held in memory
+            pending = deque()
+            while True:
+                batch = list(islice(records, chunk))
+                if batch:
+                    for i, d in enumerate(batch):
+                        ids[pos + i] = id_key(make_custom_id(d, fields=(field,)))
+                        guards[pos + i] = guard_key(d[field])
+                    pos += len(batch)
+                    pending.append(pool.submit(sign_chunk, [d[field] for d in batch]))
+                while pending and (len(pending) > 2 * workers or not batch):
+                    chunk_signatures, chunk_keys = pending.popleft().result()
+                    signatures[done:done + len(chunk_signatures)] = chunk_signatures
+                    keys[:, done:done + len(chunk_keys)] = chunk_keys.T
+                    done += len(chunk_signatures)
+                if not batch:
+                    break
+        print(f"signatures: {time.time() - start_time:.0f}s")
+
+        # buckets are split by guard, so the first record of a bucket can be the representative of the rest;
+        # repeats of one query are always paired with its first occurrence
+        edges_u, edges_v = [], []
+        for band_keys in chain((np.asarray(keys[band, :n]) ^ guards for band in range(bands)), [ids]):
+            u, v = candidate_edges(band_keys)
+            if len(u):
+                edges_u.append(u)
+                edges_v.append(v)
+        edges_u = np.concatenate(edges_u) if edges_u else np.zeros(0, dtype=np.int64)
+        edges_v = np.concatenate(edges_v) if edges_v else np.zeros(0, dtype=np.int64)
+        # the same pair shows up once per shared band
+        if len(edges_u):
+            pairs = np.unique(np.stack([edges_u, edges_v], axis=1), axis=0)
+            edges_u, edges_v = pairs[:, 0], pairs[:, 1]
+        candidates = len(edges_u)
+
+        def same(u, v):
+            result = np.zeros(len(u), dtype=bool)
+            for start in range(0, len(u), 100000):
+                a, b = u[start:start + 100000], v[start:start + 100000]
+                result[start:start + 100000] = ((signatures[a] == signatures[b]).mean(axis=1) >= threshold) & (guards[a] == guards[b])
+            return result
+
+        keep = same(edges_u, edges_v)
+        labels = representatives(n, edges_u[keep], edges_v[keep], same)
+        print(f"{candidates} candidate pairs, {int(keep.sum())} above the threshold: {time.time() - start_time:.0f}s")
+
+    # the records extract_constraint would send: one request per distinct query
+    calls_before = len(np.unique(ids))
+    calls_after = int((labels == np.arange(n)).sum())
+    # custom_ids of the records kept for others
+    has_members = np.zeros(n, dtype=bool)
+    has_members[labels[labels != np.arange(n)]] = True
+    kept_ids = {}
+    with JsonlWriter(save_path, "w") as fout, JsonlWriter(save_path + ".clusters", "w") as clusters:
+        for idx, d in enumerate(iter_jsonl(data_path)):
+            custom_id = make_custom_id(d, fields=(field,))
+            if labels[idx] == idx:
+                fout.write(d)
+                if has_members[idx]:
+                    kept_ids[idx] = custom_id
+                continue
+            representative = kept_ids[labels[idx]]
+            if representative != custom_id:
+                clusters.write({"custom_id": custom_id, "representative": representative})
+    print(f"kept {calls_after} of {n} records; 70B calls: {calls_before} -> {calls_after} "
+          f"({calls_before - calls_after} saved, {(calls_before - calls_after) / max(calls_before, 1):.1%}) in {time.time() - start_time:.0f}s")
+    return calls_before - calls_after
+
+
+def expand_results(clusters_path, results_path, save_path):
+    # batch outputs of the kept records -> the same outputs under the custom_ids of the records dropped
+    # for them; pass [results_path, save_path] wherever the results of the full input are read
+    written, missing = 0, 0
+    with OffsetIndex(results_path) as index, JsonlWriter(save_path, "w") as fout:
+        for cluster in iter_jsonl(clusters_path):
+            line = index.get_raw(cluster["representative"])
+            if line is None:
+                missing += 1
+                continue
+            fout.write({**loads(line), "custom_id": cluster["custom_id"]})
+            written += 1
+    print(f"expanded {written} results into {save_path}, {missing} representatives without a result")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["dedup", "expand"])
+    parser.add_argument("-i", "--input", help="records to deduplicate")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--field", default="query")
+    parser.add_argument("--threshold", default=0.8, type=float, help="estimated Jaccard similarity of the shingle sets")
+    parser.add_argument("--num-perm", default=128, type=int)
+    parser.add_argument("--shingle", default=5, type=int, help="shingle length in bytes")
+    parser.add_argument("--workers", default=None, type=int)
+    parser.add_argument("--work-dir", default=None, help="directory for the memory-mapped signatures")
+    parser.add_argument("--clusters", help="cluster map written by dedup (expand)")
+    parser.add_argument("--results", help="batch outputs of the deduplicated records (expand)")
+    args = parser.parse_args()
+
+    if args.command == "dedup":
+        dedup(args.input, args.output, args.threshold, args.num_perm, args.shingle, args.field, args.workers, work_dir=args.work_dir)
+    else:
+        expand_results(args.clusters, args.results, args.output)
@@ -0,0 +1,218 @@
+import ast
+import json
+import re
+
+
+_FENCE = re.compile(r"```[A-Za-z]*")
+_CLOSERS = {"{": "}", "[": "]"}
+_LITERALS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+_WHITESPACE = " \t\r\n"
+_decoder = json.JSONDecoder(strict=False)
+_STRING_SPECIAL = re.compile(r"[\\\"'\n]")
+_OPENS_ARRAY = re.compile(r"\s*\[")
+_BARE_KEY = re.compile(r"[A-Za-z_]\w*\s*:")
+_BARE_ITEM = re.compile(r"[A-Za-z_]\w*\s*(?:[,\]]|$)")
+
+
+def _candidate(text):
+    # body of the first fenced block that holds JSON (an unterminated fence runs to the end), else the whole text
+    for match in _FENCE.finditer(text):
+        end = text.find("```", match.end())
+        body = text[match.end():] if end == -1 else text[match.end():end]
+        if "{" in body or "[" in body:
+            return body
+        if end == -1:
+            break
+    return text
+
+
+def _start(text):
+    # a top-level array only when the text itself opens with one, otherwise the first object
+    if _OPENS_ARRAY.match(text):
+        return text.find("[")
+    start = text.find("{")
+    return start if start != -1 else text.find("[")
+
+
+def _closes(text, i, stack):
+    # whether the quote at text[i] ends the string: it has to be followed by structure, and after a comma
+    # by something that starts the next member, so `"use "x", and y"` stays one string
+    n = len(text)
+    j = i + 1
+    while j < n and text[j] in _WHITESPACE:
+        j += 1
+    if j >= n or text[j] in ":}]":
+        return True
+    if text[j] != ",":
+        return False
+    j += 1
+    while j < n and text[j] in _WHITESPACE:
+        j += 1
+    if j >= n or text[j] in "\"'}]":
+        return True
+    if stack and stack[-1] == "]":
+        return text[j] in "{[-" or text[j].isdigit() or _BARE_ITEM.match(text, j) is not None
+    return _BARE_KEY.match(text, j) is not None
+
+
+def _repair(text):
+    """Cut out the first JSON-like value of `text` and normalise it in one left-to-right pass.
+
+    Handles single-quoted strings, unescaped quotes inside strings, raw
+    newlines, Python True/False/None, bare words (`YES`), trailing commas and
+    truncated output (open brackets are closed; a string or number cut off at
+    the end is dropped with its member, `"score": "N` is not a score). Returns
+    (repaired, fallback) where fallback ends at the last complete member and
+    is used when the truncated tail itself does not parse.
+    """
+    start = _start(text)
+    if start == -1:
+        return None, None
+
+    out = []
+    stack = []
+    quote = None
+    last = -1          # index in `out` of the last significant token outside strings
+    safe = None        # (len(out), closers) at the last comma, for truncated output
+    i, n = start, len(text)
+    while i < n:
+        c = text[i]
+        if quote is not None:
+            # copy the run of ordinary characters in one slice
+            m = _STRING_SPECIAL.search(text, i)
+            j = m.start() if m else n
+            if j > i:
+                out.append(text[i:j])
+                i = j
+                continue
+            if c == "\\" and i + 1 < n:
+                nxt = text[i + 1]
+                out.append("'" if nxt == "'" else c + nxt)
+                i += 2
+                continue
+            if c == quote:
+                if _closes(text, i, stack):
+                    out.append('"')
+                    last = len(out) - 1
+                    quote = None
+                else:
+                    out.append('\\"')
+            elif c == '"':
+                out.append('\\"')
+            elif c == "\n":
+                out.append("\\n")
+            else:
+                out.append(c)
+            i += 1
+            continue
+
+        if c == '"' or c == "'":
+            quote = c
+            out.append('"')
+        elif c in _CLOSERS:
+            stack.append(_CLOSERS[c])
+            out.append(c)
+            last = len(out) - 1
+        elif c == "}" or c == "]":
+            if last >= 0 and out[last] == ",":
+                out[last] = ""
+            if stack:
+                out.append(stack.pop())
+            last = len(out) - 1
+            if not stack:
+                return "".join(out), None
+        elif c == ",":
+            if last >= 0 and out[last] == ",":
+                i += 1
+                continue
+            safe = (len(out), list(stack))
+            out.append(c)
+            last = len(out) - 1
+        elif c.isalpha() or c == "_":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(_LITERALS.get(word) or json.dumps(word))
+            last = len(out) - 1
+            i = j
+            continue
+        elif c in _WHITESPACE:
+            out.append(c)
+        else:
+            out.append(c)
+            last = len(out) - 1
+        i += 1
+
+    # truncated: close the open brackets, nothing usable if no member was started
+    if all(token.strip() in ("", "{", "[") for token in out):
+        return None, None
+    fallback = None
+    if safe is not None:
+        fallback = "".join(out[:safe[0]]) + "".join(reversed(safe[1]))
+    # a value still being written when the output ends may be the prefix of another one
+    if quote is not None or text[-1].isalnum() or text[-1] in ".-+":
+        return fallback, None
+    tail = []
+    if last >= 0 and out[last] == ",":
+        out[last] = ""
+    elif last >= 0 and out[last] == ":":
+        tail.append("null")
+    repaired = "".join(out) + "".join(tail) + "".join(reversed(stack))
+    return repaired, fallback
+
+
+def extract_json(text):
+    """Tolerant extraction of the first JSON object / array in a model output, None if nothing usable."""
+    if not isinstance(text, str):
+        return None
+    # fast path: a well-formed value spanning the first opener to the last closer (fences and prose around it
+    # are cut off), one C decode like the old greedy regex
+    start = _start(text)
+    end = text.rfind("]" if text[start] == "[" else "}") if start != -1 else -1
+    if end > start:
+        try:
+            return _decoder.decode(text[start:end + 1])
+        except ValueError:
+            pass
+    candidate = _candidate(text)
+    start = _start(candidate)
+    if start != -1:
+        try:
+            return _decoder.raw_decode(candidate, start)[0]
+        except ValueError:
+            pass
+    repaired, fallback = _repair(candidate)
+    for attempt in (repaired, fallback):
+        if attempt is None:
+            continue
+        try:
+            return json.loads(attempt, strict=False)
+        except ValueError:
+            pass
+    try:
+        return ast.literal_eval(candidate.strip())
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def parse_tool(tool_str):
+    result = extract_json(tool_str)
+    # some judge outputs wrap the question dict in [...] instead of {...}
+    if (result is None or isinstance(result, list)) and isinstance(tool_str, str):
+        inner = _candidate(tool_str).strip()
+        if inner.startswith("[") and inner.endswith("]"):
+            wrapped = extract_json("{" + inner[1:-1] + "}")
+            if isinstance(wrapped, dict):
+                return wrapped
+    return result
+
+
+def parse_augmented(tool_str):
+    # UltraComposer output -> ({"augmented query": str, "question": [str]}, json string)
+    result = extract_json(tool_str)
+    if not isinstance(result, dict):
+        return None, None
+    if isinstance(result.get("question"), str):
+        result["question"] = [result["question"]]
+    return result, json.dumps(result, ensure_ascii=False)
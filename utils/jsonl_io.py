@@ -0,0 +1,288 @@
+import argparse
+import gzip
+import io
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# shared JSONL I/O for every script:
+# - iter_jsonl: fast reader (orjson when installed), plain, .zst or .gz
+# - JsonlWriter: one buffered handle per output instead of reopening the file for every record;
+#   mode "w" writes to a temporary file renamed over the target on success, mode "a" appends
+#   (outputs under a StageManifest, which truncates them back to the last checkpoint itself)
+# - RotatingJsonlWriter: batch request files split to stay under provider limits
+# Compressed outputs end a zstd frame / gzip member at every flush, so StageManifest can cut them
+# back to a checkpoint offset like a plain file; batch outputs stay plain since readers seek into them.
+
+write_buffer = 1 << 20
+
+# OpenAI batch limits per input file
+batch_max_requests = 50000
+batch_max_bytes = 200 * 1024 * 1024
+
+
+def loads(line):
+    # bytes or str line -> value; json handles what orjson refuses (NaN, integers beyond 64 bits)
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(line)
+
+
+def dumps(value):
+    # same text as jsonlines / json.dumps(ensure_ascii=False), so outputs do not change byte-wise
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _require_zstandard(path):
+    if zstandard is None:
+        raise ImportError(f"{path}: install zstandard to read or write .zst files")
+
+
+class ZstdTextWriter:
+    # appends text to a .zst file; every flush() ends a zstd frame
+    def __init__(self, path, mode="a", level=3):
+        _require_zstandard(path)
+        self.raw = open(path, mode + "b")
+        self.writer = zstandard.ZstdCompressor(level=level).stream_writer(self.raw, closefd=False)
+
+    def write(self, text):
+        return self.writer.write(text.encode("utf-8"))
+
+    def flush(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+        self.raw.flush()
+
+    def close(self):
+        if not self.raw.closed:
+            self.flush()
+            self.writer.close()
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GzipTextWriter:
+    # appends text to a .gz file; every flush() ends a gzip member (multi-member files read as one stream)
+    def __init__(self, path, mode="a", level=6):
+        self.raw = open(path, mode + "b")
+        self.level = level
+        self.member = None
+
+    def write(self, text):
+        if self.member is None:
+            self.member = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=self.level)
+        return self.member.write(text.encode("utf-8"))
+
+    def flush(self):
+        if self.member is not None:
+            self.member.close()
+            self.member = None
+        self.raw.flush()
+
+    def close(self):
+        if not self.raw.closed:
+            self.flush()
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_text(path, mode="r", buffering=-1):
+    # mode "r", "w" or "a"; decompresses / compresses transparently for .zst and .gz paths
+    if path.endswith(".zst"):
+        _require_zstandard(path)
+        if mode == "r":
+            reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+            return io.TextIOWrapper(reader, encoding="utf-8")
+        return ZstdTextWriter(path, mode)
+    if path.endswith(".gz"):
+        if mode == "r":
+            return gzip.open(path, "rt", encoding="utf-8")
+        return GzipTextWriter(path, mode)
+    return open(path, mode, encoding="utf-8", buffering=buffering)
+
+
+def open_binary(path):
+    # readable byte stream of a possibly compressed file
+    if path.endswith(".zst"):
+        _require_zstandard(path)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True))
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def plain_path(path):
+    # path without the compression suffix
+    for suffix in (".zst", ".gz"):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def iter_jsonl(path, offset=0):
+    # offset: byte position of a line start to begin reading at (plain files only)
+    with open_binary(path) as f:
+        if offset:
+            f.seek(offset)
+        for line in f:
+            line = line.strip()
+            if line:
+                yield loads(line)
+
+
+class JsonlWriter:
+    """Buffered JSONL writer for one output file.
+
+    Records are serialized into an in-memory buffer that is written out in
+    `buffer_size` blocks. Mode "w" writes to <path>.<pid>.tmp and renames it
+    over `path` when closed without an error, so readers never see a
+    half-written file; mode "a" appends in place. flush() (called by
+    StageManifest.checkpoint) pushes everything to the file.
+    """
+
+    def __init__(self, path, mode="w", buffer_size=None):
+        assert mode in ("w", "a")
+        self.path = path
+        self.mode = mode
+        self.buffer_size = buffer_size or write_buffer
+        self.write_path = f"{path}.{os.getpid()}.tmp" if mode == "w" else path
+        self.f = open_text(self.write_path, mode, buffering=self.buffer_size)
+        self.buffer = []
+        self.buffered = 0
+        self.records = 0
+        self.closed = False
+
+    def write_line(self, line):
+        # one serialized record, without the newline
+        self.buffer.append(line)
+        self.buffered += len(line) + 1
+        self.records += 1
+        if self.buffered >= self.buffer_size:
+            self._drain()
+
+    def write(self, value):
+        self.write_line(dumps(value))
+
+    def _drain(self):
+        if self.buffer:
+            self.f.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+            self.buffered = 0
+
+    def flush(self):
+        self._drain()
+        self.f.flush()
+
+    def close(self, commit=True):
+        if self.closed:
+            return
+        self.closed = True
+        if commit or self.mode == "a":
+            self.flush()
+        self.f.close()
+        if self.mode == "w":
+            if commit:
+                os.replace(self.write_path, self.path)
+            elif os.path.exists(self.write_path):
+                os.remove(self.write_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # an exception leaves a "w" target untouched; "a" keeps what was written
+        self.close(commit=exc_type is None)
+
+
+def rotated_path(path, part):
+    # requests.jsonl -> requests.part-00001.jsonl (compression suffix kept)
+    stem, ext = os.path.splitext(plain_path(path))
+    return f"{stem}.part-{part:05d}{ext}{path[len(plain_path(path)):]}"
+
+
+class RotatingJsonlWriter:
+    """Writes batch request files of at most `max_requests` lines and `max_bytes` bytes
+    (uncompressed), switching to the next part file before a limit would be exceeded."""
+
+    def __init__(self, path, max_requests=None, max_bytes=None, buffer_size=None):
+        self.path = path
+        self.max_requests = max_requests or batch_max_requests
+        self.max_bytes = max_bytes or batch_max_bytes
+        self.buffer_size = buffer_size
+        self.paths = []
+        self.writer = None
+        self.bytes = 0
+
+    def write(self, value):
+        self.write_line(dumps(value))
+
+    def write_line(self, line):
+        size = len(line.encode("utf-8")) + 1
+        if self.writer is None or self.writer.records >= self.max_requests or self.bytes + size > self.max_bytes:
+            self._rotate()
+        self.writer.write_line(line)
+        self.bytes += size
+
+    def _rotate(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.paths.append(rotated_path(self.path, len(self.paths)))
+        self.writer = JsonlWriter(self.paths[-1], "w", self.buffer_size)
+        self.bytes = 0
+
+    def close(self, commit=True):
+        if self.writer is not None:
+            self.writer.close(commit)
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(commit=exc_type is None)
+
+
+def split_batch(path, max_requests=None, max_bytes=None):
+    # -> the part files of an existing request file cut to the batch limits
+    with RotatingJsonlWriter(path, max_requests, max_bytes) as f:
+        with open_text(path, "r") as fin:
+            for line in fin:
+                line = line.strip()
+                if line:
+                    f.write_line(line)
+    print(f"{path}: {len(f.paths)} part files: {', '.join(f.paths)}")
+    return f.paths
+
+
+if __name__ == "__main__":
+    # python utils/jsonl_io.py split -i extract_constraint_prompts.jsonl --max-requests 50000 --max-mb 200
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["split"])
+    parser.add_argument("-i", "--input", required=True)
+    parser.add_argument("--max-requests", default=batch_max_requests, type=int)
+    parser.add_argument("--max-mb", default=batch_max_bytes // 2**20, type=int)
+    args = parser.parse_args()
+
+    split_batch(args.input, args.max_requests, args.max_mb * 2**20)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import open_text, write_buffer
+
+
+def file_fingerprint(path, previous=None):
+    # sha256 of the file content; re-hashing is skipped when size and mtime match the previous fingerprint
+    stat = os.stat(path)
+    if previous is not None and previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime:
+        return previous
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 22), b""):
+            sha.update(block)
+    return {"sha256": sha.hexdigest(), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def truncate_partial_line(path):
+    # drop a half-written last line left behind by a crash
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        while pos > 0:
+            step = min(1 << 16, pos)
+            f.seek(pos - step)
+            block = f.read(step)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                pos = pos - step + newline + 1
+                break
+            pos -= step
+        if pos != end:
+            f.truncate(pos)
+
+
+# called with the manifest before every checkpoint is saved; a hook that raises keeps the checkpoint
+# from being recorded (utils/scheduler.py checks that the worker still holds its chunk)
+checkpoint_hooks = []
+
+
+class StageManifest:
+    """Checkpoint of a stage, stored as <first output>.manifest.json.
+
+    Records the fingerprints of the inputs, the stage parameters, the range of
+    input records already processed and the byte offset of every output file
+    at that point. On restart the outputs are truncated back to the last
+    checkpoint and the stage skips `completed` records; a manifest written for
+    different inputs or parameters is refused instead of mixing outputs.
+    """
+
+    def __init__(self, inputs, outputs, params=None, resume=True):
+        self.inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        self.outputs = [outputs] if isinstance(outputs, str) else list(outputs)
+        self.path = self.outputs[0] + ".manifest.json"
+        self.params = params or {}
+        previous = None
+        if resume and os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                previous = json.load(f)
+        old_fingerprints = previous["inputs"] if previous is not None else {}
+        self.fingerprints = {p: file_fingerprint(p, old_fingerprints.get(p)) for p in self.inputs}
+
+        self.start = 0
+        self.completed = 0
+        self.finished = False
+        offsets = {}
+        if previous is not None:
+            if [fp["sha256"] for fp in previous["inputs"].values()] != [fp["sha256"] for fp in self.fingerprints.values()] \
+                    or previous["params"] != json.loads(json.dumps(self.params)):
+                raise RuntimeError(f"{self.path} was written for different inputs or parameters; "
+                                   f"remove it (and the outputs) or run with resume=False")
+            self.start, self.completed = previous["completed"]
+            self.finished = previous.get("finished", False)
+            offsets = previous["offsets"]
+            if self.completed:
+                print(f"resuming {self.outputs[0]} after {self.completed - self.start} records")
+        # outputs are cut back to the last checkpoint, or emptied for a fresh run
+        for p in self.outputs:
+            with open(p, "ab") as f:
+                f.truncate(offsets.get(p, 0))
+
+    def open(self, path):
+        assert path in self.outputs
+        return open_text(path, "a", buffering=write_buffer)
+
+    def checkpoint(self, completed, files=(), start=None):
+        # `completed` input records are fully written; flush the outputs and record where they end
+        for hook in checkpoint_hooks:
+            hook(self)
+        for f in files:
+            f.flush()
+        if start is not None:
+            self.start = start
+        self.completed = completed
+        self._save()
+
+    def finish(self, files=()):
+        self.finished = True
+        self.checkpoint(self.completed, files)
+
+    def _save(self):
+        state = {
+            "inputs": self.fingerprints,
+            "params": self.params,
+            "completed": [self.start, self.completed],
+            "offsets": {p: os.path.getsize(p) for p in self.outputs},
+            "finished": self.finished,
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+def record_rewrite(path):
+    # after a finished output was rewritten in place (e.g. utils/repair.py), move the offset its
+    # manifest keeps for it so a resumed run does not cut the file back to the old size
+    manifest_path = path + ".manifest.json"
+    if not os.path.exists(manifest_path):
+        return
+    with open(manifest_path, "r") as f:
+        state = json.load(f)
+    state["offsets"][path] = os.path.getsize(path)
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, manifest_path)
@@ -0,0 +1,123 @@
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.prefix_cache import PrefixCache
+from utils.tokens import ApproxTokenizer
+
+
+# minimal OpenAI-compatible /v1/chat/completions for exercising the online modes locally:
+# judge prompts get a random YES/NO verdict per question (per response for multi-response prompts),
+# score-only judge prompts get one "... Question q: YES" line each with logprobs, everything else gets filler text.
+# Prompt tokens go through a simulated prefix cache: usage carries prompt_tokens_details.cached_tokens,
+# GET /metrics has the vllm prefix cache counters and POST /reset_prefix_cache empties it
+class MockHandler(BaseHTTPRequestHandler):
+    pass_rate = 0.5
+    latency = 0.0
+    tokenizer = ApproxTokenizer()
+    prefix_cache = PrefixCache()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _score_lines(self, labels):
+        content, tokens = "", []
+        for label in labels:
+            score = "YES" if random.random() < self.pass_rate else "NO"
+            other = "NO" if score == "YES" else "YES"
+            confidence = random.uniform(0.55, 1.0)
+            for token in [word if i == 0 else " " + word for i, word in enumerate(label.split())] + [":"]:
+                tokens.append({"token": token, "logprob": 0.0, "top_logprobs": [{"token": token, "logprob": 0.0}]})
+            tokens.append({"token": " " + score, "logprob": math.log(confidence),
+                           "top_logprobs": [{"token": " " + score, "logprob": math.log(confidence)}, {"token": " " + other, "logprob": math.log(1 - confidence)}]})
+            tokens.append({"token": "\n", "logprob": 0.0, "top_logprobs": [{"token": "\n", "logprob": 0.0}]})
+            content += f"{label}: {score}\n"
+        return content, tokens
+
+    def _completion(self, body):
+        prompt = body["messages"][-1]["content"]
+        labels = re.findall(r"^((?:Response \d+ )?Question \d+): YES or NO$", prompt, re.M)
+        if labels:
+            content, tokens = self._score_lines(labels)
+            return content, ({"content": tokens} if body.get("logprobs") else None)
+        if "[Evaluator Question]" in prompt:
+            section = prompt.split("[Evaluator Question]")[-1].split("\n\n")[0]
+            questions = re.findall(r"(?:^|\n)\s*\d+\. ", section)
+            responses = re.findall(r"\n\[Response (\d+)\] ", prompt)
+            verdicts = []
+            for _ in range(max(len(responses), 1)):
+                verdict = {}
+                for i in range(1, len(questions) + 1):
+                    verdict[f"Question {i}"] = {"explanation": "", "score": "YES" if random.random() < self.pass_rate else "NO"}
+                verdicts.append(verdict)
+            if responses:
+                # multi-response judge prompt -> "Response r" x "Question q" matrix
+                verdicts = {f"Response {r}": verdict for r, verdict in enumerate(verdicts, start=1)}
+            else:
+                verdicts = verdicts[0]
+            return "```json\n" + json.dumps(verdicts, indent=4) + "\n```", None
+        return "mock response " + uuid.uuid4().hex[:8], None
+
+    def _send(self, payload, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        cache = self.prefix_cache
+        lines = []
+        for name, value in (("vllm:prefix_cache_queries_total", cache.queries), ("vllm:prefix_cache_hits_total", cache.hits)):
+            lines += [f"# TYPE {name} counter", f'{name}{{model_name="mock"}} {float(value)}']
+        self._send(("\n".join(lines) + "\n").encode(), "text/plain; version=0.0.4")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if self.path == "/reset_prefix_cache":
+            self.prefix_cache.reset()
+            self._send(b"")
+            return
+        body = json.loads(self.rfile.read(length))
+        prompt_tokens = self.tokenizer.chat_tokens(body["messages"])
+        cached_tokens = self.prefix_cache.lookup(prompt_tokens)
+        if self.latency:
+            time.sleep(self.latency)
+        choices = []
+        for i in range(body.get("n", 1)):
+            content, logprobs = self._completion(body)
+            choices.append({"index": i, "message": {"role": "assistant", "content": content}, "logprobs": logprobs, "finish_reason": "stop"})
+        payload = json.dumps({
+            "id": "chatcmpl-" + uuid.uuid4().hex,
+            "object": "chat.completion",
+            "model": body.get("model"),
+            "choices": choices,
+            "usage": {"prompt_tokens": len(prompt_tokens), "completion_tokens": 16 * len(choices), "total_tokens": len(prompt_tokens) + 16 * len(choices),
+                      "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+        }).encode()
+        self._send(payload)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--pass-rate", default=0.5, type=float)
+    parser.add_argument("--latency", default=0.0, type=float)
+    parser.add_argument("--cache-blocks", default=100000, type=int, help="prefix cache size in blocks of 16 tokens")
+    args = parser.parse_args()
+
+    MockHandler.pass_rate = args.pass_rate
+    MockHandler.latency = args.latency
+    MockHandler.prefix_cache = PrefixCache(capacity=args.cache_blocks)
+    ThreadingHTTPServer(("127.0.0.1", args.port), MockHandler).serve_forever()
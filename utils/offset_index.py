@@ -0,0 +1,158 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sys
+from array import array
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import loads
+from utils.projection import line_custom_id
+
+
+# sidecar custom_id -> (byte offset, length) index of a batch result JSONL file, written next to it as
+# <path>.idx.npy and <path>.idx.json (the size and mtime of the file it was built for; a changed file is
+# re-indexed). The .npy holds three uint64 rows, key / offset / length, sorted by key, a 64-bit hash of
+# the custom_id; rows are contiguous so a lookup touches a few pages of the memory-mapped key row.
+# The result file is memory-mapped too and only the requested lines are parsed.
+
+def id_key(custom_id):
+    return int.from_bytes(hashlib.blake2b(custom_id.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def index_paths(path):
+    return path + ".idx.npy", path + ".idx.json"
+
+
+def build_index(path, save=True):
+    # one streaming pass over the file; -> (3, records) array sorted by key (stable, so equal keys keep file order).
+    # The size and mtime are taken before the pass and only that many bytes are indexed: a file appended to
+    # meanwhile is re-indexed on the next load instead of matching an index that misses its tail
+    stat = os.stat(path)
+    keys, offsets, lengths = array("Q"), array("Q"), array("I")
+    offset = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if offset + len(line) > stat.st_size:
+                break
+            if line.strip():
+                keys.append(id_key(line_custom_id(line)))
+                offsets.append(offset)
+                lengths.append(len(line))
+            offset += len(line)
+    entries = np.stack([np.frombuffer(keys, dtype=np.uint64), np.frombuffer(offsets, dtype=np.uint64),
+                        np.frombuffer(lengths, dtype=np.uint32).astype(np.uint64)]) if len(keys) else np.zeros((3, 0), dtype=np.uint64)
+    entries = entries[:, np.argsort(entries[0], kind="stable")]
+    if save:
+        npy_path, meta_path = index_paths(path)
+        try:
+            np.save(npy_path + ".tmp.npy", entries)
+            os.replace(npy_path + ".tmp.npy", npy_path)
+            with open(meta_path, "w") as f:
+                json.dump({"size": stat.st_size, "mtime": stat.st_mtime, "records": len(entries)}, f)
+        except OSError as e:
+            # read-only result directory: the index only lives as long as the reader
+            print(f"could not save the offset index of {path}: {e}")
+    return entries
+
+
+def load_index(path):
+    # the saved index when it was built for the file as it is now, else None
+    npy_path, meta_path = index_paths(path)
+    if not (os.path.exists(npy_path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    stat = os.stat(path)
+    if meta["size"] != stat.st_size or meta["mtime"] != stat.st_mtime:
+        return None
+    return np.load(npy_path, mmap_mode="r")
+
+
+class OffsetIndex:
+    """Random access into one JSONL result file by custom_id or record number.
+
+    The sidecar index is loaded (memory-mapped) when it matches the file and
+    built otherwise. Duplicate custom_ids resolve to the last line, as when
+    the file is read into a dict.
+    """
+
+    def __init__(self, path, save=True):
+        self.path = path
+        self.entries = load_index(path)
+        if self.entries is None:
+            self.entries = build_index(path, save=save)
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        self._ordered = None
+
+    def __len__(self):
+        return self.entries.shape[1]
+
+    def get_raw(self, custom_id):
+        # line bytes of the record, None when absent
+        key = np.uint64(id_key(custom_id))
+        keys, offsets, lengths = self.entries
+        lo = int(np.searchsorted(keys, key, side="left"))
+        hi = int(np.searchsorted(keys, key, side="right"))
+        for i in range(hi - 1, lo - 1, -1):
+            offset, length = int(offsets[i]), int(lengths[i])
+            line = self.data[offset:offset + length]
+            # a 64-bit key collision is possible in principle, the id in the line decides
+            if hi - lo == 1 or line_custom_id(line) == custom_id:
+                return line
+        return None
+
+    def get(self, custom_id):
+        line = self.get_raw(custom_id)
+        return loads(line) if line is not None else None
+
+    def __contains__(self, custom_id):
+        return self.get_raw(custom_id) is not None
+
+    def range(self, start, stop=None):
+        # records start..stop-1 in file order, read as one block
+        if self._ordered is None:
+            self._ordered = self.entries[:, np.argsort(self.entries[1])]
+        rows = self._ordered[:, start:stop]
+        if rows.shape[1] == 0:
+            return
+        block = self.data[int(rows[1, 0]):int(rows[1, -1]) + int(rows[2, -1])]
+        for line in block.split(b"\n"):
+            if line.strip():
+                yield loads(line)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    # python utils/offset_index.py build -i output.jsonl
+    # python utils/offset_index.py get -i output.jsonl --id request-0123abcd-2
+    # python utils/offset_index.py range -i output.jsonl --start 1000000 --stop 1000010
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["build", "get", "range"])
+    parser.add_argument("-i", "--input", required=True, help="batch result file")
+    parser.add_argument("--id", help="custom_id to fetch")
+    parser.add_argument("--start", default=0, type=int)
+    parser.add_argument("--stop", default=None, type=int)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        print(f"{args.input}: {build_index(args.input).shape[1]} records indexed")
+    else:
+        with OffsetIndex(args.input) as index:
+            records = [index.get(args.id)] if args.command == "get" else index.range(args.start, args.stop)
+            for record in records:
+                print(json.dumps(record, ensure_ascii=False))
@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import AsyncRetrying, Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.completion_cache import CompletionCache
+from utils.manifest import StageManifest
+from utils.schemas import GUIDED_BACKENDS, for_backend
+
+
+class RetryableStatus(Exception):
+    def __init__(self, status, text):
+        super().__init__(f"{status}: {text[:200]}")
+        self.status = status
+
+
+class OpenAIClient:
+    """Blocking client for an OpenAI-compatible server (vllm serve, sglang, ...).
+
+    `base_url` is the server root, e.g. http://localhost:8000; request paths are
+    the same `url` fields the batch files carry ("/v1/chat/completions").
+    `guided` is the server's guided decoding backend (utils.schemas.for_backend).
+    One pooled session is shared, so the client can be used from a thread pool.
+    """
+
+    def __init__(self, base_url, api_key=None, timeout=600, max_attempts=6, pool_size=64, cache=None, guided="vllm"):
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.guided = guided
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key is not None:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def post(self, body, url="/v1/chat/completions"):
+        if self.cache is not None:
+            cached = self.cache.get(body)
+            if cached is not None:
+                return cached
+        # 429 / 5xx / connection errors are retried, other 4xx (context length, rejected schema) fail at once
+        retrying = Retrying(stop=stop_after_attempt(self.max_attempts), wait=wait_random_exponential(min=1, max=60),
+                            retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout, RetryableStatus)), reraise=True)
+        for attempt in retrying:
+            with attempt:
+                resp = self.session.post(self.base_url + url, json=for_backend(body, self.guided), timeout=self.timeout)
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    raise RetryableStatus(resp.status_code, resp.text)
+                resp.raise_for_status()
+                result = resp.json()
+        if self.cache is not None:
+            self.cache.put(body, result)
+        return result
+
+    def chat(self, messages, **params):
+        return self.post({"messages": messages, **params})
+
+
+class TokenBucket:
+    """Asyncio token bucket: `rate` requests per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncOpenAIClient:
+    """Asyncio counterpart of OpenAIClient.
+
+    At most `concurrency` requests are in flight over one pooled aiohttp
+    connector, `rate` (requests/s) is enforced with a token bucket, and 429 /
+    5xx / connection errors / timeouts are retried with jittered exponential
+    backoff; other 4xx responses fail at once. A request waiting for its next
+    attempt does not hold a concurrency slot.
+    Must be created and closed inside the running event loop.
+    """
+
+    def __init__(self, base_url, api_key=None, concurrency=64, rate=None, timeout=600, max_attempts=6, cache=None, guided="vllm"):
+        import aiohttp
+
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.guided = guided
+        self.max_attempts = max_attempts
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate) if rate else None
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key is not None else {}
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers=headers,
+        )
+        # ClientResponseError (raise_for_status) is a ClientError too, so only connection errors are listed
+        self.retry_on = (aiohttp.ClientConnectionError, asyncio.TimeoutError, RetryableStatus)
+
+    async def _post_once(self, body, url):
+        async with self.semaphore:
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            async with self.session.post(self.base_url + url, json=body) as resp:
+                if resp.status == 429 or resp.status >= 500:
+                    raise RetryableStatus(resp.status, await resp.text())
+                resp.raise_for_status()
+                return await resp.json()
+
+    async def post(self, body, url="/v1/chat/completions"):
+        # the sqlite cache blocks (a put commits), so it runs in a worker thread, off the event loop
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, body)
+            if cached is not None:
+                return cached
+        # the cache is keyed by the body as the stages wrote it, whatever server answers it
+        result = await self._post(for_backend(body, self.guided), url)
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, body, result)
+        return result
+
+    async def _post(self, body, url):
+        retrying = AsyncRetrying(
+            stop=stop_after_attempt(self.max_attempts),
+            wait=wait_random_exponential(min=1, max=60),
+            retry=retry_if_exception_type(self.retry_on),
+            reraise=True,
+        )
+        async for attempt in retrying:
+            with attempt:
+                return await self._post_once(body, url)
+
+    async def chat(self, messages, **params):
+        return await self.post({"messages": messages, **params})
+
+    async def close(self):
+        await self.session.close()
+
+
+def to_batch_output(custom_id, body=None, error=None):
+    # same line layout as the OpenAI batch API / vllm run_batch output files
+    return {
+        "id": "batch_req_" + uuid.uuid4().hex,
+        "custom_id": custom_id,
+        "response": None if body is None else {"status_code": 200, "request_id": body.get("id"), "body": body},
+        "error": None if error is None else {"code": type(error).__name__, "message": str(error)},
+    }
+
+
+async def run_batch_online_async(input_path, output_path, base_url, api_key=None, concurrency=64, rate=None, cache=None, resume=True, guided="vllm"):
+    # on restart, requests that already have a successful result in the output are not sent again;
+    # failed ones are sent again and their error lines removed, so every custom_id keeps one line
+    manifest = StageManifest(input_path, output_path, params={"stage": "online_batch"}, resume=resume)
+    finished_ids = set()
+    errors = 0
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            result = json.loads(line)
+            if result["error"] is None:
+                finished_ids.add(result["custom_id"])
+            else:
+                errors += 1
+    if errors:
+        with open(output_path, "r", encoding="utf-8") as fin, open(output_path + ".tmp", "w", encoding="utf-8") as fout:
+            for line in fin:
+                if json.loads(line)["error"] is None:
+                    fout.write(line)
+        os.replace(output_path + ".tmp", output_path)
+        print(f"sending {errors} failed requests again")
+    if finished_ids:
+        print(f"skipping {len(finished_ids)} finished requests")
+    # `done` counts finished requests, including those of earlier runs
+    done, failed = len(finished_ids), 0
+    manifest.checkpoint(done)
+    client = AsyncOpenAIClient(base_url, api_key=api_key, concurrency=concurrency, rate=rate, cache=cache, guided=guided)
+    pending = set()
+
+    async def call(request):
+        try:
+            body = await client.post(request["body"], request.get("url", "/v1/chat/completions"))
+            return to_batch_output(request["custom_id"], body=body)
+        except Exception as e:
+            return to_batch_output(request["custom_id"], error=e)
+
+    def flush(finished, f):
+        nonlocal done, failed
+        for task in finished:
+            result = task.result()
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            done += 1
+            failed += result["error"] is not None
+            if done % 1000 == 0:
+                manifest.checkpoint(done, [f])
+        f.flush()
+
+    pbar = tqdm()
+    try:
+        with open(input_path, "r", encoding="utf-8") as fin, manifest.open(output_path) as f:
+            for line in fin:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                if request["custom_id"] in finished_ids:
+                    continue
+                # keep a bounded window of outstanding requests so the input is never fully loaded
+                if len(pending) >= 2 * concurrency:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    flush(finished, f)
+                    pbar.update(len(finished))
+                pending.add(asyncio.ensure_future(call(request)))
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                flush(finished, f)
+                pbar.update(len(finished))
+            manifest.checkpoint(done, [f])
+            manifest.finish([f])
+    finally:
+        pbar.close()
+        await client.close()
+    print(f"{done - len(finished_ids)} requests, {failed} failed")
+    if cache is not None:
+        cache.report(os.path.basename(input_path))
+
+
+def run_batch_online(input_path, output_path, base_url, api_key=None, concurrency=64, rate=None, cache=None, resume=True, guided="vllm"):
+    # drop-in replacement for `python -m vllm.entrypoints.openai.run_batch -i ... -o ...` against a running server
+    asyncio.run(run_batch_online_async(input_path, output_path, base_url, api_key=api_key, concurrency=concurrency, rate=rate, cache=cache, resume=resume,
+                                       guided=guided))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True)
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--concurrency", default=64, type=int)
+    parser.add_argument("--rate", default=None, type=float, help="max requests per second")
+    parser.add_argument("--cache", default=None, help="sqlite completion cache shared across stages")
+    parser.add_argument("--no-resume", action="store_true", help="ignore an existing manifest and start over")
+    parser.add_argument("--guided", default="vllm", choices=GUIDED_BACKENDS, help="guided decoding parameters the server accepts")
+    args = parser.parse_args()
+
+    cache = CompletionCache(args.cache) if args.cache else None
+    run_batch_online(args.input, args.output, args.base_url, api_key=args.api_key, concurrency=args.concurrency, rate=args.rate, cache=cache, resume=not args.no_resume,
+                     guided=args.guided)
@@ -0,0 +1,548 @@
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.manifest import file_fingerprint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# incremental runner for the stage graph in pipeline.yaml (UltraComposer -> augmentation -> rejection sampling).
+# Every stage runs in its own directory <work_dir>/<partition>/<stage>/, once per partition (per_source,
+# the default) or once over all of them (<work_dir>/_all/<stage>/). A partition is a source dataset, or the
+# records appended to one since the last run ("sharegpt@2", ...), so new datasets and new records go through
+# the per_source stages alone; only the aggregate stages after them run over everything again. Editing
+# records of a source runs all of it again.
+# A stage is skipped when the content hashes of its inputs, its configuration, its script and the repo modules
+# the script imports (utils/...) are the ones its last successful run recorded and its outputs are unchanged.
+# A stage re-run because something changed starts from scratch; an interrupted one resumes through its own
+# StageManifest.
+# --dry-run prints the plan and writes nothing: per stage and partition, whether it runs and why, and for
+# batch stages the requests it sends (the lines of its request file when that is current, else `estimate` per source record).
+#
+# stage kinds:
+#   call: path/to/script.py:function   called with `args`
+#   script: path/to/script.py          run with `argv`, for scripts without a function entry point
+#   batch: <server>                    sends args.input_path to a server of `servers` (utils/online_client.py) into args.output_path
+#   concat: [refs]                     concatenates files into outputs[0]
+#   external: true                     made outside the runner (model training); done when its outputs exist
+# values in args / argv / links / concat:
+#   "{source}"            the source records of the partition
+#   "@stage/file"         a file of another stage (of the same partition; from an aggregate stage: of all partitions, as a list)
+#   anything else         as is; relative file names are inside the stage directory
+# links: {name: ref} places an input under the name a script expects in its directory;
+# after: [stages] runs a stage after others it does not read from (and again when they are redone)
+#
+# python utils/pipeline.py run -c pipeline.yaml --dry-run
+# python utils/pipeline.py run -c pipeline.yaml [--only extract_constraint_batch] [--source sharegpt]
+
+KINDS = ("call", "script", "batch", "concat", "external")
+
+
+def load_config(path):
+    with open(path, "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    config["work_dir"] = os.path.join(base, config.get("work_dir", "./pipeline_work"))
+    config["sources"] = {name: os.path.join(base, p) for name, p in (config.get("sources") or {}).items()}
+    for server in (config.get("servers") or {}).values():
+        if isinstance(server, dict) and "cache" in server:
+            server["cache"] = os.path.join(base, server["cache"])
+    for name, stage in config["stages"].items():
+        kinds = [kind for kind in KINDS if kind in stage]
+        assert len(kinds) == 1, f"stage {name} needs exactly one of {KINDS}"
+        stage["kind"] = kinds[0]
+        stage.setdefault("per_source", True)
+        stage.setdefault("outputs", [])
+    return config
+
+
+class Fingerprints:
+    # sha256 of files (and of the listings of directories), re-hashed only when size or mtime changed
+    def __init__(self, path):
+        self.path = path
+        self.known = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.known = json.load(f)
+
+    def get(self, path):
+        if not os.path.exists(path):
+            return None
+        if os.path.isdir(path):
+            entries = []
+            for root, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    entries.append([os.path.relpath(full, path), self.get(full)])
+            return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+        self.known[path] = file_fingerprint(path, self.known.get(path))
+        return self.known[path]["sha256"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.known, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def scan_segments(path, known):
+    # -> [[start, end, sha256 of bytes [0, end), sha256 of bytes [start, end)]] of a source file: the segments
+    # of earlier runs while the file still starts with them, plus one for what was appended since;
+    # a single segment again when the file was edited or shortened
+    ends = {segment[1]: segment[2] for segment in known}
+    prefix, part = hashlib.sha256(), hashlib.sha256()
+    segments, start, pos, edited = [], 0, 0, False
+    with open(path, "rb") as f:
+        for line in f:
+            prefix.update(line)
+            part.update(line)
+            pos += len(line)
+            if pos in ends:
+                if prefix.hexdigest() != ends.pop(pos):
+                    edited = True
+                    break
+                segments.append([start, pos, prefix.hexdigest(), part.hexdigest()])
+                start, part = pos, hashlib.sha256()
+    if edited or ends:
+        digest = file_fingerprint(path)["sha256"]
+        return [[0, os.path.getsize(path), digest, digest]]
+    if pos > start:
+        segments.append([start, pos, prefix.hexdigest(), part.hexdigest()])
+    return segments
+
+
+def imported_modules(path):
+    # -> files of the repo modules a script imports (utils.*, or modules next to the script), also imports
+    # inside functions
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            # from utils import jsonl_io imports a module too
+            names.append(node.module)
+            names.extend(f"{node.module}.{alias.name}" for alias in node.names)
+    paths = []
+    for name in names:
+        for base in (ROOT, os.path.dirname(path)):
+            module = os.path.join(base, *name.split("."))
+            paths.extend(p for p in (module + ".py", os.path.join(module, "__init__.py")) if os.path.isfile(p))
+    return paths
+
+
+class Pipeline:
+    def __init__(self, config_path):
+        self.config = load_config(config_path)
+        self.work_dir = self.config["work_dir"]
+        self.stages = self.config["stages"]
+        self.sources = self.config["sources"]
+        self.servers = self.config.get("servers") or {}
+        self.fingerprints = Fingerprints(os.path.join(self.work_dir, ".fingerprints.json"))
+        self.code = {}
+        self.partitions = self._partitions()
+        self.order = self._topological_order()
+
+    def _partitions(self):
+        # every source is split into the segments it was appended in, one partition each ("name", "name@2", ...),
+        # so records appended to a source run through the per_source stages on their own
+        self.segments_path = os.path.join(self.work_dir, ".sources.json")
+        known = {}
+        if os.path.exists(self.segments_path):
+            with open(self.segments_path, "r") as f:
+                known = json.load(f)
+        self.segments = {}
+        partitions = {}
+        for name, path in self.sources.items():
+            assert os.path.exists(path), f"source {name}: {path} does not exist"
+            previous = known.get(name, {})
+            segments = previous.get("segments", []) if previous.get("path") == path else []
+            # unchanged since the last scan: the whole file is the last known prefix
+            if not segments or self.fingerprints.get(path) != segments[-1][2]:
+                segments = scan_segments(path, segments)
+                if previous.get("segments") and segments[0] != previous["segments"][0]:
+                    print(f"source {name} was edited, all its records run again")
+            self.segments[name] = {"path": path, "segments": segments}
+            for i, (start, end, _, digest) in enumerate(segments):
+                partitions[name if i == 0 else f"{name}@{i + 1}"] = {"source": name, "path": path, "start": start, "end": end, "sha256": digest}
+        return partitions
+
+    def segment_path(self, partition):
+        return os.path.join(self.work_dir, partition, "source.jsonl")
+
+    def write_segment(self, partition):
+        part = self.partitions[partition]
+        path = self.segment_path(partition)
+        if self.fingerprints.get(path) == part["sha256"]:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(part["path"], "rb") as fin, open(path + ".tmp", "wb") as fout:
+            fin.seek(part["start"])
+            remaining = part["end"] - part["start"]
+            while remaining:
+                block = fin.read(min(remaining, 1 << 24))
+                fout.write(block)
+                remaining -= len(block)
+        os.replace(path + ".tmp", path)
+
+    # graph
+
+    def refs(self, value):
+        # -> stage names referenced by a value
+        if isinstance(value, list):
+            return [ref for item in value for ref in self.refs(item)]
+        if isinstance(value, dict):
+            return [ref for item in value.values() for ref in self.refs(item)]
+        if isinstance(value, str) and value.startswith("@"):
+            return [value[1:].split("/", 1)[0]]
+        return []
+
+    def dependencies(self, name):
+        stage = self.stages[name]
+        deps = self.refs([stage.get("args"), stage.get("argv"), stage.get("links"), stage.get("concat")])
+        unknown = [dep for dep in deps if dep not in self.stages]
+        assert not unknown, f"stage {name} refers to unknown stages {unknown}"
+        return list(dict.fromkeys(deps + list(stage.get("after", []))))
+
+    def _topological_order(self):
+        order, visiting = [], set()
+
+        def visit(name):
+            if name in order:
+                return
+            assert name not in visiting, f"cycle through stage {name}"
+            visiting.add(name)
+            for dep in self.dependencies(name):
+                visit(dep)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def instances(self, name):
+        # -> [(name, source)], source None for aggregate stages
+        if self.stages[name]["per_source"]:
+            return [(name, partition) for partition in self.partitions]
+        return [(name, None)]
+
+    def stage_dir(self, name, source):
+        return os.path.join(self.work_dir, source or "_all", name)
+
+    def resolve(self, value, source):
+        if isinstance(value, list):
+            return [self.resolve(item, source) for item in value]
+        if isinstance(value, dict):
+            return {key: self.resolve(item, source) for key, item in value.items()}
+        if not isinstance(value, str):
+            return value
+        if value == "{source}":
+            assert source is not None, "{source} is only defined in per_source stages"
+            return self.segment_path(source)
+        if value.startswith("@"):
+            name, file = value[1:].split("/", 1)
+            if self.stages[name]["per_source"] and source is None:
+                return [os.path.join(self.stage_dir(name, s), file) for s in self.partitions]
+            return os.path.join(self.stage_dir(name, source if self.stages[name]["per_source"] else None), file)
+        return value
+
+    def inputs(self, name, source):
+        # -> input file paths of an instance
+        stage = self.stages[name]
+        paths = []
+
+        def collect(raw, resolved):
+            if isinstance(raw, list):
+                for r, v in zip(raw, resolved):
+                    collect(r, v)
+            elif isinstance(raw, dict):
+                for key in raw:
+                    collect(raw[key], resolved[key])
+            elif isinstance(raw, str) and (raw == "{source}" or raw.startswith("@")):
+                paths.extend(resolved if isinstance(resolved, list) else [resolved])
+
+        for field in ("args", "argv", "links", "concat"):
+            if stage.get(field) is not None:
+                collect(stage[field], self.resolve(stage[field], source))
+        return paths
+
+    def code_path(self, stage):
+        if stage["kind"] == "call":
+            return os.path.join(ROOT, stage["call"].split(":")[0])
+        if stage["kind"] == "script":
+            return os.path.join(ROOT, stage["script"])
+        if stage["kind"] == "batch":
+            return os.path.join(ROOT, "utils", "online_client.py")
+        return None
+
+    def code_paths(self, stage):
+        # the entry script and every repo module it imports, directly or through other repo modules
+        entry = self.code_path(stage)
+        if entry is None:
+            return []
+        if entry not in self.code:
+            paths, pending = set(), [entry]
+            while pending:
+                path = pending.pop()
+                if path not in paths and os.path.isfile(path):
+                    paths.add(path)
+                    pending.extend(imported_modules(path))
+            self.code[entry] = sorted(paths)
+        return self.code[entry]
+
+    # state
+
+    def state_path(self, name, source):
+        return os.path.join(self.stage_dir(name, source), ".stage.json")
+
+    def read_state(self, name, source):
+        path = self.state_path(name, source)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def write_state(self, name, source, state):
+        path = self.state_path(name, source)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def key(self, name, source):
+        # content hash of everything a run depends on; None while an input does not exist yet
+        stage = self.stages[name]
+        inputs = {}
+        for path in self.inputs(name, source):
+            # the source segment counts by its content, also before it is written out
+            inputs[path] = self.partitions[source]["sha256"] if source and path == self.segment_path(source) else self.fingerprints.get(path)
+            if inputs[path] is None:
+                return None
+        spec = {key: value for key, value in stage.items() if key not in ("estimate", "after")}
+        # stages it only runs after (a trained model) count through the key they last completed with
+        after = {}
+        for dep in stage.get("after", []):
+            for _, s in self.instances(dep):
+                if s == source or s is None or source is None:
+                    after[f"{dep}/{s}"] = (self.read_state(dep, s) or {}).get("key")
+        payload = {"stage": spec, "server": self.servers.get(stage.get("batch")), "inputs": inputs, "after": after,
+                   "code": {os.path.relpath(p, ROOT): self.fingerprints.get(p) for p in self.code_paths(stage)}}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def output_paths(self, name, source):
+        directory = self.stage_dir(name, source)
+        return [os.path.join(directory, output) for output in self.stages[name]["outputs"]]
+
+    def status(self, name, source, stale_upstream):
+        # -> (run?, reason)
+        stage = self.stages[name]
+        state = self.read_state(name, source)
+        outputs = self.output_paths(name, source)
+        if stage["kind"] == "external":
+            # the runner cannot redo it, only tell when what it was made from has changed since
+            if not all(os.path.exists(p) for p in outputs):
+                return False, "external, missing: " + ", ".join(outputs)
+            if stale_upstream:
+                return False, "external, present but upstream changes: " + ", ".join(stale_upstream)
+            if state is not None and state["key"] != self.key(name, source):
+                return False, "external, present but its inputs changed since (remake it and delete " + self.state_path(name, source) + ")"
+            return False, "external, present"
+        if stale_upstream:
+            return True, "upstream changes: " + ", ".join(stale_upstream)
+        key = self.key(name, source)
+        if key is None:
+            return True, "inputs missing"
+        if state is None:
+            return True, "new"
+        if state["key"] != key:
+            return True, "inputs, configuration or code changed"
+        if state.get("status") != "done":
+            return True, "interrupted, resumes"
+        if any(self.fingerprints.get(p) != state["outputs"].get(p) for p in outputs):
+            return True, "outputs changed or missing"
+        return False, "up to date"
+
+    # dry run estimates
+
+    def count_records(self, path):
+        # non-blank lines without the shared message definitions of compact request files
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return sum(1 for line in f if line.strip() and not line.startswith(b'{"shared_message"'))
+
+    def estimate_requests(self, name, source):
+        # batch stages: the lines of the request file when it is current, else `estimate` requests per source record
+        stage = self.stages[name]
+        if stage["kind"] != "batch":
+            return None
+        request_path = self.resolve(stage["args"]["input_path"], source)
+        upstream = self.refs(stage["args"]["input_path"])[0]
+        if upstream not in self.will_run.get(source, set()) and os.path.exists(request_path):
+            return self.count_records(request_path)
+        if "estimate" in stage and source is not None:
+            part = self.partitions[source]
+            with open(part["path"], "rb") as f:
+                f.seek(part["start"])
+                records = sum(1 for line in f.read(part["end"] - part["start"]).splitlines() if line.strip())
+            return int(stage["estimate"] * records)
+        return None
+
+    # execution
+
+    def command(self, name, source):
+        stage = self.stages[name]
+        if stage["kind"] == "call":
+            script, function = stage["call"].split(":")
+            script = os.path.join(ROOT, script)
+            args = self.resolve(stage.get("args") or {}, source)
+            code = (f"import sys; sys.path.insert(0, {os.path.dirname(script)!r}); sys.argv = [{script!r}]; "
+                    f"import json, {os.path.splitext(os.path.basename(script))[0]} as stage; "
+                    f"stage.{function}(**json.loads({json.dumps(args)!r}))")
+            return [sys.executable, "-c", code]
+        if stage["kind"] == "script":
+            return [sys.executable, os.path.join(ROOT, stage["script"])] + [str(a) for a in self.resolve(stage.get("argv") or [], source)]
+        if stage["kind"] == "batch":
+            server = self.servers[stage["batch"]]
+            args = self.resolve(stage["args"], source)
+            command = [sys.executable, os.path.join(ROOT, "utils", "online_client.py"), "-i", args["input_path"], "-o", args["output_path"],
+                       "--base-url", server["url"] if isinstance(server, dict) else server]
+            for option in ("concurrency", "rate", "cache", "guided"):
+                if isinstance(server, dict) and option in server:
+                    command += [f"--{option}", str(server[option])]
+            return command
+        return None
+
+    def run_instance(self, name, source):
+        stage = self.stages[name]
+        directory = self.stage_dir(name, source)
+        key = self.key(name, source)
+        state = self.read_state(name, source)
+        if state is not None and state["key"] != key and os.path.isdir(directory):
+            # a changed stage starts over; the StageManifests would refuse the old outputs anyway
+            shutil.rmtree(directory)
+        os.makedirs(directory, exist_ok=True)
+        for link, ref in (stage.get("links") or {}).items():
+            target = self.resolve(ref, source)
+            link_path = os.path.join(directory, link)
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.symlink(os.path.abspath(target), link_path)
+        self.write_state(name, source, {"key": key, "status": "running", "started": time.time()})
+        print(f"==> {name}" + (f" [{source}]" if source else ""))
+        start = time.time()
+        if stage["kind"] == "concat":
+            # an output that is also listed as input (earlier concat) would be read while written
+            with open(self.output_paths(name, source)[0] + ".tmp", "wb") as fout:
+                for path in self.inputs(name, source):
+                    with open(path, "rb") as fin:
+                        shutil.copyfileobj(fin, fout)
+            os.replace(self.output_paths(name, source)[0] + ".tmp", self.output_paths(name, source)[0])
+        else:
+            env = {**os.environ, "PYTHONPATH": ROOT + os.pathsep + os.environ.get("PYTHONPATH", "")}
+            subprocess.run(self.command(name, source), cwd=directory, env=env, check=True)
+        missing = [p for p in self.output_paths(name, source) if not os.path.exists(p)]
+        if missing:
+            raise RuntimeError(f"stage {name} did not write {missing}")
+        self.write_state(name, source, {"key": key, "status": "done", "seconds": round(time.time() - start, 1),
+                                         "outputs": {p: self.fingerprints.get(p) for p in self.output_paths(name, source)}})
+        self.fingerprints.save()
+
+    def deps_of(self, name, source):
+        # -> [(stage, source)] instances an instance reads from or runs after
+        return [(dep, s) for dep in self.dependencies(name) for _, s in self.instances(dep)
+                if s == source or s is None or source is None]
+
+    def external_missing(self, name, source):
+        return self.stages[name]["kind"] == "external" and not all(os.path.exists(p) for p in self.output_paths(name, source))
+
+    def plan(self, only=None, sources=None):
+        # -> [(stage, source, action, reason)] in topological order; action: run, skip, or wait (for an external stage)
+        # only: stage names to consider (their upstream must be up to date); sources: partitions to consider
+        self.will_run = {}
+        waiting = set()
+        planned = []
+        for name in self.order:
+            for _, source in self.instances(name):
+                if sources is not None and source is not None and self.partitions[source]["source"] not in sources:
+                    continue
+                deps = self.deps_of(name, source)
+                blocked = [dep for dep, s in deps if (dep, s) in waiting or self.external_missing(dep, s)]
+                if blocked and self.stages[name]["kind"] != "external":
+                    action, reason = "wait", "waiting for " + ", ".join(dict.fromkeys(blocked))
+                    waiting.add((name, source))
+                else:
+                    stale = [dep + (f"[{s}]" if s else "") for dep, s in deps if dep in self.will_run.get(s, set())]
+                    run, reason = self.status(name, source, stale)
+                    action = "run" if run else "skip"
+                if only is not None and name not in only and action != "skip":
+                    action, reason = "skip", "not selected"
+                if action != "skip":
+                    self.will_run.setdefault(source, set()).add(name)
+                planned.append((name, source, action, reason))
+        return planned
+
+    def report(self, planned):
+        print(f"{'stage':<32} {'source':<16} {'action':<6} {'requests':>10}  reason")
+        totals = {"run": 0, "wait": 0}
+        for name, source, action, reason in planned:
+            requests = self.estimate_requests(name, source) if action != "skip" else None
+            if requests is not None:
+                totals[action] += requests
+            print(f"{name:<32} {source or '*':<16} {action:<6} {requests if requests is not None else '':>10}  {reason}")
+        counts = {action: sum(a == action for _, _, a, _ in planned) for action in ("run", "wait")}
+        print(f"{counts['run']} of {len(planned)} stages to run, {totals['run']:,} requests to send"
+              + (f"; {counts['wait']} stages ({totals['wait']:,} requests) wait for external stages" if counts["wait"] else ""))
+
+    def run(self, dry_run=False, only=None, sources=None):
+        planned = self.plan(only, sources)
+        self.report(planned)
+        # a dry run writes nothing, not even the fingerprints it computed
+        if dry_run:
+            return planned
+        self.fingerprints.save()
+
+        with open(self.segments_path + ".tmp", "w") as f:
+            json.dump(self.segments, f, indent=2)
+        os.replace(self.segments_path + ".tmp", self.segments_path)
+        for partition in {source for _, source, action, _ in planned if action == "run" and source is not None}:
+            self.write_segment(partition)
+
+        for name, source, action, reason in planned:
+            # external outputs are recorded against the inputs present when they were first seen
+            if self.stages[name]["kind"] == "external" and reason == "external, present" and self.read_state(name, source) is None:
+                os.makedirs(self.stage_dir(name, source), exist_ok=True)
+                self.write_state(name, source, {"key": self.key(name, source), "status": "done", "outputs": {}})
+
+        for name, source, action, reason in planned:
+            if action != "run":
+                continue
+            stage = self.stages[name]
+            if stage["kind"] == "batch" and stage["batch"] not in self.servers:
+                print(f"stopping before {name}: no server '{stage['batch']}' configured")
+                break
+            self.run_instance(name, source)
+        return planned
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["run"])
+    parser.add_argument("-c", "--config", default=os.path.join(ROOT, "pipeline.yaml"))
+    parser.add_argument("--dry-run", action="store_true", help="show what would run and how many requests it would send")
+    parser.add_argument("--only", nargs="*", default=None, help="stages to run")
+    parser.add_argument("--source", nargs="*", default=None, help="source datasets to run")
+    args = parser.parse_args()
+
+    Pipeline(args.config).run(dry_run=args.dry_run, only=args.only, sources=args.source)
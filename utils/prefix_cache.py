@@ -0,0 +1,54 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# simulation of the automatic prefix cache of vllm (--enable-prefix-caching): prompts are cut into full
+# blocks of block_size tokens, a block is keyed by a hash of its tokens chained with the key of the
+# block before it, so a block is only reused when the whole prompt up to its end is the same.
+# Blocks are evicted least recently used beyond `capacity` blocks (None: unbounded).
+
+class PrefixCache:
+    def __init__(self, block_size=16, capacity=None):
+        self.block_size = block_size
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.hits = 0
+
+    def block_keys(self, tokens):
+        keys, key = [], b""
+        for start in range(0, len(tokens) - len(tokens) % self.block_size, self.block_size):
+            block = "\x00".join(map(str, tokens[start:start + self.block_size])).encode("utf-8")
+            key = hashlib.blake2b(key + block, digest_size=16).digest()
+            keys.append(key)
+        return keys
+
+    def lookup(self, tokens):
+        # -> prompt tokens served from the cache; the prompt's blocks are cached afterwards
+        keys = self.block_keys(tokens)
+        with self.lock:
+            cached = 0
+            for key in keys:
+                if key not in self.blocks:
+                    break
+                cached += 1
+            # the last prompt token is always computed, to get the logits of the first output token
+            cached = min(cached, (len(tokens) - 1) // self.block_size) if tokens else 0
+            for key in keys:
+                self.blocks[key] = True
+                self.blocks.move_to_end(key)
+            if self.capacity is not None:
+                while len(self.blocks) > self.capacity:
+                    self.blocks.popitem(last=False)
+            self.queries += len(tokens)
+            self.hits += cached * self.block_size
+        return cached * self.block_size
+
+    def reset(self):
+        with self.lock:
+            self.blocks.clear()
+
+    def hit_rate(self):
+        return self.hits / self.queries if self.queries else 0.0
@@ -0,0 +1,155 @@
+import json
+import os
+import re
+import sys
+from json.decoder import scanstring
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import loads, orjson
+
+
+# projection pushdown for batch output lines: pulls single fields out of the raw line instead of
+# building the whole envelope (ids, request ids, logprobs, ...) as nested dicts, and returns plain
+# tuples so callers keep no per-record dicts around. The line is scanned
+# left to right with str.find for the keys, each search starting where the previous value ended, so
+# the long content strings are only walked by the C scanstring of the json module that decodes them.
+# Inside JSON strings every quote is escaped, so a key preceded by an unescaped quote is structural.
+# A line whose layout differs from what the fast path expects is parsed in full instead, so the
+# result is always the same as reading the parsed record.
+
+FIELDS = ("custom_id", "status_code", "content", "contents", "finish_reason", "finish_reasons", "usage")
+
+_CUSTOM_ID_BYTES = re.compile(rb'(?<!\\)"custom_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_INT = re.compile(r"\d+")
+
+_decoder = json.JSONDecoder()
+
+
+def line_custom_id(line):
+    # custom_id of a raw (bytes) line; the envelope comes first, so this is found without parsing
+    match = _CUSTOM_ID_BYTES.search(line)
+    if match is not None and b"\\" not in match.group(1):
+        return match.group(1).decode("utf-8")
+    return loads(line)["custom_id"]
+
+
+_KEYS = {key: re.compile('"' + key + r'"\s*:\s*') for key in ("custom_id", "status_code", "message", "index", "content", "finish_reason", "usage")}
+
+
+def _key(text, key, start=0, end=None):
+    # -> (position of `"key"`, position of its value), (-1, -1) when absent from text[start:end]
+    pattern = _KEYS[key]
+    end = len(text) if end is None else end
+    match = pattern.search(text, start, end)
+    while match is not None and text[match.start() - 1] == "\\":
+        match = pattern.search(text, match.start() + 1, end)
+    if match is None:
+        return -1, -1
+    return match.start(), match.end()
+
+
+def _string(text, pos):
+    # -> (value, end) of a JSON string or null at pos, None for anything else
+    if text.startswith('"', pos):
+        return scanstring(text, pos + 1)
+    if text.startswith("null", pos):
+        return None, pos + 4
+    return None
+
+
+def _fast(text):
+    # -> (custom_id, contents, finish_reasons, usage, status_code), None when the line needs a full parse
+    _, pos = _key(text, "custom_id")
+    value = _string(text, pos) if pos != -1 else None
+    if value is None or value[0] is None:
+        return None
+    custom_id, pos = value
+    first, _ = _key(text, "message", pos)
+    if first == -1:
+        return None
+    _, status_pos = _key(text, "status_code", pos, first)
+    status = _INT.match(text, status_pos) if status_pos != -1 else None
+    contents, finish_reasons = [], []
+    while True:
+        message, value_pos = _key(text, "message", pos)
+        if message == -1:
+            break
+        if not text.startswith("{", value_pos):
+            return None
+        # choices must come in index order
+        _, index_pos = _key(text, "index", pos, message)
+        index = _INT.match(text, index_pos) if index_pos != -1 else None
+        if index is not None and int(index.group()) != len(contents):
+            return None
+        _, content_pos = _key(text, "content", value_pos)
+        content = _string(text, content_pos) if content_pos != -1 else None
+        if content is None:
+            return None
+        finish, finish_pos = _key(text, "finish_reason", content[1])
+        finish_reason = _string(text, finish_pos) if finish_pos != -1 else None
+        # a choice without finish_reason would pair its content with the next choice's
+        if finish_reason is None or text.find('"message"', content[1], finish) != -1:
+            return None
+        contents.append(content[0])
+        finish_reasons.append(finish_reason[0])
+        pos = finish_reason[1]
+    usage = None
+    _, usage_pos = _key(text, "usage", pos)
+    if usage_pos == -1:
+        _, usage_pos = _key(text, "usage", 0, first)
+    if usage_pos != -1:
+        usage, _ = _decoder.raw_decode(text, usage_pos)
+    return custom_id, contents, finish_reasons, usage, int(status.group()) if status else None
+
+
+def _full(line):
+    record = loads(line)
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    try:
+        choices = sorted(body["choices"], key=lambda choice: choice.get("index", 0))
+        contents = [choice["message"]["content"] for choice in choices]
+        finish_reasons = [choice.get("finish_reason") for choice in choices]
+    except (KeyError, TypeError):
+        contents, finish_reasons = [], []
+    return record["custom_id"], contents, finish_reasons, body.get("usage"), response.get("status_code")
+
+
+def project(line, fields):
+    # raw output line (bytes or str) -> tuple of the requested FIELDS
+    line = line.encode("utf-8") if isinstance(line, str) else line
+    # without logprobs a line is mostly the content strings, which orjson decodes faster than the
+    # scan can walk the envelope in Python; per-token logprobs (score-only judge outputs) are the
+    # bulk of a line that has them, and the scan skips them
+    if orjson is not None and b'"top_logprobs"' not in line:
+        projected = _full(line)
+    else:
+        projected = _fast(line.decode("utf-8")) or _full(line)
+    custom_id, contents, finish_reasons, usage, status = projected
+    values = []
+    for field in fields:
+        if field == "custom_id":
+            values.append(custom_id)
+        elif field == "status_code":
+            values.append(status)
+        elif field == "content":
+            values.append(contents[0] if contents else None)
+        elif field == "contents":
+            values.append(contents)
+        elif field == "finish_reason":
+            values.append(finish_reasons[0] if finish_reasons else None)
+        elif field == "finish_reasons":
+            values.append(finish_reasons)
+        elif field == "usage":
+            values.append(usage)
+        else:
+            raise ValueError(f"unknown field {field}, expected one of {FIELDS}")
+    return tuple(values)
+
+
+def iter_projected(path, fields=("custom_id", "content")):
+    # -> one tuple of `fields` per output line of a (plain) batch output file
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield project(line, fields)
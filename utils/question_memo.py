@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import re
+import sys
+from collections import Counter, defaultdict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.json_extract import parse_tool
+from utils.jsonl_io import iter_jsonl
+from utils.stream_join import CustomIdReader, get_content
+
+
+# evaluator questions of constraints that do not depend on the query ("Use bullet points", "Answer in
+# English", "within 100 words"): generate_eval_ques looks every constraint up here before building its
+# request and answers memo hits itself. Constraints are normalized (case, punctuation, number words)
+# and their numbers become slots, so "within 100 words" and "Within 200 words." share the entry
+# "within <num> words" with the question template "Is the response within {0} words?". A constraint
+# without an exact entry matches the most similar key (Jaccard similarity of character trigrams) with
+# the same number of slots when the similarity reaches `threshold`.
+# Entries are learned from finished generate_eval_ques batches: a normalized constraint becomes an entry
+# once it was asked for at least `min_count` different queries and `agreement` of its questions have
+# the same template; constraints whose questions name query-specific things never agree and stay out.
+# The memo is a JSON file {key: {"template", "count"}} that can be reviewed and edited by hand.
+#
+# python utils/question_memo.py learn --requests generate_questions_prompts.jsonl --results output.jsonl --memo question_memo.json
+# python utils/question_memo.py show --memo question_memo.json
+
+_NUMBER_WORDS = {word: str(i) for i, word in enumerate(
+    "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen "
+    "seventeen eighteen nineteen twenty".split())}
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+# a few constraints common enough to be useful before anything was learned
+SEED = {
+    "use bullet points": "Does the response use bullet points?",
+    "use bulletpoint in your answer": "Does the response use bullet points?",
+    "answer in english": "Is the response written in English?",
+    "in english": "Is the response written in English?",
+    "in json format": "Is the response in JSON format?",
+    "within <num> words": "Is the response within {0} words?",
+    "in <num> words or less": "Is the response {0} words or less?",
+    "answer with exactly <num> sentences": "Does the response contain exactly {0} sentences?",
+    "in <num> paragraphs": "Does the response consist of {0} paragraphs?",
+}
+
+
+def normalize(constraint):
+    # -> (key, numbers in order)
+    text = constraint.lower()
+    text = re.sub(r"\b(" + "|".join(_NUMBER_WORDS) + r")\b", lambda m: _NUMBER_WORDS[m.group(1)], text)
+    numbers = _NUMBER.findall(text)
+    text = _NUMBER.sub("<num>", text)
+    text = re.sub(r"[^\w<> ]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip(), numbers
+
+
+def template(question, numbers):
+    # question -> template with the constraint's numbers as slots, None when it has other numbers
+    # (those come from the query, not from the constraint)
+    text = question.replace("{", "{{").replace("}", "}}")
+    slots = {number: i for i, number in reversed(list(enumerate(numbers)))}
+    query_specific = []
+
+    def slot(match):
+        if match.group() not in slots:
+            query_specific.append(match.group())
+            return match.group()
+        return "{" + str(slots[match.group()]) + "}"
+
+    # number words of the question count too ("exactly three sentences" -> "exactly {0} sentences")
+    text = re.sub(r"\b(" + "|".join(_NUMBER_WORDS) + r")\b", lambda m: _NUMBER_WORDS[m.group(1)], text, flags=re.I)
+    text = _NUMBER.sub(slot, text)
+    return None if query_specific else text
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class QuestionMemo:
+    def __init__(self, path="./question_memo.json", threshold=0.85, seed=True):
+        self.path = path
+        self.threshold = threshold
+        self.entries = {key: {"template": value, "count": 0} for key, value in SEED.items()} if seed else {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries.update(json.load(f))
+        self._index()
+        # per constraint category: [lookups, exact hits, near hits]
+        self.stats = defaultdict(lambda: [0, 0, 0])
+
+    def _index(self):
+        self.grams = {key: trigrams(key) for key in self.entries}
+        self.by_gram = defaultdict(set)
+        for key, grams in self.grams.items():
+            for gram in grams:
+                self.by_gram[gram].add(key)
+
+    def match(self, key):
+        # -> (memo key, exact) or (None, False)
+        if key in self.entries:
+            return key, True
+        grams = trigrams(key)
+        candidates = Counter(other for gram in grams for other in self.by_gram.get(gram, ()))
+        best, best_score = None, 0.0
+        for other, shared in candidates.items():
+            if other.count("<num>") != key.count("<num>"):
+                continue
+            score = shared / (len(grams) + len(self.grams[other]) - shared)
+            if score > best_score:
+                best, best_score = other, score
+        return (best, False) if best_score >= self.threshold else (None, False)
+
+    def lookup(self, constraint, category="all"):
+        # -> question for the constraint, None when it has to go to the model
+        key, numbers = normalize(constraint)
+        stats = self.stats[category]
+        stats[0] += 1
+        entry, exact = self.match(key)
+        if entry is None:
+            return None
+        try:
+            question = self.entries[entry]["template"].format(*numbers)
+        except (IndexError, KeyError, ValueError):
+            return None
+        stats[1 if exact else 2] += 1
+        return question
+
+    def learn(self, request_path, output_path, min_count=3, agreement=0.6):
+        # generate_eval_ques request file + its batch outputs -> new entries; -> number of entries added
+        questions = defaultdict(Counter)
+        queries = defaultdict(set)
+        with CustomIdReader(output_path) as reader:
+            for request in iter_jsonl(request_path):
+                prompt = request["body"]["messages"][-1]["content"]
+                # the examples of the prompt have Constraint: lines too, the record's comes last
+                constraints = re.findall(r"^Constraint: (.*)$", prompt, re.M)
+                record = reader.take(request["custom_id"])
+                tool = parse_tool(get_content(record)) if record is not None else None
+                if not constraints or not isinstance(tool, dict) or not isinstance(tool.get("question"), str):
+                    continue
+                key, numbers = normalize(constraints[-1])
+                question = template(tool["question"], numbers) if tool["question"] else ""
+                questions[key][question] += 1
+                queries[key].add(request["custom_id"].rsplit("-", 1)[0])
+        added = 0
+        for key, counter in questions.items():
+            # learned entries are kept, seeds give way to what the model asked
+            if len(queries[key]) < min_count or self.entries.get(key, {}).get("count"):
+                continue
+            question, count = counter.most_common(1)[0]
+            # an empty question means "not a constraint" and is not worth memoizing either
+            if question and count / sum(counter.values()) >= agreement:
+                self.entries[key] = {"template": question, "count": sum(counter.values())}
+                added += 1
+        self._index()
+        return added
+
+    def save(self):
+        learned = {key: entry for key, entry in self.entries.items() if key not in SEED or entry["template"] != SEED[key]}
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(learned, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    def report(self, stage="generate_eval_ques"):
+        total = [sum(s[i] for s in self.stats.values()) for i in range(3)]
+        for category, (lookups, exact, near) in sorted(self.stats.items()) + [("all", total)]:
+            if lookups:
+                print(f"[memo] {stage} {category}: {exact + near}/{lookups} ({(exact + near) / lookups:.1%}) "
+                      f"answered from the memo, {exact} exact, {near} near")
+        self.stats.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["learn", "show"])
+    parser.add_argument("--memo", default="./question_memo.json")
+    parser.add_argument("--requests", help="generate_eval_ques request file")
+    parser.add_argument("--results", help="its batch outputs")
+    parser.add_argument("--min-count", default=3, type=int, help="queries a constraint must appear for")
+    parser.add_argument("--agreement", default=0.6, type=float, help="share of its questions that must have the same template")
+    args = parser.parse_args()
+
+    memo = QuestionMemo(args.memo)
+    if args.command == "learn":
+        added = memo.learn(args.requests, args.results, args.min_count, args.agreement)
+        memo.save()
+        print(f"{added} entries learned, {len(memo.entries)} in {args.memo}")
+    else:
+        for key, entry in sorted(memo.entries.items(), key=lambda item: -item[1]["count"]):
+            print(f"{entry['count']:>8} {key!r}: {entry['template']!r}")
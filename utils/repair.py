@@ -0,0 +1,162 @@
+import argparse
+import copy
+import json
+import os
+import re
+import sys
+from collections import Counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.json_extract import extract_json, parse_tool
+from utils.jsonl_io import JsonlWriter, iter_jsonl
+from utils.manifest import record_rewrite
+from utils.schemas import CONSTRAINT_SCHEMA, QUESTION_SCHEMA, matches
+from utils.stream_join import CustomIdReader
+
+
+# repair queue for batch stages: find the requests whose output failed, write a follow-up batch with
+# only those (same custom_id, optionally other temperature / max_tokens) and splice the repaired
+# results back into the original output file, so downstream joins see one complete file
+
+# stage -> (parser of the output text, schema when the request does not carry one)
+STAGES = {
+    "extract_constraint": (extract_json, CONSTRAINT_SCHEMA),
+    "generate_eval_ques": (parse_tool, QUESTION_SCHEMA),
+    "judge": (parse_tool, None),
+    "resample": (None, None),
+}
+
+_SCORE_LABEL = re.compile(r"^(.*Question \d+): YES or NO$", re.MULTILINE)
+
+
+def request_schema(body):
+    # the schema a guided request was decoded against (see utils.schemas.guided_json)
+    if "guided_json" in body:
+        return body["guided_json"]
+    try:
+        return body["response_format"]["json_schema"]["schema"]
+    except (KeyError, TypeError):
+        return None
+
+
+def score_lines_ok(content, body):
+    # score-only judge: every "<label>: YES or NO" line asked for is answered
+    labels = _SCORE_LABEL.findall(body["messages"][-1]["content"])
+    answered = re.findall(r"^\W*(.*?Question\W*\d+)\W*(?:YES|NO)\b", content, re.MULTILINE | re.IGNORECASE)
+    return len(labels) > 0 and set(label.lower() for label in labels) <= set(label.lower() for label in answered)
+
+
+def scores_ok(value):
+    # judge output decoded without a schema: every question scored YES or NO, per response for
+    # multi-response prompts
+    if not isinstance(value, dict):
+        return False
+    if value and all(key.startswith("Response") for key in value):
+        return all(scores_ok(verdict) for verdict in value.values())
+    scores = [verdict.get("score") if isinstance(verdict, dict) else None for key, verdict in value.items() if "Question" in key]
+    return len(scores) > 0 and all(isinstance(score, str) and score.strip().upper() in ("YES", "NO") for score in scores)
+
+
+def failure_reason(record, body, stage):
+    # None for a usable output, otherwise why it failed:
+    # missing, http_error, truncated (finish_reason length), invalid_json, schema_mismatch
+    if record is None:
+        return "missing"
+    if record.get("error") is not None or record.get("response") is None or record["response"].get("status_code", 200) != 200:
+        return "http_error"
+    try:
+        choice = record["response"]["body"]["choices"][0]
+        content = choice["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return "http_error"
+    if choice.get("finish_reason") == "length":
+        return "truncated"
+    parse, schema = STAGES[stage]
+    if body.get("logprobs"):
+        return None if score_lines_ok(content, body) else "invalid_json"
+    if parse is None:
+        return None
+    try:
+        value = parse(content)
+    except Exception:
+        value = None
+    if value is None:
+        return "invalid_json"
+    schema = request_schema(body) or schema
+    if schema is not None and not matches(value, schema):
+        return "schema_mismatch"
+    if stage == "judge" and schema is None and not scores_ok(value):
+        return "schema_mismatch"
+    return None
+
+
+def collect_failures(request_path, output_path, repair_path, stage, temperature=None, max_tokens_scale=2.0):
+    # writes the failed requests of one batch to repair_path; truncated requests get max_tokens scaled,
+    # the others the given temperature (a deterministic request repeated at temperature 0 fails the same way)
+    reasons = Counter()
+    total = 0
+    with CustomIdReader(output_path) as outputs, JsonlWriter(repair_path, "w") as f:
+        for request in iter_jsonl(request_path):
+            total += 1
+            reason = failure_reason(outputs.take(request["custom_id"]), request["body"], stage)
+            if reason is None:
+                continue
+            reasons[reason] += 1
+            request = copy.deepcopy(request)
+            if reason == "truncated" and "max_tokens" in request["body"]:
+                request["body"]["max_tokens"] = int(request["body"]["max_tokens"] * max_tokens_scale)
+            elif reason in ("invalid_json", "schema_mismatch") and temperature is not None:
+                request["body"]["temperature"] = temperature
+            f.write(request)
+    failed = sum(reasons.values())
+    print(f"[repair] {stage}: {failed}/{total} requests failed ({failed / max(total, 1):.1%})"
+          + "".join(f", {reason} {count}" for reason, count in reasons.most_common()))
+    return reasons
+
+
+def merge_repairs(output_path, repair_path, repair_output_path, stage):
+    # replaces failed records of output_path in place by repaired ones that succeeded; requests that
+    # never had an output are appended
+    bodies = {request["custom_id"]: request["body"] for request in iter_jsonl(repair_path)}
+    repaired, still = {}, {}
+    for record in iter_jsonl(repair_output_path):
+        custom_id = record["custom_id"]
+        if custom_id not in bodies:
+            continue
+        reason = failure_reason(record, bodies[custom_id], stage)
+        if reason is None:
+            repaired[custom_id] = record
+            still.pop(custom_id, None)
+        elif custom_id not in repaired:
+            still[custom_id] = reason
+    reasons = Counter(still.values())
+    reasons["missing"] += len(bodies) - len(repaired) - len(still)
+    print(f"[repair] {stage}: {len(repaired)}/{len(bodies)} repaired"
+          + ("; still failing: " + ", ".join(f"{reason} {count}" for reason, count in reasons.most_common() if count) if len(repaired) < len(bodies) else ""))
+    with JsonlWriter(output_path, "w") as f:
+        for record in iter_jsonl(output_path):
+            f.write(repaired.pop(record["custom_id"], record))
+        for record in repaired.values():
+            f.write(record)
+    record_rewrite(output_path)
+
+
+if __name__ == "__main__":
+    # python utils/repair.py collect --stage judge -r requests.jsonl -o output.jsonl -p repair.jsonl --temperature 0.3
+    # (run repair.jsonl as a batch into repair_output.jsonl)
+    # python utils/repair.py merge --stage judge -o output.jsonl -p repair.jsonl --repair-output repair_output.jsonl
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["collect", "merge"])
+    parser.add_argument("--stage", required=True, choices=list(STAGES))
+    parser.add_argument("-r", "--requests", help="request file of the batch")
+    parser.add_argument("-o", "--output", required=True, help="output file of the batch")
+    parser.add_argument("-p", "--repair", required=True, help="follow-up request file")
+    parser.add_argument("--repair-output", help="output file of the follow-up batch")
+    parser.add_argument("--temperature", default=None, type=float, help="temperature for invalid_json / schema_mismatch retries")
+    parser.add_argument("--max-tokens-scale", default=2.0, type=float, help="max_tokens multiplier for truncated outputs")
+    args = parser.parse_args()
+
+    if args.command == "collect":
+        collect_failures(args.requests, args.output, args.repair, args.stage, temperature=args.temperature, max_tokens_scale=args.max_tokens_scale)
+    else:
+        merge_repairs(args.output, args.repair, args.repair_output, args.stage)
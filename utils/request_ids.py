@@ -0,0 +1,14 @@
+import hashlib
+import json
+
+
+def record_key(record, fields=("query", "history", "eval question")):
+    # short content hash of the fields that determine a record's requests
+    content = json.dumps([record.get(field) for field in fields], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+def make_custom_id(record, *parts, fields=("query", "history", "eval question")):
+    # request-{hash}[-{part}...]: stable under filtering, reordering and re-sharding of the input,
+    # so results can be joined in any order and reused after the input list changes
+    return "-".join(["request", record_key(record, fields)] + [str(part) for part in parts])
@@ -0,0 +1,85 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import JsonlWriter, RotatingJsonlWriter, open_text
+
+
+# request files are written line by line as the requests are built. In compact form, every message
+# of at least `min_chars` characters (system prompts, multi-turn history, the prompt repeated for each
+# of the k samples) is written once as {"shared_message": ref, "message": {...}} and requests carry
+# the ref string in place of the message dict. expand_requests() rebuilds the plain batch file at
+# upload time; compact files are only for storage and transfer, every reader expects the plain format.
+
+
+def message_ref(message):
+    return hashlib.sha1(json.dumps(message, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:20]
+
+
+class RequestWriter:
+    def __init__(self, fout, compact=False, min_chars=64):
+        self.fout = fout
+        self.compact = compact
+        self.min_chars = min_chars
+        self.defined = set()
+        self.requests = 0
+        self.shared = 0
+
+    def _line(self, value):
+        self.fout.write(json.dumps(value, ensure_ascii=False) + "\n")
+
+    def write(self, request):
+        self.requests += 1
+        if not self.compact:
+            self._line(request)
+            return
+        messages = []
+        for message in request["body"]["messages"]:
+            if len(message.get("content") or "") < self.min_chars:
+                messages.append(message)
+                continue
+            ref = message_ref(message)
+            if ref not in self.defined:
+                # after a resume the definitions before the checkpoint are not known here and get repeated
+                self.defined.add(ref)
+                self._line({"shared_message": ref, "message": message})
+            else:
+                self.shared += 1
+            messages.append(ref)
+        self._line({**request, "body": {**request["body"], "messages": messages}})
+
+
+def expand_requests(compact_path, save_path, split=False, max_requests=None, max_bytes=None):
+    # compact (optionally .zst) request file -> plain batch request file; split=True writes
+    # save_path.part-NNNNN files within the batch limits instead (utils.jsonl_io.RotatingJsonlWriter)
+    shared = {}
+    written = 0
+    writer = RotatingJsonlWriter(save_path, max_requests, max_bytes) if split else JsonlWriter(save_path, "w")
+    with open_text(compact_path, "r") as fin, writer as fout:
+        for line in fin:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "shared_message" in record:
+                shared[record["shared_message"]] = record["message"]
+                continue
+            messages = [shared[m] if isinstance(m, str) else m for m in record["body"]["messages"]]
+            fout.write({**record, "body": {**record["body"], "messages": messages}})
+            written += 1
+    print(f"expanded {written} requests ({len(shared)} shared messages) into {', '.join(fout.paths) if split else save_path}")
+    return written
+
+
+if __name__ == "__main__":
+    # python utils/request_writer.py -i Sharegpt_turn1_augmented_query_sft_1_query_1.jsonl.zst -o Sharegpt_turn1_augmented_query_sft_1_query_1.jsonl
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True, help="compact request file")
+    parser.add_argument("-o", "--output", required=True, help="plain batch request file")
+    parser.add_argument("--split", action="store_true", help="write part files within the batch request-count / size limits")
+    args = parser.parse_args()
+
+    expand_requests(args.input, args.output, split=args.split)
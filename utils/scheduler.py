@@ -0,0 +1,311 @@
+import argparse
+import fcntl
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.manifest import checkpoint_hooks
+
+
+# work-stealing shard scheduler over a shared directory: the input is cut into small chunks, any number
+# of workers lease the next free chunk, keep the lease alive with a heartbeat and mark it done; leases
+# whose heartbeat stopped (dead or hung worker) are taken over. Only plain files and flock, no external service.
+# The heartbeat only renews a lease while the stage makes progress (progress() per record, every checkpoint),
+# and a worker that lost its lease stops at its next record or checkpoint instead of writing on.
+#
+# <work_dir>/plan.json            chunk boundaries (record range + byte offset into the input)
+# <work_dir>/leases/<id>.lease    current owner, mtime = last heartbeat
+# <work_dir>/done/<id>.done       finished chunk, owner and record count
+
+Chunk = namedtuple("Chunk", ["id", "start", "end", "offset"])
+
+
+class LeaseLost(Exception):
+    pass
+
+
+# chunk id -> progress of the chunk this process is working on (see ShardScheduler.heartbeat)
+_active = {}
+
+
+def progress(index):
+    # called by stages for every record of a chunk they get through: keeps the heartbeat renewing the
+    # lease, and raises LeaseLost once the lease went to another worker; a no-op outside the scheduler
+    state = _active.get(index.id) if isinstance(index, Chunk) else None
+    if state is None:
+        return
+    if state["lost"]:
+        raise LeaseLost(f"chunk {index.id} was taken over by another worker")
+    state["count"] += 1
+
+
+def default_worker():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def plan_chunks(data_path, chunk_size):
+    # one pass over the input for the byte offset of every chunk_size-th record (blank lines are skipped
+    # like iter_jsonl does), so a worker seeks to its chunk instead of re-reading everything before it
+    offsets = []
+    count = 0
+    pos = 0
+    with open(data_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                if count % chunk_size == 0:
+                    offsets.append(pos)
+                count += 1
+            pos += len(line)
+    return [Chunk(i, i * chunk_size, min((i + 1) * chunk_size, count), offset) for i, offset in enumerate(offsets)]
+
+
+class ShardScheduler:
+    """Leases chunks of `data_path` to the workers sharing `work_dir`.
+
+    The first worker writes the plan, the others load it (a plan for another
+    input, chunk size or input size is refused). A lease expires
+    `lease_seconds` after its last heartbeat; heartbeats are sent every
+    lease_seconds / 3 while the chunk makes progress, so only a dead or hung
+    worker loses its chunk. Expiry is
+    judged by file mtimes of the shared filesystem, not by the local clock,
+    so clock skew between nodes does not matter.
+    """
+
+    def __init__(self, work_dir, data_path, chunk_size=1000, lease_seconds=600, worker=None, poll_seconds=30):
+        self.work_dir = work_dir
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.worker = worker or default_worker()
+        self.lease_dir = os.path.join(work_dir, "leases")
+        self.done_dir = os.path.join(work_dir, "done")
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        plan_path = os.path.join(work_dir, "plan.json")
+        with self._lock():
+            if os.path.exists(plan_path):
+                with open(plan_path, "r") as f:
+                    plan = json.load(f)
+                if plan["data_path"] != os.path.abspath(data_path) or plan["chunk_size"] != chunk_size:
+                    raise RuntimeError(f"{plan_path} was planned for {plan['data_path']} with chunk_size {plan['chunk_size']}; "
+                                       f"use another work_dir or remove it")
+                if plan["size"] != os.path.getsize(data_path):
+                    raise RuntimeError(f"{data_path} is {os.path.getsize(data_path)} bytes, {plan_path} was planned for {plan['size']}; "
+                                       f"the chunk offsets no longer match, use another work_dir or remove it")
+            else:
+                chunks = plan_chunks(data_path, chunk_size)
+                plan = {"data_path": os.path.abspath(data_path), "chunk_size": chunk_size, "size": os.path.getsize(data_path),
+                        "chunks": [list(chunk) for chunk in chunks]}
+                write_json(plan_path, plan)
+        self.chunks = [Chunk(*chunk) for chunk in plan["chunks"]]
+
+    @contextmanager
+    def _lock(self):
+        # every lease / done transition happens under one exclusive flock on the shared directory
+        with open(os.path.join(self.work_dir, "lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _now(self):
+        # "now" in the shared filesystem's clock, the one lease mtimes are written with
+        path = os.path.join(self.work_dir, f"clock.{self.worker}")
+        with open(path, "a"):
+            os.utime(path)
+        return os.stat(path).st_mtime
+
+    def _lease_path(self, chunk):
+        return os.path.join(self.lease_dir, f"{chunk.id:05d}.lease")
+
+    def _done_path(self, chunk):
+        return os.path.join(self.done_dir, f"{chunk.id:05d}.done")
+
+    def _owner(self, chunk):
+        try:
+            with open(self._lease_path(chunk), "r") as f:
+                return json.load(f)["worker"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _expired(self, chunk, now):
+        try:
+            return os.stat(self._lease_path(chunk)).st_mtime + self.lease_seconds < now
+        except FileNotFoundError:
+            return True
+
+    def acquire(self):
+        # the first chunk that is neither done nor leased by a live worker, None if there is none right now
+        with self._lock():
+            now = self._now()
+            for chunk in self.chunks:
+                if os.path.exists(self._done_path(chunk)):
+                    continue
+                lease_path = self._lease_path(chunk)
+                if os.path.exists(lease_path):
+                    if not self._expired(chunk, now):
+                        continue
+                    print(f"[scheduler] {self.worker} reclaims chunk {chunk.id} from {self._owner(chunk)}")
+                write_json(lease_path, {"worker": self.worker, "acquired": now})
+                return chunk
+        return None
+
+    def renew(self, chunk):
+        # heartbeat; False when the lease was lost (expired and taken over by another worker)
+        with self._lock():
+            if self._owner(chunk) != self.worker:
+                return False
+            os.utime(self._lease_path(chunk))
+            return True
+
+    def complete(self, chunk):
+        # False when the lease was lost: the new owner finishes the chunk and marks it done
+        with self._lock():
+            if self._owner(chunk) != self.worker:
+                print(f"[scheduler] {self.worker} finished chunk {chunk.id} after losing its lease, leaving it to its new owner")
+                return False
+            write_json(self._done_path(chunk), {"worker": self.worker, "records": chunk.end - chunk.start, "finished": self._now()})
+            if os.path.exists(self._lease_path(chunk)):
+                os.remove(self._lease_path(chunk))
+            return True
+
+    def release(self, chunk):
+        # give a chunk back right away (the worker failed on it) instead of waiting for the lease to expire
+        with self._lock():
+            if self._owner(chunk) == self.worker:
+                os.remove(self._lease_path(chunk))
+
+    @contextmanager
+    def heartbeat(self, chunk):
+        # renews the lease while progress() or checkpoints of the chunk's stages move on; a stage that
+        # checkpoints after losing the lease gets LeaseLost before its manifest is written
+        state = _active[chunk.id] = {"count": 0, "lost": False}
+        stop = threading.Event()
+
+        def lose():
+            state["lost"] = True
+            print(f"[scheduler] {self.worker} lost the lease of chunk {chunk.id}")
+
+        def beat():
+            seen = 0
+            while not stop.wait(self.lease_seconds / 3):
+                if state["count"] == seen:
+                    # no progress since the last beat: the lease is left to expire unless the stage moves on
+                    if self._owner(chunk) != self.worker:
+                        return lose()
+                    continue
+                seen = state["count"]
+                if not self.renew(chunk):
+                    return lose()
+
+        def check(manifest):
+            if state["lost"] or not self.renew(chunk):
+                state["lost"] = True
+                raise LeaseLost(f"chunk {chunk.id} was taken over by another worker")
+            state["count"] += 1
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        checkpoint_hooks.append(check)
+        try:
+            yield
+        finally:
+            checkpoint_hooks.remove(check)
+            stop.set()
+            thread.join()
+            del _active[chunk.id]
+
+    def status(self):
+        now = self._now()
+        done, leased, expired = [], [], []
+        for chunk in self.chunks:
+            if os.path.exists(self._done_path(chunk)):
+                done.append(chunk)
+            elif os.path.exists(self._lease_path(chunk)):
+                (expired if self._expired(chunk, now) else leased).append(chunk)
+        finished = []
+        for chunk in done:
+            try:
+                with open(self._done_path(chunk), "r") as f:
+                    finished.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return {
+            "chunks": len(self.chunks),
+            "done": len(done),
+            "leased": len(leased),
+            "expired": len(expired),
+            "pending": len(self.chunks) - len(done) - len(leased) - len(expired),
+            "records": self.chunks[-1].end if self.chunks else 0,
+            "records_done": sum(chunk.end - chunk.start for chunk in done),
+            "workers": Counter(self._owner(chunk) for chunk in leased),
+            "finished": sorted(info["finished"] for info in finished),
+            "now": now,
+        }
+
+    def report(self):
+        s = self.status()
+        line = (f"[scheduler] {s['done']}/{s['chunks']} chunks done ({s['records_done']}/{s['records']} records), "
+                f"{s['leased']} leased by {len(s['workers'])} workers, {s['expired']} expired, {s['pending']} pending")
+        # throughput over the finished chunks, from the first completion until now
+        if len(s["finished"]) > 1 and s["now"] > s["finished"][0]:
+            rate = (len(s["finished"]) - 1) / (s["now"] - s["finished"][0])
+            remaining = s["chunks"] - s["done"]
+            line += f", {rate * 3600:.1f} chunks/h, eta {remaining / rate / 60:.0f} min"
+        print(line)
+        return s
+
+    def run(self, fn):
+        # lease chunks and call fn(chunk) until every chunk is done; while the remaining chunks are all
+        # leased by others, keep polling so the ones of dead workers are picked up once they expire
+        processed = 0
+        while True:
+            chunk = self.acquire()
+            if chunk is None:
+                s = self.status()
+                if s["done"] == s["chunks"]:
+                    break
+                time.sleep(self.poll_seconds)
+                continue
+            try:
+                with self.heartbeat(chunk):
+                    fn(chunk)
+            except LeaseLost as e:
+                print(f"[scheduler] {self.worker} stopped: {e}")
+                continue
+            except BaseException:
+                self.release(chunk)
+                raise
+            if self.complete(chunk):
+                processed += 1
+            self.report()
+        print(f"[scheduler] {self.worker} processed {processed} chunks, all done")
+        return processed
+
+
+def write_json(path, value):
+    # written to a temporary file and renamed, readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    # python utils/scheduler.py status -w ./schedule/resampling -i ./Sharegpt_turn1_augmented_query_sft_1.jsonl
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["status"])
+    parser.add_argument("-w", "--work-dir", required=True)
+    parser.add_argument("-i", "--input", required=True)
+    parser.add_argument("--chunk-size", default=1000, type=int)
+    args = parser.parse_args()
+
+    s = ShardScheduler(args.work_dir, args.input, chunk_size=args.chunk_size).report()
+    for worker, count in s["workers"].most_common():
+        print(f"  {worker}: {count} chunks leased")
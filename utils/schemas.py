@@ -0,0 +1,136 @@
+import re
+
+
+# JSON schemas of every structured stage output, attached to requests for guided decoding as vllm's
+# guided_json / guided_regex extra parameters (vllm serve and vllm run_batch read them as written);
+# the online clients translate them per server with for_backend (their `guided` option):
+# "vllm" sends them, "openai" sends response_format json_schema, "none" sends nothing and leaves it to the parsers
+GUIDED_BACKENDS = ("vllm", "openai", "none")
+
+CONSTRAINT_CATEGORIES = ["Content Constraints", "Numerical Constraints", "Stylistic Constraints", "Format Constraints", "Linguistic Constraints"]
+
+_CONSTRAINT_ITEM = {
+    "type": "object",
+    "properties": {
+        "constraint": {"type": "string"},
+        "simplified query": {"type": "string"},
+    },
+    "required": ["constraint", "simplified query"],
+}
+
+# extract_constraint: {"Complex": false} or the basic query plus a list per constraint category
+CONSTRAINT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Complex": {"type": "boolean"},
+        "Basic Query": {"type": "string"},
+        **{category: {"type": "array", "items": _CONSTRAINT_ITEM} for category in CONSTRAINT_CATEGORIES},
+    },
+    "required": ["Complex"],
+    "additionalProperties": False,
+}
+
+# generate_eval_ques: one evaluator question, "" when the constraint cannot be checked
+QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {"question": {"type": "string"}},
+    "required": ["question"],
+    "additionalProperties": False,
+}
+
+# UltraComposer (augment_query): the query with one more constraint and its evaluator questions
+AUGMENTED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "augmented query": {"type": "string"},
+        "question": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["augmented query", "question"],
+    "additionalProperties": False,
+}
+
+
+def verdict_schema(num_questions, num_responses=1, explanation=True):
+    # judge: {"Question q": {"explanation", "score"}}, nested under "Response r" for multi-response prompts
+    item = {"type": "object", "properties": {"score": {"type": "string", "enum": ["YES", "NO"]}}, "required": ["score"]}
+    if explanation:
+        item["properties"] = {"explanation": {"type": "string"}, **item["properties"]}
+        item["required"] = ["explanation", "score"]
+    keys = [f"Question {i}" for i in range(1, num_questions + 1)]
+    schema = {"type": "object", "properties": {key: item for key in keys}, "required": keys}
+    if num_responses == 1:
+        return schema
+    keys = [f"Response {r}" for r in range(1, num_responses + 1)]
+    return {"type": "object", "properties": {key: schema for key in keys}, "required": keys}
+
+
+def guided_json(schema):
+    # extra request body parameters constraining the output to `schema`
+    return {"guided_json": schema}
+
+
+def guided_lines(labels, choices=("YES", "NO")):
+    # "<label>: <choice>" per line, for the score-only judge; only vllm has regex-guided decoding
+    choice = "(" + "|".join(choices) + ")"
+    return {"guided_regex": "".join(re.escape(label) + ": " + choice + r"\n" for label in labels)}
+
+
+def for_backend(body, backend):
+    # request body as written by the stages -> the body to send to a `backend` server (one of GUIDED_BACKENDS)
+    if backend not in GUIDED_BACKENDS:
+        raise ValueError(f"unknown guided decoding backend {backend}, expected one of {GUIDED_BACKENDS}")
+    if backend == "vllm" or ("guided_json" not in body and "guided_regex" not in body):
+        return body
+    sent = {key: value for key, value in body.items() if key not in ("guided_json", "guided_regex")}
+    if backend == "openai" and "guided_json" in body:
+        sent["response_format"] = {"type": "json_schema", "json_schema": {"name": "output", "schema": body["guided_json"]}}
+    return sent
+
+
+_TYPES = {"object": dict, "array": list, "string": str, "boolean": bool, "integer": int, "number": (int, float)}
+
+
+def matches(value, schema):
+    # the subset of JSON schema used above: type, properties, required, additionalProperties, items, enum
+    if "type" in schema:
+        if not isinstance(value, _TYPES[schema["type"]]) or (schema["type"] in ("integer", "number") and isinstance(value, bool)):
+            return False
+    if "enum" in schema and value not in schema["enum"]:
+        return False
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        if any(key not in value for key in schema.get("required", [])):
+            return False
+        if schema.get("additionalProperties") is False and any(key not in properties for key in value):
+            return False
+        if not all(matches(value[key], sub) for key, sub in properties.items() if key in value):
+            return False
+    if isinstance(value, list) and "items" in schema:
+        return all(matches(item, schema["items"]) for item in value)
+    return True
+
+
+class ParseStats:
+    # per-stage count of outputs the parsers could not read or that do not match the stage's schema
+    def __init__(self, stage):
+        self.stage = stage
+        self.total = 0
+        self.unparsed = 0
+        self.invalid = 0
+
+    def add(self, value, schema=None):
+        self.total += 1
+        if value is None:
+            self.unparsed += 1
+            return False
+        if schema is not None and not matches(value, schema):
+            self.invalid += 1
+            return False
+        return True
+
+    def report(self):
+        if self.total:
+            failed = self.unparsed + self.invalid
+            print(f"[parse] {self.stage}: {failed}/{self.total} failed ({failed / self.total:.1%}): "
+                  f"{self.unparsed} unparsed, {self.invalid} not matching the schema")
+        self.total, self.unparsed, self.invalid = 0, 0, 0
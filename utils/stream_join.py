@@ -0,0 +1,161 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import iter_jsonl, loads
+from utils.offset_index import OffsetIndex, id_key
+from utils.projection import line_custom_id, project
+
+
+def body_contents(body):
+    # chat completion body -> message content of every choice, ordered by choice index
+    try:
+        choices = sorted(body["choices"], key=lambda choice: choice.get("index", 0))
+        return [choice["message"]["content"] for choice in choices]
+    except (KeyError, TypeError):
+        return []
+
+
+def body_content(body):
+    contents = body_contents(body)
+    return contents[0] if contents else None
+
+
+def get_body(record):
+    # batch output line -> completion body, None for failed / missing requests
+    try:
+        return record["response"]["body"]
+    except (KeyError, TypeError):
+        return None
+
+
+def get_contents(record):
+    # batch output line -> all choices, [] for failed / missing requests
+    try:
+        return body_contents(record["response"]["body"])
+    except (KeyError, TypeError):
+        return []
+
+
+def get_content(record):
+    # batch output line -> choices[0].message.content, None for failed / missing requests
+    contents = get_contents(record)
+    return contents[0] if contents else None
+
+
+def has_custom_ids(path):
+    # whether result files are batch output lines (joined by custom_id) rather than post-processed
+    # records without one, which are only aligned with their input by position
+    for p in ([path] if isinstance(path, str) else path):
+        if not os.path.exists(p):
+            continue
+        with open(p, "rb") as f:
+            for line in f:
+                if line.strip():
+                    return "custom_id" in loads(line)
+    return True
+
+
+def iter_positional(path):
+    # records of one or more post-processed result files, in order
+    for p in ([path] if isinstance(path, str) else path):
+        if os.path.exists(p):
+            yield from iter_jsonl(p)
+
+
+def duplicate_keys(indexes):
+    # id keys with more than one line across the indexed files
+    keys = np.sort(np.concatenate([index.entries[0] for index in indexes])) if indexes else np.zeros(0, dtype=np.uint64)
+    return set(keys[1:][keys[1:] == keys[:-1]].tolist())
+
+
+class CustomIdReader:
+    """Look up batch results by custom_id without loading the whole file.
+
+    vllm run_batch writes results in request order, so the common case is a
+    lockstep walk over the file. The first time the next line is not the
+    requested id (OpenAI batch output, retried shards, concatenated files)
+    the reader switches to the sidecar offset index of each file
+    (utils/offset_index.py; loaded when an up-to-date one exists next to the
+    file, built and saved otherwise) and serves every later lookup from the
+    memory-mapped file.
+
+    `path` may also be a list of result files (e.g. a batch output plus the
+    cache hits written next to its request file); they are read as one stream.
+    A custom_id with several lines resolves to the last one, in either mode:
+    the indexes are opened up front and ids they hold more than once are
+    always looked up there.
+    """
+
+    def __init__(self, path):
+        self.paths = [path] if isinstance(path, str) else [p for p in path if os.path.exists(p)]
+        self._files = [open(p, "rb") for p in self.paths]
+        self._current = 0
+        self._indexes = [OffsetIndex(p) for p in self.paths]
+        self._duplicates = duplicate_keys(self._indexes)
+        self._lockstep = True
+        self.missing = 0
+
+    def _read_next(self):
+        # -> the next raw line, None at the end
+        while self._current < len(self._files):
+            line = self._files[self._current].readline()
+            if not line:
+                self._current += 1
+                continue
+            line = line.strip()
+            if line:
+                return line
+        return None
+
+    def _lookup(self, custom_id):
+        # later files win, like later lines within a file
+        for index in reversed(self._indexes):
+            line = index.get_raw(custom_id)
+            if line is not None:
+                return line
+        return None
+
+    def take_line(self, custom_id):
+        # raw line of the result, None when there is none
+        if self._lockstep:
+            line = self._read_next()
+            if line is not None and line_custom_id(line) == custom_id:
+                if not self._duplicates or id_key(custom_id) not in self._duplicates:
+                    return line
+            else:
+                self._lockstep = False
+        line = self._lookup(custom_id)
+        if line is None:
+            self.missing += 1
+        return line
+
+    def take(self, custom_id):
+        line = self.take_line(custom_id)
+        return loads(line) if line is not None else None
+
+    def take_contents(self, custom_id):
+        # message content of every choice, [] for failed / missing requests; the projection only pays off
+        # on lines with per-token logprobs (score-only judge outputs), other lines are mostly content
+        # and a full parse reads them faster
+        line = self.take_line(custom_id)
+        if line is None:
+            return []
+        if b'"top_logprobs"' in line:
+            return project(line, ("contents",))[0]
+        return get_contents(loads(line))
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        for index in self._indexes:
+            index.close()
+        self._indexes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
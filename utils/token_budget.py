@@ -0,0 +1,230 @@
+import argparse
+import os
+import re
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.jsonl_io import JsonlWriter, dumps, loads, open_text, plain_path
+from utils.projection import iter_projected
+from utils.tokens import load_tokenizer
+
+
+# token budget of batch request files, before they are sent:
+# - report: prompt tokens per stage (one stage per request file, part files of a split file count as
+#   one), a histogram, the decode tokens max_tokens allows and, with --results from an earlier run of
+#   the stage, the decode tokens to expect; with prices, the cost of both
+# - plan: writes the requests again with max_tokens lowered per request to what the context window leaves
+#   after its prompt (capped by --max-output), so no request fails on prompt + max_tokens > max-model-len.
+#   Requests that cannot keep --min-output tokens are flagged, trimmed (oldest history turns dropped
+#   first, the system prompt and last turn are kept) or dropped, and listed in <output>.overflow.jsonl
+# Bodies are tokenized in a process pool with the tokenizer of the served model (--tokenizer, needs
+# transformers) or approximately without it; --margin absorbs the difference to the server's count.
+#
+# python utils/token_budget.py report -i Sharegpt_turn1_augmented_query_sft_1_query_1.jsonl evaluate_prompts.jsonl --tokenizer meta-llama/Llama-3.1-8B-Instruct --context 8192
+# python utils/token_budget.py plan -i Sharegpt_turn1_augmented_query_sft_1_query_1.jsonl -o Sharegpt_turn1_augmented_query_sft_1_query_1.planned.jsonl --context 8192 --overflow trim
+
+_tokenizer = None
+
+
+def _init(name):
+    global _tokenizer
+    _tokenizer = load_tokenizer(name)
+
+
+def fit(body, context, min_output, max_output, margin, overflow):
+    # -> (body with max_tokens set, prompt tokens, history turns dropped, fits)
+    messages = body["messages"]
+    tokens = len(_tokenizer.chat_tokens(messages))
+    dropped = 0
+    if overflow == "trim":
+        while tokens + margin + min_output > context:
+            first = next((i for i, message in enumerate(messages) if message["role"] != "system"), None)
+            # keep the last user turn
+            if first is None or len(messages) - first < 3:
+                break
+            messages = messages[:first] + messages[first + 2:]
+            tokens = len(_tokenizer.chat_tokens(messages))
+            dropped += 1
+    remaining = context - tokens - margin
+    if remaining < min_output:
+        return body, tokens, dropped, False
+    # planning only ever lowers max_tokens: a judge request's short budget stays as it was written
+    max_tokens = min(remaining, body.get("max_tokens", remaining), remaining if max_output is None else max_output)
+    return {**body, "messages": messages, "max_tokens": max_tokens}, tokens, dropped, True
+
+
+def plan_line(args):
+    # request line -> (planned request line, custom_id, prompt tokens, max_tokens, n, history turns dropped, fits);
+    # without rewrite, only whether the request fits is checked and max_tokens stays the request's own
+    line, context, min_output, max_output, margin, overflow, rewrite = args
+    request = loads(line)
+    body = request["body"]
+    if context is None:
+        tokens = len(_tokenizer.chat_tokens(body["messages"]))
+        return None, request["custom_id"], tokens, body.get("max_tokens"), body.get("n", 1), 0, True
+    planned, tokens, dropped, fits = fit(body, context, min_output, max_output, margin, overflow)
+    if not rewrite:
+        return None, request["custom_id"], tokens, body.get("max_tokens"), body.get("n", 1), dropped, fits
+    if fits:
+        line = dumps({**request, "body": planned})
+    return line, request["custom_id"], tokens, planned.get("max_tokens"), planned.get("n", 1), dropped, fits
+
+
+def iter_requests(path):
+    # request lines of a plain or compact (utils/request_writer.py) request file, shared messages resolved
+    shared = {}
+    with open_text(path, "r") as fin:
+        for line in fin:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{"shared_message"'):
+                record = loads(line)
+                shared[record["shared_message"]] = record["message"]
+                continue
+            if shared:
+                record = loads(line)
+                messages = record["body"]["messages"]
+                if any(isinstance(m, str) for m in messages):
+                    line = dumps({**record, "body": {**record["body"], "messages": [shared[m] if isinstance(m, str) else m for m in messages]}})
+            yield line
+
+
+def stage_name(path):
+    return re.sub(r"\.part-\d{5}(?=\.jsonl$)", "", os.path.basename(plain_path(path)))
+
+
+def mean_output_tokens(paths):
+    # completion tokens per choice in earlier batch outputs of the stage
+    completion, choices = 0, 0
+    for path in paths:
+        for usage, contents in iter_projected(path, ("usage", "contents")):
+            if usage and contents:
+                completion += usage.get("completion_tokens", 0)
+                choices += len(contents)
+    return completion / choices if choices else None
+
+
+class StageStats:
+    def __init__(self):
+        self.prompt_tokens = []
+        self.decode_bound = 0
+        self.choices = 0
+        self.trimmed = 0
+        self.overflow = 0
+
+    def add(self, tokens, max_tokens, n, dropped, fits):
+        self.prompt_tokens.append(tokens)
+        self.choices += n
+        self.decode_bound += n * (max_tokens or 0)
+        self.trimmed += dropped > 0
+        self.overflow += not fits
+
+
+def histogram(tokens, width=40):
+    # power-of-two buckets of prompt tokens
+    edges = [0] + [2 ** i for i in range(6, max(7, int(np.ceil(np.log2(max(tokens) + 1))) + 1))]
+    counts = np.histogram(tokens, bins=edges + [np.inf])[0]
+    top = max(counts.max(), 1)
+    lines = []
+    for low, high, count in zip(edges, edges[1:] + [None], counts):
+        if count:
+            label = f"{low}-{high - 1}" if high is not None else f">={low}"
+            lines.append(f"    {label:>13} {count:>9,} {'#' * max(1, round(width * count / top))}")
+    return lines
+
+
+def report(stats, results=None, price_input=None, price_output=None, context=None):
+    # stats: {stage: StageStats}; results: {stage: [batch output paths]}; prices in USD per 1M tokens
+    total_cost = 0.0
+    for stage, s in stats.items():
+        tokens = np.array(s.prompt_tokens)
+        if not len(tokens):
+            print(f"[{stage}] no requests")
+            continue
+        print(f"[{stage}] {len(tokens):,} requests, {s.choices:,} choices")
+        print(f"  prompt tokens: {tokens.sum():,} total, mean {tokens.mean():,.0f}, p50 {np.percentile(tokens, 50):,.0f}, "
+              f"p95 {np.percentile(tokens, 95):,.0f}, max {tokens.max():,}")
+        print("\n".join(histogram(tokens)))
+        print(f"  decode tokens allowed by max_tokens: {s.decode_bound:,}")
+        decode = None
+        mean_output = mean_output_tokens(results[stage]) if results and results.get(stage) else None
+        if mean_output is not None:
+            decode = mean_output * s.choices
+            print(f"  decode tokens expected: {decode:,.0f} ({mean_output:,.0f} per choice in {', '.join(results[stage])})")
+        if price_input is not None and price_output is not None:
+            prefill_cost = tokens.sum() * price_input / 1e6
+            cost = prefill_cost + (decode if decode is not None else s.decode_bound) * price_output / 1e6
+            total_cost += cost
+            print(f"  cost: ${cost:,.2f} ({'expected' if decode is not None else 'at most'}; prompt ${prefill_cost:,.2f})")
+        if context is not None:
+            print(f"  context {context}: {s.trimmed:,} trimmed, {s.overflow:,} do not fit")
+    if price_input is not None and price_output is not None and len(stats) > 1:
+        print(f"total cost: ${total_cost:,.2f}")
+
+
+def budget(paths, tokenizer=None, context=None, save_path=None, min_output=256, max_output=None, margin=16,
+           overflow="flag", workers=None, chunksize=64):
+    # -> {stage: StageStats}; with context and save_path, writes the planned requests of `paths` to save_path
+    # overflow: "flag" keeps a request that does not fit unchanged, "trim" drops history turns until it
+    # fits, "drop" leaves it out; either way it is listed in save_path.overflow.jsonl
+    assert overflow in ("flag", "trim", "drop")
+    stats = defaultdict(StageStats)
+    fout = JsonlWriter(save_path, "w") if save_path is not None else None
+    overflow_f = JsonlWriter(save_path + ".overflow.jsonl", "w") if save_path is not None else None
+    with ProcessPoolExecutor(workers, initializer=_init, initargs=(tokenizer,)) as pool:
+        for path in paths:
+            stage = stats[stage_name(path)]
+            tasks = ((line, context, min_output, max_output, margin, overflow, fout is not None) for line in iter_requests(path))
+            for line, custom_id, tokens, max_tokens, n, dropped, fits in pool.map(plan_line, tasks, chunksize=chunksize):
+                stage.add(tokens, max_tokens, n, dropped, fits)
+                if fout is None:
+                    continue
+                if not fits or dropped:
+                    overflow_f.write({"custom_id": custom_id, "path": path, "prompt_tokens": tokens, "dropped_turns": dropped,
+                                      "action": "trim" if fits else ("drop" if overflow == "drop" else "flag")})
+                if fits or overflow != "drop":
+                    fout.write_line(line)
+    if fout is not None:
+        fout.close()
+        overflow_f.close()
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["report", "plan"])
+    parser.add_argument("-i", "--input", nargs="+", required=True, help="batch request files (plain, compact, .zst)")
+    parser.add_argument("-o", "--output", help="planned request file (plan)")
+    parser.add_argument("--tokenizer", default=None, help="tokenizer of the served model; approximate counts without it")
+    parser.add_argument("--context", default=None, type=int, help="context window of the server (vllm --max-model-len)")
+    parser.add_argument("--min-output", default=256, type=int, help="fewest output tokens a request must keep")
+    parser.add_argument("--max-output", default=None, type=int, help="cap of the planned max_tokens (default: all the context left)")
+    parser.add_argument("--margin", default=16, type=int, help="tokens kept free for tokenizer / chat template differences")
+    parser.add_argument("--overflow", default="flag", choices=["flag", "trim", "drop"])
+    parser.add_argument("--results", nargs="*", default=[], help="earlier batch outputs of the stages, for the expected decode tokens")
+    parser.add_argument("--price-input", default=None, type=float, help="USD per 1M prompt tokens")
+    parser.add_argument("--price-output", default=None, type=float, help="USD per 1M output tokens")
+    parser.add_argument("--workers", default=None, type=int)
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        assert args.output and args.context, "plan needs --output and --context"
+    results = defaultdict(list)
+    stages = {stage_name(path) for path in args.input}
+    for path in args.results:
+        # output files are matched to the stage whose request file name they start with
+        stage = max((s for s in stages if os.path.basename(path).startswith(os.path.splitext(s)[0])), key=len, default=None)
+        if stage is None and len(stages) == 1:
+            stage = next(iter(stages))
+        if stage is not None:
+            results[stage].append(path)
+    stats = budget(args.input, args.tokenizer, args.context, args.output if args.command == "plan" else None,
+                   args.min_output, args.max_output, args.margin, args.overflow, args.workers)
+    report(stats, results, args.price_input, args.price_output, args.context)
+    if args.command == "plan":
+        print(f"planned requests written to {args.output}, overflow listed in {args.output}.overflow.jsonl")
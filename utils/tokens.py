@@ -0,0 +1,55 @@
+import re
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:
+    AutoTokenizer = None
+
+
+# token counts of chat requests: the model's own tokenizer and chat template when transformers is
+# installed and a tokenizer name is given, otherwise an approximation (word pieces of at most 6
+# characters, roughly what a 128k-vocabulary BPE gives on English text) rendered with a
+# Llama 3 style chat template
+
+_PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+
+
+class ApproxTokenizer:
+    name = "approx"
+
+    def encode(self, text):
+        # -> list of token strings
+        tokens = []
+        for piece in _PIECES.findall(text):
+            if len(piece) <= 6:
+                tokens.append(piece)
+            else:
+                tokens.extend(piece[i:i + 5] for i in range(0, len(piece), 5))
+        return tokens
+
+    def chat_tokens(self, messages):
+        text = "<|begin_of_text|>"
+        for message in messages:
+            text += f"<|start_header_id|>{message['role']}<|end_header_id|>\n\n{message['content']}<|eot_id|>"
+        return ["<|begin_of_text|>"] + self.encode(text[len("<|begin_of_text|>"):]) + ["<|start_header_id|>", "assistant", "<|end_header_id|>", "\n\n"]
+
+
+class HFTokenizer:
+    def __init__(self, name):
+        self.name = name
+        self.tokenizer = AutoTokenizer.from_pretrained(name)
+
+    def encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def chat_tokens(self, messages):
+        return self.tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+
+
+def load_tokenizer(name=None):
+    if name is None or name == "approx":
+        return ApproxTokenizer()
+    if AutoTokenizer is None:
+        print(f"transformers is not installed, approximating the token counts of {name}")
+        return ApproxTokenizer()
+    return HFTokenizer(name)
@@ -0,0 +1,240 @@
+import json
+import re
+
+
+# checkers for mechanically decidable eval questions, keyed by the constraint categories of
+# extract_constraint's schema; each returns True / False, or None when it cannot decide.
+# Only questions about the whole response are decided here: scoped ("each paragraph") or negated
+# ("avoid a numbered list") questions, questions more than one checker reads and questions with a count,
+# bound, exception or required keys outside the part the checker evaluates go to the judge
+VERIFIERS = []
+
+NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+    "eleven": 11, "twelve": 12, "fifteen": 15, "twenty": 20, "thirty": 30, "fifty": 50, "hundred": 100, "a single": 1, "single": 1,
+}
+_NUMBER = r"(\d+|" + "|".join(sorted(NUMBER_WORDS, key=len, reverse=True)) + r")"
+_BOUND = r"(exactly|at least|at most|no more than|no less than|no fewer than|more than|less than|fewer than|up to|(?:a )?maximum of|(?:a )?minimum of)"
+_COUNT = re.compile(r"(?:" + _BOUND + r" )?" + _NUMBER + r" ", re.IGNORECASE)
+# what a checker would have to evaluate besides its own match: counts, bounds, exceptions, required keys
+_QUALIFIER = re.compile(r"\d|\b(" + "|".join(NUMBER_WORDS) + r"|once|twice|thrice|times|at least|at most|more than|less than|fewer than|"
+                        r"up to|maximum|minimum|exactly|between|except|unless|other than|apart from|aside from|excluding|besides|"
+                        r"keys?|fields?|properties|attributes?)\b", re.IGNORECASE)
+# frequent English function words that are not also common Spanish, French, Italian, Portuguese or German words
+_ENGLISH = {"the", "and", "is", "are", "was", "were", "of", "to", "that", "this", "it", "with", "for", "be", "have", "has",
+            "you", "your", "they", "what", "which", "an", "as", "by", "from", "can", "will", "not", "or", "we", "i", "on", "at"}
+_BULLET = re.compile(r"^\s*[-*•]\s+\S", re.MULTILINE)
+_NUMBERED = re.compile(r"^\s*\d+[.)]\s+\S", re.MULTILINE)
+_SENTENCE_END = re.compile(r"[.!?]+(?=\s|$)")
+_ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g", "i.e", "fig", "no", "approx"}
+_SCOPED = re.compile(r"\b(each|per|every|first|second|third|last|final)\b", re.IGNORECASE)
+_NEGATED = re.compile(r"\b(not|no|never|none|avoid\w*|free (of|from)|without|refrain\w*|lacks?)\b|n't\b", re.IGNORECASE)
+_QUOTED = re.compile(r"[\"'“‘]([^\"'”’]{1,80})[\"'”’]")
+
+
+def register(category, pattern):
+    def wrap(fn):
+        VERIFIERS.append((category, re.compile(pattern, re.IGNORECASE), fn))
+        return fn
+    return wrap
+
+
+def to_number(text):
+    text = text.lower()
+    return int(text) if text.isdigit() else NUMBER_WORDS.get(text)
+
+
+def within(count, bound, target):
+    bound = (bound or "exactly").lower()
+    if bound in ("at least", "no less than", "no fewer than") or bound.endswith("minimum of"):
+        return count >= target
+    if bound in ("at most", "no more than", "up to") or bound.endswith("maximum of"):
+        return count <= target
+    if bound == "more than":
+        return count > target
+    if bound in ("less than", "fewer than"):
+        return count < target
+    return count == target
+
+
+def counted(match, items):
+    # a count in the match ("at least 3 bullet points") decides on the number of items, else any item does
+    count = _COUNT.search(match.group())
+    if count is None:
+        return len(items) > 0
+    return within(len(items), count.group(1), to_number(count.group(2)))
+
+
+def strip_fence(response):
+    match = re.search(r"```[A-Za-z]*\n?(.*?)```", response, re.DOTALL)
+    return match.group(1) if match else response
+
+
+def paragraphs(response):
+    return [p for p in re.split(r"\n\s*\n", response.strip()) if p.strip()]
+
+
+def sentences(response):
+    # a period after a title, an initial or a.m. / p.m. followed by a lowercase word does not end the sentence
+    text = re.sub(r"^\s*([-*•]|\d+[.)])\s+", "", response.strip(), flags=re.MULTILINE)
+    result, start = [], 0
+    for match in _SENTENCE_END.finditer(text):
+        if match.group() == ".":
+            before = text[start:match.start()].split()
+            word = before[-1].lstrip("(\"'“‘").lower() if before else ""
+            after = text[match.end():].lstrip()[:1]
+            if word in _ABBREVIATIONS or (len(word) == 1 and word.isalpha() and word != "i"):
+                continue
+            if word in ("a.m", "p.m") and not after.isupper():
+                continue
+        result.append(text[start:match.start()])
+        start = match.end()
+    result.append(text[start:])
+    return [s for s in result if s.strip()]
+
+
+def words(response):
+    return re.findall(r"\b[\w'-]+\b", response)
+
+
+@register("Format", r"\b(?:" + _BOUND + r" )?(?:" + _NUMBER + r" )?bullet[ -]?points?\b|\bbulleted\b")
+def check_bullets(question, response, match):
+    return counted(match, _BULLET.findall(response))
+
+
+@register("Format", r"\b(?:" + _BOUND + r" )?(?:" + _NUMBER + r" )?numbered (?:list )?(?:items?|points?|steps?)\b|"
+                    r"\bnumbered list(?: (?:with|of|containing) (?:" + _BOUND + r" )?" + _NUMBER + r" (?:items?|points?|steps?|entries))?\b")
+def check_numbered(question, response, match):
+    return counted(match, _NUMBERED.findall(response))
+
+
+@register("Format", r"\b(in|as|valid|use|uses|using) (a )?json\b|\bjson format\b")
+def check_json(question, response, match):
+    try:
+        json.loads(strip_fence(response).strip())
+        return True
+    except ValueError:
+        return False
+
+
+@register("Format", r"\b(markdown )?table\b")
+def check_table(question, response, match):
+    if not re.search(r"\b(use|uses|in|as|present|format)\b.*\btable\b", question, re.IGNORECASE):
+        return None
+    return bool(re.search(r"^\s*\|?.*\|.*\n\s*\|?\s*:?-{3,}", response, re.MULTILINE))
+
+
+@register("Format", r"\b(no|without|avoid|not use any) commas?\b")
+def check_no_commas(question, response, match):
+    return "," not in response
+
+
+@register("Linguistic", r"\b(all |entirely |only |completely )?(in )?lower ?case\b")
+def check_lowercase(question, response, match):
+    if not re.search(r"\b(all|entire|entirely|only|completely|whole)\b", question, re.IGNORECASE):
+        return None
+    return response == response.lower()
+
+
+@register("Linguistic", r"\b(all |entirely |only |completely )?(in )?(upper ?case|capital letters)\b")
+def check_uppercase(question, response, match):
+    if not re.search(r"\b(all|entire|entirely|only|completely|whole)\b", question, re.IGNORECASE):
+        return None
+    return response == response.upper()
+
+
+@register("Linguistic", r"\b(written |respond |response )?in english\b")
+def check_english(question, response, match):
+    # mostly non-Latin letters is not English; Latin text only when English function words are frequent,
+    # unaccented Spanish or Italian is ASCII too
+    letters = [c for c in response if c.isalpha()]
+    if not letters:
+        return None
+    if sum(c.isascii() for c in letters) / len(letters) < 0.5:
+        return False
+    tokens = [word.lower() for word in words(response)]
+    if len(tokens) < 8:
+        return None
+    return True if sum(token in _ENGLISH for token in tokens) / len(tokens) >= 0.15 else None
+
+
+@register("Numerical", r"\bexactly " + _NUMBER + r" (sentences?|paragraphs?|words?)\b")
+def check_exact_count(question, response, match):
+    target = to_number(match.group(1))
+    unit = match.group(2).lower()
+    if unit.startswith("sentence"):
+        return len(sentences(response)) == target
+    if unit.startswith("paragraph"):
+        return len(paragraphs(response)) == target
+    return len(words(response)) == target
+
+
+@register("Numerical", r"\b(?<!no )(within|at most|no more than|less than|fewer than|under|not exceed(?:ing)?|maximum of) " + _NUMBER + r" (words?|sentences?|paragraphs?)\b")
+def check_max_count(question, response, match):
+    bound = to_number(match.group(2))
+    unit = match.group(3).lower()
+    count = len(words(response)) if unit.startswith("word") else len(sentences(response)) if unit.startswith("sentence") else len(paragraphs(response))
+    strict = match.group(1).lower() in ("less than", "fewer than", "under")
+    return count < bound if strict else count <= bound
+
+
+@register("Numerical", r"\b(?<!no )(at least|no less than|more than|minimum of) " + _NUMBER + r" (words?|sentences?|paragraphs?)\b")
+def check_min_count(question, response, match):
+    bound = to_number(match.group(2))
+    unit = match.group(3).lower()
+    count = len(words(response)) if unit.startswith("word") else len(sentences(response)) if unit.startswith("sentence") else len(paragraphs(response))
+    return count > bound if match.group(1).lower() == "more than" else count >= bound
+
+
+@register("Content", r"\b(include|includes|contain|contains|use|uses|mention|mentions) the (word|phrase|term|keyword)s? ")
+def check_keyword(question, response, match):
+    terms = _QUOTED.findall(question[match.end() - 1:])
+    if not terms:
+        return None
+    return all(re.search(r"(?<!\w)" + re.escape(term.lower()) + r"(?!\w)", response.lower()) for term in terms)
+
+
+@register("Format", r"\b(end|ends|conclude|concludes) with the (exact )?(phrase|sentence|word) ")
+def check_ending(question, response, match):
+    terms = _QUOTED.findall(question[match.end() - 1:])
+    if len(terms) != 1:
+        return None
+    return response.strip().rstrip(".!?\"'").lower().endswith(terms[0].strip().rstrip(".!?").lower())
+
+
+@register("Format", r"\b(start|starts|begin|begins) with the (exact )?(phrase|sentence|word) ")
+def check_start(question, response, match):
+    terms = _QUOTED.findall(question[match.end() - 1:])
+    if len(terms) != 1:
+        return None
+    return response.strip().lstrip("\"'").lower().startswith(terms[0].strip().lower())
+
+
+def verify(question, response):
+    # -> (verdict, category); verdict is None when no single registered checker can decide the question
+    if _SCOPED.search(question):
+        return None, None
+    matched = [(category, pattern.search(question), fn) for category, pattern, fn in VERIFIERS]
+    matched = [(category, match, fn) for category, match, fn in matched if match is not None]
+    if len(matched) != 1:
+        return None, None
+    category, match, fn = matched[0]
+    # negations and counts the checker reads itself ("no more than", "at least 3 bullet points") are part
+    # of the match; quoted terms are the checker's too
+    rest = _QUOTED.sub(" ", question[:match.start()] + " " + question[match.end():])
+    if _NEGATED.search(rest) or _QUALIFIER.search(rest):
+        return None, None
+    verdict = fn(question, response, match)
+    return (None, None) if verdict is None else (verdict, category)
+
+
+def split_questions(questions, response):
+    # -> ({question index: verdict} decided locally, [indices left for the judge])
+    decided, remaining = {}, []
+    for i, question in enumerate(questions):
+        verdict, _ = verify(question, response)
+        if verdict is None:
+            remaining.append(i)
+        else:
+            decided[i] = verdict
+    return decided, remaining